@@ -3,7 +3,7 @@ import logging
 from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, status
 from llama_index.core.llms import MessageRole
 
-from app.api.routers.events import EventCallbackHandler
+from app.api.routers.events import EventCallbackHandler, set_event_handler
 from app.api.routers.models import (
     ChatData,
     Message,
@@ -37,6 +37,8 @@ async def chat(
             f"Creating chat engine with filters: {str(filters)}",
         )
         event_handler = EventCallbackHandler()
+        # Let the tools stream their progress to this request
+        set_event_handler(event_handler)
         chat_engine = get_chat_engine(
             filters=filters, params=params, event_handlers=[event_handler]
         )
@@ -1,7 +1,8 @@
 import asyncio
 import json
 import logging
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union
 
 from llama_index.core.callbacks.base import BaseCallbackHandler
 from llama_index.core.callbacks.schema import CBEventType
@@ -99,6 +100,17 @@ class CallbackEvent(BaseModel):
             return None
 
 
+class DataEvent(BaseModel):
+    """
+    An event with data sent directly to the client, e.g. the partial output of a tool.
+    """
+
+    data: Dict[str, Any]
+
+    def to_response(self):
+        return self.data
+
+
 class EventCallbackHandler(BaseCallbackHandler):
     _aqueue: asyncio.Queue
     is_done: bool = False
@@ -141,6 +153,12 @@ class EventCallbackHandler(BaseCallbackHandler):
         if event.to_response() is not None:
             self._aqueue.put_nowait(event)
 
+    def send(self, data: Dict[str, Any]) -> None:
+        """
+        Send data to the client in the event stream.
+        """
+        self._aqueue.put_nowait(DataEvent(data=data))
+
     def start_trace(self, trace_id: Optional[str] = None) -> None:
         """No-op."""
 
@@ -151,9 +169,33 @@ class EventCallbackHandler(BaseCallbackHandler):
     ) -> None:
         """No-op."""
 
-    async def async_event_gen(self) -> AsyncGenerator[CallbackEvent, None]:
+    async def async_event_gen(
+        self,
+    ) -> AsyncGenerator[Union[CallbackEvent, DataEvent], None]:
         while not self._aqueue.empty() or not self.is_done:
             try:
                 yield await asyncio.wait_for(self._aqueue.get(), timeout=0.1)
             except asyncio.TimeoutError:
                 pass
+
+
+# The event handler of the current chat request, so tools can send events to the client
+_current_event_handler: ContextVar[Optional[EventCallbackHandler]] = ContextVar(
+    "current_event_handler", default=None
+)
+
+
+def set_event_handler(event_handler: Optional[EventCallbackHandler]) -> None:
+    _current_event_handler.set(event_handler)
+
+
+def send_event(data: Dict[str, Any]) -> bool:
+    """
+    Send data to the client of the current chat request.
+    Returns False if there is no event stream, e.g. in a non-streaming request.
+    """
+    event_handler = _current_event_handler.get()
+    if event_handler is None or event_handler.is_done:
+        return False
+    event_handler.send(data)
+    return True
@@ -1,11 +1,14 @@
+import json
 import logging
-from typing import Any
+import os
+from typing import Any, Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, File, Form, Header, HTTPException, UploadFile
 from pydantic import BaseModel
 
 from app.api.routers.models import DocumentFile
 from app.services.file import FileService
+from app.services.indexing import IndexingJob, get_indexing_queue
 
 file_upload_router = r = APIRouter()
 
@@ -22,12 +25,71 @@ class FileUploadRequest(BaseModel):
 def upload_file(request: FileUploadRequest) -> DocumentFile:
     """
     To upload a private file from the chat UI.
+    Set INDEXING_BACKGROUND=true to index the file in the background instead of waiting for it.
     """
+    background = os.getenv("INDEXING_BACKGROUND", "false").lower() == "true"
     try:
         logger.info(f"Processing file: {request.name}")
         return FileService.process_private_file(
-            request.name, request.base64, request.params
+            request.name, request.base64, request.params, background=background
         )
     except Exception as e:
         logger.error(f"Error processing file: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error processing file")
+
+
+@r.post("/stream")
+def upload_file_stream(
+    file: UploadFile = File(...),
+    params: Optional[str] = Form(None),
+) -> DocumentFile:
+    """
+    To upload a private file as multipart form data.
+    The file is streamed to disk and queued for indexing,
+    so the response is returned as soon as the file is stored.
+    Use the returned `job_id` to check the indexing status.
+    """
+    try:
+        parsed_params = json.loads(params) if params else None
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+    try:
+        logger.info(f"Streaming file: {file.filename}")
+        return FileService.process_private_file_stream(
+            file.filename, file.file, parsed_params
+        )
+    except Exception as e:
+        logger.error(f"Error processing file: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Error processing file")
+
+
+@r.get("/jobs/{job_id}")
+def get_indexing_job(job_id: str) -> IndexingJob:
+    """
+    To get the status of a background indexing job.
+    """
+    job = get_indexing_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Indexing job not found")
+    return job
+
+
+@r.delete("/{file_id}")
+def delete_file(
+    file_id: str,
+    user_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    release_token: Optional[str] = Header(None, alias="X-Release-Token"),
+) -> dict:
+    """
+    To release an uploaded private file, with the `release_token` returned by the upload.
+    The file is only deleted (and removed from the index) when no other uploader references it.
+    """
+    params = {"user_id": user_id, "session_id": session_id}
+    try:
+        deleted = FileService.release_private_file(file_id, params, release_token)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    return {"deleted": deleted}
@@ -0,0 +1,390 @@
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from app.engine.query_filter import matches_filters
+
+logger = logging.getLogger("uvicorn")
+
+BM25_DIR = os.path.join(os.getenv("STORAGE_DIR", "storage"), "bm25")
+
+# Words, numbers and identifiers like part numbers (AB-1234) or clause ids (4.2.1)
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "in",
+    "is", "it", "of", "on", "or", "that", "the", "to", "was", "were", "with",
+}  # fmt: skip
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase terms. Compound identifiers are kept as one term
+    and their parts are added too, so "AB-1234" matches both "ab-1234" and "1234".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        parts = re.split(r"[-./:]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """
+    A sparse inverted index over the nodes of a vector store collection, scored with BM25.
+
+    Changes are appended to a log file, so nodes can be added on every insert without loading
+    the index; it's loaded into memory on the first search. If there is no log yet, it's built
+    from the nodes in the vector store on the first search, and changes before that are skipped
+    as the vector store already has them. Once the index is loaded, the log is rewritten with only
+    the live nodes when most of its records are updated or deleted nodes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        vector_store: Any,
+        k1: float = 1.5,
+        b: float = 0.75,
+        compact_min_records: int = 10000,
+    ):
+        self.path = path
+        self.vector_store = vector_store
+        self.k1 = k1
+        self.b = b
+        self.compact_min_records = compact_min_records
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._log_records = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        # Node ids are mapped to small ints to keep the postings compact
+        self._keys: Dict[str, int] = {}
+        self._node_ids: List[Optional[str]] = []
+        self._ref_doc_ids: List[Optional[str]] = []
+        self._metadata: List[Dict[str, Any]] = []
+        self._terms: List[List[str]] = []
+        self._lengths: List[int] = []
+        self._ref_keys: Dict[str, Set[int]] = {}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._total_length = 0
+        self._live_count = 0
+
+    def add(self, nodes: Sequence[BaseNode]) -> None:
+        """
+        Add (or update) nodes in the index.
+        """
+        records = [self._to_record(node) for node in nodes]
+        if len(records) == 0:
+            return
+        with self._lock:
+            if not os.path.exists(self.path):
+                # The log is built from the vector store on the first search, which has the nodes
+                return
+            self._append(records)
+            if self._loaded:
+                for record in records:
+                    self._apply(record)
+                self._maybe_compact()
+
+    def delete(self, ref_doc_id: str) -> None:
+        """
+        Delete the nodes of a document from the index.
+        """
+        record = {"op": "delete", "ref": ref_doc_id}
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            self._append([record])
+            if self._loaded:
+                self._apply(record)
+                self._maybe_compact()
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        filters: Optional[MetadataFilters] = None,
+    ) -> List[Tuple[str, float]]:
+        """
+        Get the ids and BM25 scores of the top-k nodes matching the query and filters.
+        """
+        terms = Counter(tokenize(query))
+        with self._lock:
+            self._load()
+            if self._live_count == 0 or len(terms) == 0:
+                return []
+            average_length = self._total_length / self._live_count
+            scores: Dict[int, float] = {}
+            for term, query_count in terms.items():
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(
+                    1 + (self._live_count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for key, tf in postings.items():
+                    length_norm = 1 - self.b + self.b * self._lengths[key] / average_length
+                    score = idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+                    scores[key] = scores.get(key, 0.0) + query_count * score
+            if filters is not None:
+                scores = {
+                    key: score
+                    for key, score in scores.items()
+                    if matches_filters(self._metadata[key], filters)
+                }
+            top = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [(self._node_ids[key], score) for key, score in top]
+
+    def _ensure_log(self) -> None:
+        if os.path.exists(self.path):
+            return
+        # Build the index from the nodes that were stored before it existed
+        try:
+            nodes = self.vector_store.get_nodes()
+        except NotImplementedError:
+            logger.warning(
+                f"{self.vector_store.__class__.__name__} can't list its nodes, starting an empty BM25 index"
+            )
+            nodes = []
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._append([self._to_record(node) for node in nodes])
+        logger.info(f"Built BM25 index {self.path} with {len(nodes)} nodes")
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._ensure_log()
+        self._log_records = 0
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    self._apply(json.loads(line))
+                    self._log_records += 1
+        self._loaded = True
+        logger.info(f"Loaded BM25 index {self.path} with {self._live_count} nodes")
+        self._maybe_compact()
+
+    def _append(self, records: List[Dict[str, Any]]) -> None:
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        self._log_records += len(records)
+
+    def _maybe_compact(self) -> None:
+        if self._log_records < max(self.compact_min_records, 2 * self._live_count):
+            return
+        self.compact()
+
+    def compact(self) -> None:
+        """
+        Rewrite the log with only the live nodes, and drop the deleted nodes from memory.
+        """
+        with self._lock:
+            self._load()
+            records = [
+                {
+                    "op": "add",
+                    "id": node_id,
+                    "ref": self._ref_doc_ids[key],
+                    "meta": self._metadata[key],
+                    "tf": {term: self._postings[term][key] for term in self._terms[key]},
+                    "len": self._lengths[key],
+                }
+                for key, node_id in enumerate(self._node_ids)
+                if node_id is not None
+            ]
+            tmp_path = f"{self.path}.compacting"
+            with open(tmp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, self.path)
+            self._reset()
+            for record in records:
+                self._apply(record)
+            self._log_records = len(records)
+        logger.info(f"Compacted BM25 index {self.path} to {len(records)} nodes")
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        if record["op"] == "delete":
+            for key in list(self._ref_keys.get(record["ref"], ())):
+                self._remove(key)
+            return
+        key = self._keys.get(record["id"])
+        if key is not None:
+            self._remove(key)
+        key = len(self._node_ids)
+        self._keys[record["id"]] = key
+        self._node_ids.append(record["id"])
+        self._ref_doc_ids.append(record["ref"])
+        self._metadata.append(record["meta"])
+        self._terms.append(list(record["tf"]))
+        self._lengths.append(record["len"])
+        self._ref_keys.setdefault(record["ref"], set()).add(key)
+        for term, tf in record["tf"].items():
+            self._postings.setdefault(term, {})[key] = tf
+        self._total_length += record["len"]
+        self._live_count += 1
+
+    def _remove(self, key: int) -> None:
+        node_id = self._node_ids[key]
+        if node_id is None:
+            return
+        for term in self._terms[key]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(key, None)
+                if len(postings) == 0:
+                    del self._postings[term]
+        self._keys.pop(node_id, None)
+        self._ref_keys.get(self._ref_doc_ids[key], set()).discard(key)
+        self._node_ids[key] = None
+        self._ref_doc_ids[key] = None
+        self._metadata[key] = {}
+        self._terms[key] = []
+        self._total_length -= self._lengths[key]
+        self._live_count -= 1
+
+    @staticmethod
+    def _to_record(node: BaseNode) -> Dict[str, Any]:
+        terms = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+        metadata = {
+            key: value
+            for key, value in node.metadata.items()
+            if isinstance(value, (str, int, float, bool))
+        }
+        # Vector stores add the document id to the metadata, it's used to filter private documents
+        metadata["doc_id"] = node.ref_doc_id
+        return {
+            "op": "add",
+            "id": node.node_id,
+            "ref": node.ref_doc_id,
+            "meta": metadata,
+            "tf": dict(Counter(terms)),
+            "len": len(terms),
+        }
+
+
+class BM25Retriever(BaseRetriever):
+    """
+    Retrieve nodes with the BM25 index and load them from the vector store.
+    """
+
+    def __init__(
+        self,
+        bm25_index: BM25Index,
+        similarity_top_k: int,
+        filters: Optional[MetadataFilters] = None,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        super().__init__(callback_manager=callback_manager)
+        self._bm25_index = bm25_index
+        self._similarity_top_k = similarity_top_k
+        self._filters = filters
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        results = self._bm25_index.search(
+            query_bundle.query_str, self._similarity_top_k, self._filters
+        )
+        if len(results) == 0:
+            return []
+        nodes = self._bm25_index.vector_store.get_nodes(
+            node_ids=[node_id for node_id, _ in results]
+        )
+        nodes_by_id = {node.node_id: node for node in nodes}
+        return [
+            NodeWithScore(node=nodes_by_id[node_id], score=score)
+            for node_id, score in results
+            if node_id in nodes_by_id
+        ]
+
+
+_bm25_indexes: Dict[str, BM25Index] = {}
+_bm25_indexes_lock = threading.Lock()
+
+
+def get_bm25_index(vector_store: Any) -> BM25Index:
+    """
+    Get the BM25 index of a vector store collection.
+    """
+    name = get_collection_name(vector_store)
+    with _bm25_indexes_lock:
+        bm25_index = _bm25_indexes.get(name)
+        if bm25_index is None:
+            bm25_index = BM25Index(
+                path=os.path.join(BM25_DIR, f"{name}.jsonl"),
+                vector_store=vector_store,
+                k1=float(os.getenv("BM25_K1", "1.5")),
+                b=float(os.getenv("BM25_B", "0.75")),
+                compact_min_records=int(os.getenv("BM25_COMPACT_MIN_RECORDS", "10000")),
+            )
+            _bm25_indexes[name] = bm25_index
+    return bm25_index
+
+
+def get_collection_name(vector_store: Any) -> str:
+    name = getattr(vector_store, "collection_name", None)
+    if not name and getattr(vector_store, "persist_dir", None):
+        name = os.path.basename(os.path.normpath(vector_store.persist_dir))
+    return name or "default"
+
+
+def is_hybrid_retrieval_enabled() -> bool:
+    return os.getenv("RETRIEVAL_MODE", "dense") == "hybrid"
+
+
+def add_nodes_to_bm25_index(vector_store: Any, nodes: Sequence[BaseNode]) -> None:
+    """
+    Keep the BM25 index of a vector store in sync after inserting nodes.
+    """
+    try:
+        if not is_hybrid_retrieval_enabled():
+            _drop_bm25_index(vector_store)
+            return
+        get_bm25_index(vector_store).add(nodes)
+    except Exception:
+        # The BM25 index can be rebuilt from the vector store, don't fail the insert
+        logger.exception("Failed to add nodes to the BM25 index")
+
+
+def delete_from_bm25_index(vector_store: Any, ref_doc_ids: Sequence[str]) -> None:
+    """
+    Keep the BM25 index of a vector store in sync after deleting documents.
+    """
+    try:
+        if not is_hybrid_retrieval_enabled():
+            _drop_bm25_index(vector_store)
+            return
+        bm25_index = get_bm25_index(vector_store)
+        for ref_doc_id in ref_doc_ids:
+            bm25_index.delete(ref_doc_id)
+    except Exception:
+        logger.exception("Failed to delete documents from the BM25 index")
+        # Rebuild the index on the next search instead of returning the deleted nodes
+        _drop_bm25_index(vector_store)
+
+
+def _drop_bm25_index(vector_store: Any) -> None:
+    # The index isn't maintained outside of hybrid mode, so a log left by an earlier
+    # hybrid run is removed to be rebuilt from the vector store instead of going stale
+    name = get_collection_name(vector_store)
+    path = os.path.join(BM25_DIR, f"{name}.jsonl")
+    with _bm25_indexes_lock:
+        _bm25_indexes.pop(name, None)
+        if os.path.exists(path):
+            os.remove(path)
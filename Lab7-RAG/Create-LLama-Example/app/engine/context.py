@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, cast
+
+from cachetools import LRUCache
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import (
+    ImageNode,
+    MetadataMode,
+    NodeWithScore,
+    QueryBundle,
+    TextNode,
+)
+from llama_index.core.settings import Settings
+
+logger = logging.getLogger("uvicorn")
+
+# Tokens kept free for the prompt template, the query and the chat history
+PROMPT_RESERVE_TOKENS = 1024
+
+_token_counts: LRUCache = LRUCache(maxsize=16384)
+_token_counts_lock = threading.Lock()
+_tokenizers: Dict[str, Callable[[str], List]] = {}
+
+
+def get_tokenizer() -> Callable[[str], List]:
+    """
+    Get the tokenizer of the active LLM if tiktoken knows it, otherwise the global tokenizer.
+    """
+    model_name = getattr(Settings.llm.metadata, "model_name", None) or ""
+    tokenizer = _tokenizers.get(model_name)
+    if tokenizer is None:
+        tokenizer = Settings.tokenizer
+        try:
+            import tiktoken
+
+            tokenizer = tiktoken.encoding_for_model(model_name).encode
+        except (ImportError, KeyError):
+            pass
+        _tokenizers[model_name] = tokenizer
+    return tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text. Counts are cached by content, so every chunk is tokenized once.
+    """
+    tokenizer = get_tokenizer()
+    key = (id(tokenizer), hashlib.sha1(text.encode("utf-8")).hexdigest())
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+    if count is None:
+        count = len(tokenizer(text))
+        with _token_counts_lock:
+            _token_counts[key] = count
+    return count
+
+
+def cut_to_token_budget(
+    nodes: List[NodeWithScore], token_budget: int
+) -> List[NodeWithScore]:
+    """
+    Keep the nodes (in order) until the token budget is used up. The first node is always kept.
+    """
+    kept: List[NodeWithScore] = []
+    used = 0
+    for node in nodes:
+        tokens = count_tokens(node.node.get_content(metadata_mode=MetadataMode.LLM))
+        if len(kept) > 0 and used + tokens > token_budget:
+            break
+        kept.append(node)
+        used += tokens
+    return kept
+
+
+def get_context_token_budget(metadata: Optional[Any] = None) -> int:
+    """
+    The tokens available for the retrieved context, CONTEXT_TOKEN_BUDGET or derived from
+    the metadata of the LLM (the active LLM by default).
+    """
+    budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+    if budget > 0:
+        return budget
+    if metadata is None:
+        metadata = Settings.llm.metadata
+    return max(
+        512, metadata.context_window - metadata.num_output - PROMPT_RESERVE_TOKENS
+    )
+
+
+class ContextPacker(BaseNodePostprocessor):
+    """
+    Pack the retrieved nodes into a context that fits a single LLM call.
+
+    Duplicate chunks and overlapping chunks of the same document are merged, then the nodes
+    are kept by score until the token budget is used up. With a budget below the context window,
+    the compact response mode answers in one call instead of a chain of refine calls.
+    """
+
+    token_budget: int
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextPacker"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if len(nodes) == 0:
+            return nodes
+        ranked = sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)
+        packed = cut_to_token_budget(self._merge_overlapping(ranked), self.token_budget)
+        if len(packed) < len(nodes):
+            logger.info(f"Packed {len(nodes)} retrieved nodes into {len(packed)} nodes")
+        return packed
+
+    @staticmethod
+    def _merge_overlapping(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """
+        Merge nodes with the same content or overlapping character ranges of the same document.
+        The merged node takes the position (and score) of the best of them.
+        Image nodes have no text to compare, only repeated nodes are dropped.
+        """
+        merged: List[NodeWithScore] = []
+        seen_content: Set[str] = set()
+        seen_images: Set[str] = set()
+        for node in nodes:
+            if isinstance(node.node, ImageNode) or not isinstance(node.node, TextNode):
+                if node.node.node_id not in seen_images:
+                    merged.append(node)
+                    seen_images.add(node.node.node_id)
+                continue
+            content = node.node.get_content(metadata_mode=MetadataMode.NONE)
+            content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+            if content_hash in seen_content:
+                continue
+            for i, kept in enumerate(merged):
+                combined = _merge_text_nodes(kept, node)
+                if combined is not None:
+                    merged[i] = combined
+                    break
+            else:
+                merged.append(node)
+            seen_content.add(content_hash)
+        return merged
+
+
+def _merge_text_nodes(
+    first: NodeWithScore, second: NodeWithScore
+) -> Optional[NodeWithScore]:
+    a, b = first.node, second.node
+    if not isinstance(a, TextNode) or not isinstance(b, TextNode):
+        return None
+    if a.ref_doc_id is None or a.ref_doc_id != b.ref_doc_id:
+        return None
+    # The documents of an uploaded file share its id, the offsets are only comparable within a part
+    if a.metadata.get("file_part") != b.metadata.get("file_part"):
+        return None
+    if None in (a.start_char_idx, a.end_char_idx, b.start_char_idx, b.end_char_idx):
+        return None
+    if a.start_char_idx > b.start_char_idx:
+        a, b = b, a
+    if b.start_char_idx > a.end_char_idx:
+        return None
+    if b.end_char_idx <= a.end_char_idx:
+        # One chunk contains the other, if the offsets refer to the same text
+        if b.text not in a.text:
+            return None
+        text = a.text
+    else:
+        overlap = a.end_char_idx - b.start_char_idx
+        # Only merge if the texts agree on the overlap (the offsets refer to the same text)
+        if overlap > 0 and not a.text.endswith(b.text[:overlap]):
+            return None
+        text = a.text + b.text[overlap:]
+    node = cast(TextNode, first.node.model_copy())
+    node.text = text
+    node.start_char_idx = a.start_char_idx
+    node.end_char_idx = max(a.end_char_idx, b.end_char_idx)
+    return NodeWithScore(node=node, score=max(first.score or 0.0, second.score or 0.0))
+
+
+def get_context_packer() -> Optional[ContextPacker]:
+    """
+    Get the context packer if it's enabled with CONTEXT_PACKING=true (it's off by default).
+    """
+    if os.getenv("CONTEXT_PACKING", "false").lower() != "true":
+        return None
+    return ContextPacker(token_budget=get_context_token_budget())
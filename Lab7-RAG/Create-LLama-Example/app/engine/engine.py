@@ -6,8 +6,8 @@ from llama_index.core.callbacks import CallbackManager
 from llama_index.core.settings import Settings
 from llama_index.core.tools import BaseTool
 
-from app.engine.index import IndexConfig, get_index
-from app.engine.tools import ToolFactory
+from app.engine.index import IndexConfig, get_index, get_private_index
+from app.engine.tools import ToolContext, ToolFactory
 from app.engine.tools.query_engine import get_query_engine_tool
 
 
@@ -19,12 +19,23 @@ def get_chat_engine(params=None, event_handlers=None, **kwargs):
     # Add query tool if index exists
     index_config = IndexConfig(callback_manager=callback_manager, **(params or {}))
     index = get_index(index_config)
+    private_index = None
     if index is not None:
-        query_engine_tool = get_query_engine_tool(index, **kwargs)
+        # Query the private uploads of the user together with the shared index
+        private_index = get_private_index(params, index_config)
+        query_engine_tool = get_query_engine_tool(
+            index, private_index=private_index, **kwargs
+        )
         tools.append(query_engine_tool)
 
     # Add additional tools
-    configured_tools: List[BaseTool] = ToolFactory.from_env()
+    configured_tools: List[BaseTool] = ToolFactory.from_env(
+        context=ToolContext(
+            params=params,
+            filters=kwargs.get("filters"),
+            private_index=private_index,
+        )
+    )
     tools.extend(configured_tools)
 
     return AgentRunner.from_llm(
@@ -7,12 +7,13 @@ import logging
 import os
 
 from llama_index.core.ingestion import DocstoreStrategy, IngestionPipeline
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.settings import Settings
 from llama_index.core.storage import StorageContext
 from llama_index.core.storage.docstore import SimpleDocumentStore
 
+from app.engine.bm25 import add_nodes_to_bm25_index, delete_from_bm25_index
+from app.engine.ingestion import get_transformations
 from app.engine.loaders import get_documents
+from app.engine.storage import get_docstore_log
 from app.engine.vectordb import get_vector_store
 from app.settings import init_settings
 
@@ -23,23 +24,18 @@ STORAGE_DIR = os.getenv("STORAGE_DIR", "storage")
 
 
 def get_doc_store():
-    # If the storage directory is there, load the document store from it.
+    # If the storage directory is there, load the document store from it
+    # (including the nodes appended to the docstore log since the last persist).
     # If not, set up an in-memory document store since we can't load from a directory that doesn't exist.
     if os.path.exists(STORAGE_DIR):
-        return SimpleDocumentStore.from_persist_dir(STORAGE_DIR)
+        return get_docstore_log().load_docstore()
     else:
         return SimpleDocumentStore()
 
 
 def run_pipeline(docstore, vector_store, documents):
     pipeline = IngestionPipeline(
-        transformations=[
-            SentenceSplitter(
-                chunk_size=Settings.chunk_size,
-                chunk_overlap=Settings.chunk_overlap,
-            ),
-            Settings.embed_model,
-        ],
+        transformations=get_transformations(),
         docstore=docstore,
         docstore_strategy=DocstoreStrategy.UPSERTS_AND_DELETE,  # type: ignore
         vector_store=vector_store,
@@ -57,6 +53,8 @@ def persist_storage(docstore, vector_store):
         vector_store=vector_store,
     )
     storage_context.persist(STORAGE_DIR)
+    # The persisted docstore includes all nodes from the log
+    get_docstore_log().clear()
 
 
 def generate_datasource():
@@ -70,9 +68,16 @@ def generate_datasource():
         doc.metadata["private"] = "false"
     docstore = get_doc_store()
     vector_store = get_vector_store()
+    previous_doc_ids = set(docstore.get_all_document_hashes().values())
 
     # Run the ingestion pipeline
-    _ = run_pipeline(docstore, vector_store, documents)
+    nodes = run_pipeline(docstore, vector_store, documents)
+    # The pipeline replaced the nodes of changed documents and deleted the removed documents,
+    # drop their old nodes from the keyword index before indexing the new ones
+    removed_doc_ids = previous_doc_ids - {doc.id_ for doc in documents}
+    upserted_doc_ids = {node.ref_doc_id for node in nodes if node.ref_doc_id}
+    delete_from_bm25_index(vector_store, sorted(removed_doc_ids | upserted_doc_ids))
+    add_nodes_to_bm25_index(vector_store, nodes)
 
     # Build the index and persist storage
     persist_storage(docstore, vector_store)
@@ -0,0 +1,131 @@
+import base64
+import io
+import logging
+import math
+import os
+import threading
+from typing import List, Optional, Sequence, Tuple, Union
+
+from cachetools import LRUCache
+from llama_index.core.base.llms.types import ImageBlock
+from llama_index.core.schema import BaseNode, ImageNode
+
+logger = logging.getLogger("uvicorn")
+
+# Images are downscaled to fit this size (in pixels) before they are sent to the LLM
+DEFAULT_IMAGE_MAX_SIZE = 1024
+JPEG_QUALITY = 85
+DEFAULT_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# The prepared images (base64 and mimetype) by node id and size, bounded by their size in bytes
+_image_cache: LRUCache = LRUCache(
+    maxsize=int(os.getenv("IMAGE_CACHE_BYTES", str(DEFAULT_IMAGE_CACHE_BYTES))),
+    getsizeof=lambda value: len(value[0]),
+)
+_image_cache_lock = threading.Lock()
+
+
+def get_image_max_size() -> int:
+    return int(os.getenv("MULTIMODAL_IMAGE_MAX_SIZE", str(DEFAULT_IMAGE_MAX_SIZE)))
+
+
+def prepare_image_node(node: ImageNode, max_size: Optional[int] = None) -> ImageNode:
+    """
+    Get a copy of an image node with a downscaled and re-encoded base64 image.
+    Images that are only available by URL are returned as they are.
+    """
+    if max_size is None:
+        max_size = get_image_max_size()
+    cached = _get_prepared_image(node, max_size)
+    if cached is None:
+        return node
+    image, mimetype = cached
+    return ImageNode(
+        id_=node.node_id,
+        image=image,
+        image_mimetype=mimetype,
+        metadata=node.metadata,
+    )
+
+
+def prepare_image_nodes(
+    nodes: List[ImageNode], max_size: Optional[int] = None
+) -> List[Union[ImageNode, ImageBlock]]:
+    return [prepare_image_node(node, max_size) for node in nodes]
+
+
+def estimate_image_tokens(max_size: Optional[int] = None) -> int:
+    """
+    Estimate the prompt tokens of a prepared image, counted like OpenAI vision models:
+    85 tokens plus 170 tokens per 512px tile of an image of the maximum size.
+    """
+    if max_size is None:
+        max_size = get_image_max_size()
+    tiles = math.ceil(max_size / 512) ** 2
+    return 85 + 170 * tiles
+
+
+def warm_image_cache(nodes: Sequence[BaseNode], max_size: Optional[int] = None) -> None:
+    """
+    Prepare the images of new image nodes in a background thread,
+    so the first query over them doesn't pay for decoding and encoding.
+    """
+    image_nodes = [node for node in nodes if isinstance(node, ImageNode)]
+    if len(image_nodes) == 0:
+        return
+    if max_size is None:
+        max_size = get_image_max_size()
+
+    def warm():
+        for node in image_nodes:
+            try:
+                _get_prepared_image(node, max_size)
+            except Exception as e:
+                logger.warning(f"Failed to prepare image of node {node.node_id}: {e}")
+
+    threading.Thread(target=warm, name="image-cache-warmup", daemon=True).start()
+
+
+def _get_prepared_image(node: ImageNode, max_size: int) -> Optional[Tuple[str, str]]:
+    key = (node.node_id, max_size)
+    with _image_cache_lock:
+        cached: Optional[Tuple[str, str]] = _image_cache.get(key)
+    if cached is not None:
+        return cached
+    image_bytes = _read_image_bytes(node)
+    if image_bytes is None:
+        return None
+    cached = _encode_image(image_bytes, max_size)
+    # Images larger than the whole cache are not cached
+    if len(cached[0]) <= _image_cache.maxsize:
+        with _image_cache_lock:
+            _image_cache[key] = cached
+    return cached
+
+
+def _read_image_bytes(node: ImageNode) -> Optional[bytes]:
+    if node.image:
+        return base64.b64decode(node.image)
+    if node.image_path and os.path.exists(node.image_path):
+        with open(node.image_path, "rb") as f:
+            return f.read()
+    return None
+
+
+def _encode_image(image_bytes: bytes, max_size: int) -> Tuple[str, str]:
+    """
+    Downscale an image to fit `max_size` and encode it as JPEG (or PNG if it has transparency).
+    Returns the base64 image and its mimetype.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "P"):
+            image.save(output, format="PNG", optimize=True)
+            mimetype = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=JPEG_QUALITY)
+            mimetype = "image/jpeg"
+    return base64.b64encode(output.getvalue()).decode("utf-8"), mimetype
@@ -1,14 +1,17 @@
 import logging
-from typing import Optional
+import os
+from typing import Any, Optional
 
 from llama_index.core.callbacks import CallbackManager
 from llama_index.core.indices import VectorStoreIndex
 from pydantic import BaseModel, Field
 
-from app.engine.vectordb import get_vector_store
+from app.engine.vectordb import get_private_collection_name, get_vector_store
 
 logger = logging.getLogger("uvicorn")
 
+DEFAULT_OWNER = "anonymous"
+
 
 class IndexConfig(BaseModel):
     callback_manager: Optional[CallbackManager] = Field(
@@ -29,3 +32,34 @@ def get_index(config: IndexConfig = None):
     )
     logger.info("Finished load index from vector store.")
     return index
+
+
+def is_private_collections_enabled() -> bool:
+    return os.getenv("PRIVATE_COLLECTIONS", "false").lower() == "true"
+
+
+def get_private_owner(params: Any = None) -> str:
+    """
+    Get the owner (user or session) of private uploads from the request params.
+    """
+    if isinstance(params, dict):
+        owner = params.get("user_id") or params.get("session_id")
+        if owner:
+            return str(owner)
+    return DEFAULT_OWNER
+
+
+def get_private_index(params: Any = None, config: IndexConfig = None):
+    """
+    Get the index with the private uploads of the owner of the request.
+    Returns None if private uploads are stored in the shared collection (PRIVATE_COLLECTIONS is not enabled).
+    """
+    if not is_private_collections_enabled():
+        return None
+    if config is None:
+        config = IndexConfig()
+    # The collection is derived from the owner only, never from a collection name in the params
+    store = get_vector_store(get_private_collection_name(get_private_owner(params)))
+    return VectorStoreIndex.from_vector_store(
+        store, callback_manager=config.callback_manager
+    )
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, Document, MetadataMode, TransformComponent
+from llama_index.core.settings import Settings
+
+from app.engine.images import warm_image_cache
+
+logger = logging.getLogger("uvicorn")
+
+
+class BatchEmbedding(TransformComponent):
+    """
+    Embed nodes in batches of `batch_size`, running up to `concurrency` batches at the same time.
+    Nodes that already have an embedding are skipped.
+    """
+
+    embed_model: BaseEmbedding
+    batch_size: int = 64
+    concurrency: int = 4
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> Sequence[BaseNode]:
+        # The sync client of the embedding model is used from worker threads: the cached async
+        # client would be bound to the first event loop and fail in later uploads
+        batches = list(self._batches(nodes))
+        if len(batches) == 0:
+            return nodes
+        with ThreadPoolExecutor(
+            max_workers=min(self.concurrency, len(batches)),
+            thread_name_prefix="embedding",
+        ) as executor:
+            results = executor.map(
+                lambda batch: self.embed_model.get_text_embedding_batch(
+                    self._texts(batch)
+                ),
+                batches,
+            )
+            for batch, embeddings in zip(batches, results):
+                self._set_embeddings(batch, embeddings)
+        return nodes
+
+    async def acall(
+        self, nodes: Sequence[BaseNode], **kwargs: Any
+    ) -> Sequence[BaseNode]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def embed(batch: List[BaseNode]):
+            async with semaphore:
+                embeddings = await self.embed_model.aget_text_embedding_batch(
+                    self._texts(batch)
+                )
+            self._set_embeddings(batch, embeddings)
+
+        await asyncio.gather(*[embed(batch) for batch in self._batches(nodes)])
+        return nodes
+
+    def _batches(self, nodes: Sequence[BaseNode]) -> Iterator[List[BaseNode]]:
+        pending = [node for node in nodes if node.embedding is None]
+        for i in range(0, len(pending), self.batch_size):
+            yield pending[i : i + self.batch_size]
+
+    @staticmethod
+    def _texts(batch: List[BaseNode]) -> List[str]:
+        return [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+
+    @staticmethod
+    def _set_embeddings(batch: List[BaseNode], embeddings: List[List[float]]):
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+
+
+class StageTimer:
+    """
+    Collect the time spent (in seconds) in each stage of the ingestion.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = round(self.timings.get(name, 0.0) + elapsed, 4)
+
+
+def get_node_parser() -> SentenceSplitter:
+    return SentenceSplitter(
+        chunk_size=Settings.chunk_size,
+        chunk_overlap=Settings.chunk_overlap,
+    )
+
+
+def get_embedding_transformation() -> BatchEmbedding:
+    embed_model = Settings.embed_model
+    return BatchEmbedding(
+        embed_model=embed_model,
+        batch_size=int(
+            os.getenv("EMBEDDING_BATCH_SIZE", str(embed_model.embed_batch_size))
+        ),
+        concurrency=int(os.getenv("EMBEDDING_CONCURRENCY", "4")),
+    )
+
+
+def get_transformations() -> List[TransformComponent]:
+    """
+    The transformations used for all ingestion: the generate script and private uploads.
+    """
+    return [get_node_parser(), get_embedding_transformation()]
+
+
+def run_ingestion(
+    documents: List[Document], timer: Optional[StageTimer] = None
+) -> List[BaseNode]:
+    """
+    Split and embed the documents, recording the time of each stage in the timer.
+    """
+    if timer is None:
+        timer = StageTimer()
+    with timer.stage("split"):
+        nodes = get_node_parser()(documents)
+    # Image nodes are prepared for the multi-modal LLM while the text nodes are embedded
+    warm_image_cache(nodes)
+    with timer.stage("embed"):
+        nodes = get_embedding_transformation()(nodes)
+    logger.info(f"Ingested {len(documents)} documents into {len(nodes)} nodes")
+    return list(nodes)
@@ -1,5 +1,8 @@
+import copy
 import logging
-from typing import Any, Dict, List
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 import yaml  # type: ignore
 from app.engine.loaders.db import DBLoaderConfig, get_db_documents
@@ -9,11 +12,25 @@ from llama_index.core import Document
 
 logger = logging.getLogger(__name__)
 
+LOADERS_CONFIG_PATH = "config/loaders.yaml"
+
+# The parsed config and the modification time of the file it was parsed from
+_configs_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+_configs_lock = threading.Lock()
+
 
 def load_configs() -> Dict[str, Any]:
-    with open("config/loaders.yaml") as f:
-        configs = yaml.safe_load(f)
-    return configs
+    """
+    Load the loaders config. The file is only parsed again when it changes on disk.
+    """
+    global _configs_cache
+    mtime = os.path.getmtime(LOADERS_CONFIG_PATH)
+    with _configs_lock:
+        if _configs_cache is None or _configs_cache[0] != mtime:
+            with open(LOADERS_CONFIG_PATH) as f:
+                _configs_cache = (mtime, yaml.safe_load(f))
+        configs = _configs_cache[1]
+    return copy.deepcopy(configs)
 
 
 def get_documents() -> List[Document]:
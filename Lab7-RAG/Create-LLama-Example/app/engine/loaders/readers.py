@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+from typing import Dict, Optional, Type
+
+from llama_index.core.readers.base import BaseReader
+from llama_index.core.readers.file.base import (
+    _try_loading_included_file_formats as get_file_loaders_map,
+)
+from llama_index.readers.file import FlatReader
+
+from app.engine.loaders import LOADERS_CONFIG_PATH, load_configs
+from app.engine.loaders.file import FileLoaderConfig
+
+logger = logging.getLogger(__name__)
+
+# File signatures used to detect the file type when the extension is missing or wrong
+FILE_SIGNATURES = {
+    b"%PDF": ".pdf",
+    b"\x89PNG": ".png",
+    b"\xff\xd8\xff": ".jpg",
+    b"GIF8": ".gif",
+}
+# Office documents are zip files, so the extension is needed to tell them apart
+ZIP_SIGNATURE = b"PK\x03\x04"
+ZIP_EXTENSIONS = {".docx", ".pptx", ".xlsx", ".epub", ".zip"}
+
+
+def sniff_extension(file_path: str) -> Optional[str]:
+    """
+    Detect the extension of a file from its first bytes.
+    """
+    with open(file_path, "rb") as f:
+        header = f.read(8)
+    for signature, extension in FILE_SIGNATURES.items():
+        if header.startswith(signature):
+            return extension
+    if header.startswith(ZIP_SIGNATURE):
+        extension = os.path.splitext(file_path)[1].lower()
+        return extension if extension in ZIP_EXTENSIONS else ".zip"
+    return None
+
+
+class ReaderRegistry:
+    """
+    Select the reader for a file by its extension and sniffed type.
+
+    The reader map is resolved once and reader instances are reused across files.
+    The registry is rebuilt when the loaders config changes on disk.
+    """
+
+    def __init__(self, config_path: str = LOADERS_CONFIG_PATH):
+        self.config_path = config_path
+        self._lock = threading.Lock()
+        self._config_mtime: Optional[float] = None
+        self._llama_parse_reader: Optional[BaseReader] = None
+        self._reader_classes: Dict[str, Type[BaseReader]] = {}
+        self._readers: Dict[str, BaseReader] = {}
+
+    def get_reader(self, file_path: str) -> BaseReader:
+        self._reload_if_changed()
+        # If LlamaParse is enabled, use it to parse all files
+        if self._llama_parse_reader is not None:
+            return self._llama_parse_reader
+
+        extension = self.get_extension(file_path)
+        with self._lock:
+            reader = self._readers.get(extension)
+            if reader is None:
+                reader_cls = self._reader_classes.get(extension)
+                if reader_cls is None:
+                    raise ValueError(
+                        f"File extension {extension.lstrip('.')} is not supported"
+                    )
+                reader = reader_cls()
+                self._readers[extension] = reader
+        return reader
+
+    def get_extension(self, file_path: str) -> str:
+        """
+        Get the extension used to select the reader.
+        The sniffed type wins over the file extension, if it is supported.
+        """
+        extension = os.path.splitext(file_path)[1].lower()
+        sniffed_extension = sniff_extension(file_path)
+        if sniffed_extension is not None and sniffed_extension in self._reader_classes:
+            if sniffed_extension != extension:
+                logger.info(
+                    f"Using {sniffed_extension} reader for {file_path} based on its content"
+                )
+            return sniffed_extension
+        return extension
+
+    def _reload_if_changed(self):
+        mtime = os.path.getmtime(self.config_path)
+        if mtime == self._config_mtime:
+            return
+        with self._lock:
+            if mtime == self._config_mtime:
+                return
+            logger.info(f"Loading file readers from {self.config_path}")
+            config = load_configs()
+            file_loader_config = FileLoaderConfig(**config.get("file", {}))
+            if file_loader_config.use_llama_parse:
+                from app.engine.loaders.file import llama_parse_parser
+
+                self._llama_parse_reader = llama_parse_parser()
+            else:
+                self._llama_parse_reader = None
+            self._reader_classes = _default_file_loaders_map()
+            self._readers = {}
+            self._config_mtime = mtime
+
+
+def _default_file_loaders_map() -> Dict[str, Type[BaseReader]]:
+    default_loaders = get_file_loaders_map()
+    default_loaders[".txt"] = FlatReader
+    default_loaders[".csv"] = FlatReader
+    return default_loaders
+
+
+_reader_registry: Optional[ReaderRegistry] = None
+_reader_registry_lock = threading.Lock()
+
+
+def get_reader_registry() -> ReaderRegistry:
+    global _reader_registry
+    with _reader_registry_lock:
+        if _reader_registry is None:
+            _reader_registry = ReaderRegistry()
+    return _reader_registry
+
+
+def init_reader_registry() -> None:
+    """
+    Resolve the file readers at startup, so the first upload doesn't pay for it.
+    """
+    get_reader_registry()._reload_if_changed()
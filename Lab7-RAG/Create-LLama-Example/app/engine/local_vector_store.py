@@ -0,0 +1,570 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+
+from app.engine.query_filter import matches_filters
+
+logger = logging.getLogger("uvicorn")
+
+VECTORS_FNAME = "vectors.bin"
+METADATA_FNAME = "metadata.db"
+IVF_FNAME = "ivf.npz"
+# Metadata keys with the serialized node, they are not used for filtering
+NODE_CONTENT_KEYS = {"_node_content", "_node_type"}
+INITIAL_CAPACITY = 1024
+
+
+class _IVFIndex:
+    """
+    An inverted file index: the vectors are clustered with k-means and a query only scores
+    the vectors in the clusters of its `probes` nearest centroids.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_count: int):
+        self.centroids = centroids
+        # The cluster of every row, -1 if the row is not assigned yet
+        self.assignments = assignments
+        self.trained_count = trained_count
+
+    @classmethod
+    def train(
+        cls, vectors: np.ndarray, count: int, iterations: int = 10, seed: int = 0
+    ) -> "_IVFIndex":
+        nlist = min(4096, max(16, int(math.sqrt(count))), count)
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, size=min(count, nlist * 64), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(nlist):
+                members = sample[labels == cluster]
+                if len(members) > 0:
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        index = cls(centroids, np.full(len(vectors), -1, dtype=np.int32), count)
+        index.assign(vectors, 0, count)
+        return index
+
+    def assign(self, vectors: np.ndarray, start: int, end: int, batch_size: int = 65536):
+        if len(self.assignments) < len(vectors):
+            assignments = np.full(len(vectors), -1, dtype=np.int32)
+            assignments[: len(self.assignments)] = self.assignments
+            self.assignments = assignments
+        for batch_start in range(start, end, batch_size):
+            batch_end = min(end, batch_start + batch_size)
+            batch = np.asarray(vectors[batch_start:batch_end], dtype=np.float32)
+            self.assignments[batch_start:batch_end] = np.argmax(
+                batch @ self.centroids.T, axis=1
+            )
+
+    def candidates(self, query: np.ndarray, count: int, probes: int) -> np.ndarray:
+        probes = min(probes, len(self.centroids))
+        nearest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+        return np.nonzero(np.isin(self.assignments[:count], nearest))[0]
+
+    def save(self, path: str, count: int):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            centroids=self.centroids,
+            assignments=self.assignments[:count],
+            trained_count=np.asarray(self.trained_count),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "_IVFIndex":
+        data = np.load(path)
+        return cls(
+            data["centroids"], data["assignments"].copy(), int(data["trained_count"])
+        )
+
+
+class LocalVectorStore(BasePydanticVectorStore):
+    """
+    An in-process vector store persisted in a directory.
+
+    The normalized embeddings are stored in a memory-mapped float32 (or float16) matrix and the
+    nodes in a SQLite metadata table next to it, so opening the store only maps the file and
+    reads the node ids of the rows. The filterable metadata of the rows is loaded the first time
+    a filtered query needs it. Queries are scored with exact batched NumPy top-k search;
+    once the store has `ivf_threshold` vectors, an IVF index is trained in the background
+    and queries only score the vectors in the nearest clusters.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+
+    persist_dir: str
+    dtype: str = "float32"
+    ivf_threshold: int = 50000
+    ivf_probes: int = 8
+    search_batch_size: int = 65536
+
+    _lock: threading.RLock = PrivateAttr()
+    _db: sqlite3.Connection = PrivateAttr()
+    _vectors: Optional[np.memmap] = PrivateAttr(default=None)
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _count: int = PrivateAttr(default=0)
+    _capacity: int = PrivateAttr(default=0)
+    _node_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    # The filter metadata of every row, None until it's needed to evaluate a filter
+    _metadata: List[Optional[Dict[str, Any]]] = PrivateAttr(default_factory=list)
+    _deleted: np.ndarray = PrivateAttr()
+    _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _ivf: Optional[_IVFIndex] = PrivateAttr(default=None)
+    _ivf_thread: Optional[threading.Thread] = PrivateAttr(default=None)
+    _filter_masks: "OrderedDict[str, Tuple[np.ndarray, int]]" = PrivateAttr(
+        default_factory=OrderedDict
+    )
+
+    def __init__(self, persist_dir: str, dtype: str = "float32", **kwargs: Any):
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported vector dtype {dtype}, use float32 or float16")
+        super().__init__(persist_dir=persist_dir, dtype=dtype, **kwargs)
+        os.makedirs(persist_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self._deleted = np.zeros(0, dtype=bool)
+        self._db = sqlite3.connect(
+            os.path.join(persist_dir, METADATA_FNAME), check_same_thread=False
+        )
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS nodes (row INTEGER PRIMARY KEY, node_id TEXT NOT NULL UNIQUE, ref_doc_id TEXT, filter_metadata TEXT NOT NULL, node TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+        self._load()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.persist_dir, VECTORS_FNAME)
+
+    @property
+    def ivf_path(self) -> str:
+        return os.path.join(self.persist_dir, IVF_FNAME)
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        if len(nodes) == 0:
+            return []
+        embeddings = _normalize(
+            np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        )
+        with self._lock:
+            if self._dim is None:
+                self._create_vectors(embeddings.shape[1])
+            elif embeddings.shape[1] != self._dim:
+                raise ValueError(
+                    f"Embedding dimension {embeddings.shape[1]} doesn't match the store dimension {self._dim}"
+                )
+            # Existing nodes are updated in place, new nodes are appended
+            rows: Dict[str, int] = {}
+            next_row = self._count
+            for node in nodes:
+                if node.node_id in rows:
+                    continue
+                row = self._rows.get(node.node_id)
+                if row is None:
+                    row, next_row = next_row, next_row + 1
+                else:
+                    # Cached filter masks may have the old metadata of the row
+                    self._filter_masks.clear()
+                rows[node.node_id] = row
+            self._ensure_capacity(next_row)
+            node_rows = [rows[node.node_id] for node in nodes]
+            self._vectors[node_rows] = embeddings.astype(self.dtype)
+            self._vectors.flush()
+
+            records = []
+            for node, row in zip(nodes, node_rows):
+                metadata = node_to_metadata_dict(
+                    node, remove_text=False, flat_metadata=self.flat_metadata
+                )
+                filter_metadata = {
+                    key: value
+                    for key, value in metadata.items()
+                    if key not in NODE_CONTENT_KEYS
+                }
+                records.append(
+                    (
+                        row,
+                        node.node_id,
+                        node.ref_doc_id,
+                        json.dumps(filter_metadata),
+                        json.dumps(metadata),
+                    )
+                )
+                self._set_row(row, node.node_id, node.ref_doc_id, filter_metadata)
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO nodes (row, node_id, ref_doc_id, filter_metadata, node, deleted) VALUES (?, ?, ?, ?, ?, 0)",
+                    records,
+                )
+            start, self._count = self._count, max(self._count, next_row)
+            if self._ivf is not None:
+                self._ivf.assign(self._vectors, start, self._count)
+        self._maybe_train_ivf()
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            rows = [
+                row
+                for row in range(self._count)
+                if self._ref_doc_ids[row] == ref_doc_id and not self._deleted[row]
+            ]
+            self._delete_rows(rows)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        with self._lock:
+            mask = self._candidate_mask(filters, self._count)
+            if node_ids is not None:
+                node_mask = np.zeros(self._count, dtype=bool)
+                node_mask[[self._rows[i] for i in node_ids if i in self._rows]] = True
+                mask &= node_mask
+            self._delete_rows(np.nonzero(mask)[0].tolist())
+
+    def clear(self) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM nodes")
+                self._db.execute("DELETE FROM store_info")
+            self._vectors = None
+            for path in [self.vectors_path, self.ivf_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._reset()
+
+    def get_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        with self._lock:
+            mask = self._candidate_mask(filters, self._count)
+            if node_ids is not None:
+                node_mask = np.zeros(self._count, dtype=bool)
+                node_mask[[self._rows[i] for i in node_ids if i in self._rows]] = True
+                mask &= node_mask
+            rows = np.nonzero(mask)[0].tolist()
+        return list(self._load_nodes(rows).values())
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.query_embedding is None:
+            raise ValueError("LocalVectorStore only supports queries with an embedding")
+        with self._lock:
+            count = self._count
+            if count == 0:
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            mask = self._candidate_mask(query.filters, count)
+            if query.doc_ids:
+                doc_ids = set(query.doc_ids)
+                mask &= np.fromiter(
+                    (ref in doc_ids for ref in self._ref_doc_ids[:count]), bool, count
+                )
+            if query.node_ids:
+                node_mask = np.zeros(count, dtype=bool)
+                node_mask[[self._rows[i] for i in query.node_ids if i in self._rows]] = True
+                mask &= node_mask
+            vectors, ivf = self._vectors, self._ivf
+
+        query_embedding = _normalize(
+            np.asarray(query.query_embedding, dtype=np.float32)[None, :]
+        )[0]
+        top_k = query.similarity_top_k
+        selected = int(np.count_nonzero(mask))
+        if selected <= self.search_batch_size:
+            # Selective filters (e.g. a few private documents) are scored exactly
+            top_rows, top_scores = self._score_rows(
+                vectors, np.nonzero(mask)[0], query_embedding, top_k
+            )
+        elif ivf is not None:
+            rows = ivf.candidates(query_embedding, count, self.ivf_probes)
+            rows = rows[mask[rows]]
+            top_rows, top_scores = self._score_rows(vectors, rows, query_embedding, top_k)
+        else:
+            top_rows, top_scores = self._exact_search(
+                vectors, count, mask, query_embedding, top_k
+            )
+
+        nodes_by_row = self._load_nodes(top_rows)
+        result_rows = [row for row in top_rows if row in nodes_by_row]
+        similarities = [
+            float(score)
+            for row, score in zip(top_rows, top_scores)
+            if row in nodes_by_row
+        ]
+        nodes = [nodes_by_row[row] for row in result_rows]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=similarities,
+            ids=[node.node_id for node in nodes],
+        )
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        # Nodes are written on insert, only flush the vectors and the IVF assignments
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+            if self._ivf is not None:
+                self._ivf.save(self.ivf_path, self._count)
+
+    def _exact_search(
+        self,
+        vectors: np.ndarray,
+        count: int,
+        mask: np.ndarray,
+        query_embedding: np.ndarray,
+        top_k: int,
+    ) -> Tuple[List[int], List[float]]:
+        # Score the matrix in batches to bound the memory of the float32 copies
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for start in range(0, count, self.search_batch_size):
+            end = min(count, start + self.search_batch_size)
+            rows = start + np.nonzero(mask[start:end])[0]
+            if len(rows) == 0:
+                continue
+            scores = np.asarray(vectors[start:end], dtype=np.float32) @ query_embedding
+            scores = scores[rows - start]
+            best_rows = np.concatenate([best_rows, rows])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_rows) > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1)[:top_k]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return best_rows[order].tolist(), best_scores[order].tolist()
+
+    @staticmethod
+    def _score_rows(
+        vectors: np.ndarray, rows: np.ndarray, query_embedding: np.ndarray, top_k: int
+    ) -> Tuple[List[int], List[float]]:
+        if len(rows) == 0:
+            return [], []
+        scores = np.asarray(vectors[rows], dtype=np.float32) @ query_embedding
+        if len(rows) > top_k:
+            keep = np.argpartition(-scores, top_k - 1)[:top_k]
+            rows, scores = rows[keep], scores[keep]
+        order = np.argsort(-scores)
+        return rows[order].tolist(), scores[order].tolist()
+
+    def _candidate_mask(self, filters: Optional[MetadataFilters], count: int) -> np.ndarray:
+        mask = ~self._deleted[:count]
+        if filters is None or len(filters.filters) == 0:
+            return mask
+        # Filter masks are cached and only evaluated for the rows added since
+        key = filters.model_dump_json()
+        cached = self._filter_masks.get(key)
+        filter_mask = np.zeros(count, dtype=bool)
+        start = 0
+        if cached is not None:
+            start = min(cached[1], count)
+            filter_mask[:start] = cached[0][:start]
+        self._load_filter_metadata(start, count)
+        for row in range(start, count):
+            filter_mask[row] = matches_filters(self._metadata[row] or {}, filters)
+        self._filter_masks[key] = (filter_mask, count)
+        self._filter_masks.move_to_end(key)
+        while len(self._filter_masks) > 32:
+            self._filter_masks.popitem(last=False)
+        return mask & filter_mask
+
+    def _load_filter_metadata(self, start: int, end: int) -> None:
+        rows = [row for row in range(start, end) if self._metadata[row] is None]
+        for batch_start in range(0, len(rows), 500):
+            batch = rows[batch_start : batch_start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for row, filter_metadata in self._db.execute(
+                f"SELECT row, filter_metadata FROM nodes WHERE row IN ({placeholders})",
+                batch,
+            ):
+                self._metadata[row] = json.loads(filter_metadata)
+
+    def _load_nodes(self, rows: List[int]) -> Dict[int, BaseNode]:
+        nodes: Dict[int, BaseNode] = {}
+        for start in range(0, len(rows), 500):
+            batch = rows[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                records = self._db.execute(
+                    f"SELECT row, node FROM nodes WHERE deleted = 0 AND row IN ({placeholders})",
+                    batch,
+                ).fetchall()
+            for row, data in records:
+                nodes[row] = metadata_dict_to_node(json.loads(data))
+        return nodes
+
+    def _delete_rows(self, rows: List[int]) -> None:
+        if len(rows) == 0:
+            return
+        with self._db:
+            self._db.executemany(
+                "UPDATE nodes SET deleted = 1 WHERE row = ?", [(row,) for row in rows]
+            )
+        for row in rows:
+            self._deleted[row] = True
+            self._rows.pop(self._node_ids[row], None)
+
+    def _set_row(
+        self,
+        row: int,
+        node_id: str,
+        ref_doc_id: Optional[str],
+        filter_metadata: Optional[Dict[str, Any]],
+    ) -> None:
+        while len(self._node_ids) <= row:
+            self._node_ids.append(None)
+            self._ref_doc_ids.append(None)
+            self._metadata.append(None)
+        self._node_ids[row] = node_id
+        self._ref_doc_ids[row] = ref_doc_id
+        self._metadata[row] = filter_metadata
+        self._deleted[row] = False
+        self._rows[node_id] = row
+
+    def _reset(self) -> None:
+        self._dim = None
+        self._count = 0
+        self._capacity = 0
+        self._node_ids, self._ref_doc_ids, self._metadata = [], [], []
+        self._deleted = np.zeros(0, dtype=bool)
+        self._rows = {}
+        self._ivf = None
+        self._filter_masks.clear()
+
+    def _load(self) -> None:
+        self._reset()
+        info = dict(self._db.execute("SELECT key, value FROM store_info").fetchall())
+        if "dim" not in info:
+            return
+        if info["dtype"] != self.dtype:
+            raise ValueError(
+                f"The store at {self.persist_dir} has {info['dtype']} vectors, not {self.dtype}"
+            )
+        self._dim = int(info["dim"])
+        self._capacity = int(info["capacity"])
+        self._vectors = np.memmap(
+            self.vectors_path,
+            dtype=self.dtype,
+            mode="r+",
+            shape=(self._capacity, self._dim),
+        )
+        self._deleted = np.zeros(self._capacity, dtype=bool)
+        # The filter metadata is only parsed when a filter needs it
+        for row, node_id, ref_doc_id, deleted in self._db.execute(
+            "SELECT row, node_id, ref_doc_id, deleted FROM nodes ORDER BY row"
+        ):
+            self._set_row(row, node_id, ref_doc_id, None)
+            if deleted:
+                self._deleted[row] = True
+                self._rows.pop(node_id, None)
+        self._count = len(self._node_ids)
+        if os.path.exists(self.ivf_path):
+            self._ivf = _IVFIndex.load(self.ivf_path)
+            # Assign the rows added after the IVF assignments were saved
+            self._ivf.assign(
+                self._vectors, min(len(self._ivf.assignments), self._count), self._count
+            )
+        logger.info(f"Opened local vector store {self.persist_dir} with {self._count} vectors")
+
+    def _create_vectors(self, dim: int) -> None:
+        self._dim = dim
+        self._capacity = 0
+        self._ensure_capacity(INITIAL_CAPACITY)
+
+    def _ensure_capacity(self, size: int) -> None:
+        if size <= self._capacity:
+            return
+        capacity = max(self._capacity, INITIAL_CAPACITY)
+        while capacity < size:
+            capacity *= 2
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        # Grow the file, the new rows are zero-filled
+        itemsize = np.dtype(self.dtype).itemsize
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * self._dim * itemsize)
+        self._vectors = np.memmap(
+            self.vectors_path, dtype=self.dtype, mode="r+", shape=(capacity, self._dim)
+        )
+        deleted = np.zeros(capacity, dtype=bool)
+        deleted[: len(self._deleted)] = self._deleted
+        self._deleted = deleted
+        self._capacity = capacity
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO store_info (key, value) VALUES (?, ?)",
+                [
+                    ("dim", str(self._dim)),
+                    ("dtype", self.dtype),
+                    ("capacity", str(capacity)),
+                ],
+            )
+
+    def _maybe_train_ivf(self) -> None:
+        with self._lock:
+            if self._count < self.ivf_threshold:
+                return
+            # Retrain when the store doubled since the last training
+            if self._ivf is not None and self._count < 2 * self._ivf.trained_count:
+                return
+            if self._ivf_thread is not None and self._ivf_thread.is_alive():
+                return
+            self._ivf_thread = threading.Thread(
+                target=self._train_ivf, name="local-vector-store-ivf", daemon=True
+            )
+            self._ivf_thread.start()
+
+    def _train_ivf(self) -> None:
+        with self._lock:
+            vectors, count = self._vectors, self._count
+        logger.info(f"Training IVF index for {count} vectors in {self.persist_dir}")
+        ivf = _IVFIndex.train(vectors, count)
+        with self._lock:
+            # Assign the rows added during the training
+            ivf.assign(self._vectors, count, self._count)
+            self._ivf = ivf
+            ivf.save(self.ivf_path, self._count)
+        logger.info(f"Trained IVF index with {len(ivf.centroids)} clusters")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
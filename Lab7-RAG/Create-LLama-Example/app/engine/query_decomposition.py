@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from llama_index.core import get_response_synthesizer
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.llms import LLM
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.response_synthesizers import BaseSynthesizer, ResponseMode
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.settings import Settings
+
+logger = logging.getLogger("uvicorn")
+
+DEFAULT_DECOMPOSE_PROMPT = PromptTemplate(
+    "Split the question below into at most {max_sub_questions} self-contained search queries, "
+    "one for each entity, time period or aspect it asks about, e.g. one per item of a comparison.\n"
+    "If the question asks about a single thing, return it unchanged.\n"
+    "Return one query per line, without numbering or any other text.\n"
+    "Question: {query_str}\n"
+    "Queries:\n"
+)
+# Numbering or bullets the LLM may add despite the instructions
+LIST_MARKER_PATTERN = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+
+def is_query_decomposition_enabled() -> bool:
+    return os.getenv("QUERY_DECOMPOSITION", "false").lower() == "true"
+
+
+class DecomposingQueryEngine(BaseQueryEngine):
+    """
+    Answer compound questions in a single query: the question is split into sub-queries,
+    all of them are retrieved concurrently, and the best `similarity_top_k` of the merged
+    and deduplicated nodes are synthesized into one response.
+
+    This saves the agent a tool call (and an LLM reasoning step) for every part of
+    comparison-style questions.
+    """
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        response_synthesizer: BaseSynthesizer,
+        llm: LLM,
+        node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+        max_sub_questions: int = 4,
+        similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+        decompose_prompt: PromptTemplate = DEFAULT_DECOMPOSE_PROMPT,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        super().__init__(callback_manager=callback_manager)
+        self._retriever = retriever
+        self._response_synthesizer = response_synthesizer
+        self._llm = llm
+        self._node_postprocessors = node_postprocessors or []
+        self._max_sub_questions = max_sub_questions
+        self._similarity_top_k = similarity_top_k
+        self._decompose_prompt = decompose_prompt
+
+    @classmethod
+    def from_args(
+        cls,
+        retriever: BaseRetriever,
+        llm: Optional[LLM] = None,
+        response_synthesizer: Optional[BaseSynthesizer] = None,
+        node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+        similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+        **kwargs: Any,
+    ) -> "DecomposingQueryEngine":
+        llm = llm or Settings.llm
+        callback_manager = retriever.callback_manager
+        response_synthesizer = response_synthesizer or get_response_synthesizer(
+            llm=llm,
+            response_mode=ResponseMode.COMPACT,
+            callback_manager=callback_manager,
+            **kwargs,
+        )
+        return cls(
+            retriever=retriever,
+            response_synthesizer=response_synthesizer,
+            llm=llm,
+            node_postprocessors=node_postprocessors,
+            max_sub_questions=int(os.getenv("QUERY_DECOMPOSITION_MAX_QUERIES", "4")),
+            similarity_top_k=similarity_top_k,
+            callback_manager=callback_manager,
+        )
+
+    def _get_prompt_modules(self) -> Dict[str, Any]:
+        return {"response_synthesizer": self._response_synthesizer}
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        sub_queries = self._parse_sub_queries(
+            query_bundle,
+            self._llm.predict(
+                self._decompose_prompt,
+                max_sub_questions=self._max_sub_questions,
+                query_str=query_bundle.query_str,
+            ),
+        )
+        with ThreadPoolExecutor(max_workers=len(sub_queries)) as executor:
+            results = list(executor.map(self._retriever.retrieve, sub_queries))
+        nodes = self._postprocess(self._merge(results), query_bundle)
+        response = self._response_synthesizer.synthesize(query_bundle, nodes)
+        response.metadata = {**(response.metadata or {}), "sub_queries": sub_queries}
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        sub_queries = self._parse_sub_queries(
+            query_bundle,
+            await self._llm.apredict(
+                self._decompose_prompt,
+                max_sub_questions=self._max_sub_questions,
+                query_str=query_bundle.query_str,
+            ),
+        )
+        results = await asyncio.gather(
+            *[self._retriever.aretrieve(sub_query) for sub_query in sub_queries]
+        )
+        nodes = self._postprocess(self._merge(list(results)), query_bundle)
+        response = await self._response_synthesizer.asynthesize(query_bundle, nodes)
+        response.metadata = {**(response.metadata or {}), "sub_queries": sub_queries}
+        return response
+
+    def _parse_sub_queries(self, query_bundle: QueryBundle, output: str) -> List[str]:
+        # The original question is always searched too
+        sub_queries = [query_bundle.query_str]
+        for line in output.splitlines():
+            sub_query = LIST_MARKER_PATTERN.sub("", line).strip()
+            if sub_query and sub_query not in sub_queries:
+                sub_queries.append(sub_query)
+        sub_queries = sub_queries[: self._max_sub_questions + 1]
+        logger.info(f"Decomposed query into {len(sub_queries) - 1} sub-queries")
+        return sub_queries
+
+    def _merge(self, results: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        merged: Dict[str, NodeWithScore] = {}
+        for nodes in results:
+            for node in nodes:
+                existing = merged.get(node.node.node_id)
+                if existing is None or (node.score or 0.0) > (existing.score or 0.0):
+                    merged[node.node.node_id] = node
+        # Every sub-query retrieves the top-k nodes, keep as many as a single query would
+        ranked = sorted(merged.values(), key=lambda node: node.score or 0.0, reverse=True)
+        return ranked[: self._similarity_top_k]
+
+    def _postprocess(
+        self, nodes: List[NodeWithScore], query_bundle: QueryBundle
+    ) -> List[NodeWithScore]:
+        for node_postprocessor in self._node_postprocessors:
+            nodes = node_postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        return nodes
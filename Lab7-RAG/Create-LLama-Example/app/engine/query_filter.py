@@ -1,4 +1,16 @@
-from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+
+# The where clause of the public documents
+PUBLIC_DOC_WHERE: Dict[str, Any] = {"private": {"$ne": "true"}}
 
 
 def generate_filters(doc_ids):
@@ -32,3 +44,107 @@ def generate_filters(doc_ids):
         )
 
     return filters
+
+
+def get_filter_doc_ids(filters: MetadataFilters) -> Optional[List[str]]:
+    """
+    Get the selected document ids from filters created by `generate_filters`.
+    Returns None if the filters have a different shape.
+    """
+    doc_ids: List[str] = []
+    for metadata_filter in filters.filters:
+        if not isinstance(metadata_filter, MetadataFilter):
+            return None
+        if metadata_filter.key == "private" and metadata_filter.operator == "!=":
+            continue
+        if (
+            metadata_filter.key == "doc_id"
+            and metadata_filter.operator == "in"
+            and isinstance(metadata_filter.value, list)
+        ):
+            doc_ids = [str(doc_id) for doc_id in metadata_filter.value]
+        else:
+            return None
+    return doc_ids
+
+
+def compile_chroma_filters(doc_ids: Sequence[str]) -> Tuple[Dict[str, Any], ...]:
+    """
+    Compile the public/private document filter into native Chroma where clauses.
+
+    Returns a single clause, unless there are more selected documents than
+    FILTER_MAX_INLINE_IDS: then the public documents and each chunk of the selected
+    documents get their own clause, so they can be queried separately and merged.
+    The clauses are cached per document id set and must not be modified.
+    """
+    max_inline_ids = int(os.getenv("FILTER_MAX_INLINE_IDS", "64"))
+    return _compile_chroma_filters(tuple(sorted(set(doc_ids))), max_inline_ids)
+
+
+@lru_cache(maxsize=1024)
+def _compile_chroma_filters(
+    doc_ids: Tuple[str, ...], max_inline_ids: int
+) -> Tuple[Dict[str, Any], ...]:
+    if len(doc_ids) == 0:
+        return (PUBLIC_DOC_WHERE,)
+    if len(doc_ids) <= max_inline_ids:
+        return ({"$or": [PUBLIC_DOC_WHERE, _doc_ids_where(doc_ids)]},)
+    return (PUBLIC_DOC_WHERE,) + tuple(
+        _doc_ids_where(doc_ids[i : i + max_inline_ids])
+        for i in range(0, len(doc_ids), max_inline_ids)
+    )
+
+
+def _doc_ids_where(doc_ids: Sequence[str]) -> Dict[str, Any]:
+    if len(doc_ids) == 1:
+        return {"doc_id": {"$eq": doc_ids[0]}}
+    return {"doc_id": {"$in": list(doc_ids)}}
+
+
+def matches_filters(metadata: Dict[str, Any], filters: MetadataFilters) -> bool:
+    """
+    Evaluate metadata filters on the metadata of a node, for stores without native filtering.
+    """
+    results = (
+        matches_filters(metadata, metadata_filter)
+        if isinstance(metadata_filter, MetadataFilters)
+        else _matches_filter(metadata, metadata_filter)
+        for metadata_filter in filters.filters
+    )
+    if filters.condition == FilterCondition.OR:
+        return any(results)
+    return all(results)
+
+
+def _matches_filter(metadata: Dict[str, Any], metadata_filter: MetadataFilter) -> bool:
+    operator = metadata_filter.operator
+    if operator == FilterOperator.IS_EMPTY:
+        return metadata.get(metadata_filter.key) in (None, "", [])
+    if metadata_filter.key not in metadata:
+        # Like a missing value in SQL: only inequality filters match
+        return operator in (FilterOperator.NE, FilterOperator.NIN)
+    value = metadata[metadata_filter.key]
+    expected = metadata_filter.value
+    # A single value is treated as a list of one value by the list operators
+    expected_values = expected if isinstance(expected, list) else [expected]
+    if operator == FilterOperator.EQ:
+        return value == expected
+    if operator == FilterOperator.NE:
+        return value != expected
+    if operator == FilterOperator.IN:
+        return value in expected_values
+    if operator == FilterOperator.NIN:
+        return value not in expected_values
+    if operator == FilterOperator.GT:
+        return value > expected
+    if operator == FilterOperator.GTE:
+        return value >= expected
+    if operator == FilterOperator.LT:
+        return value < expected
+    if operator == FilterOperator.LTE:
+        return value <= expected
+    if operator == FilterOperator.CONTAINS:
+        return isinstance(value, list) and expected in value
+    if operator == FilterOperator.TEXT_MATCH:
+        return isinstance(value, str) and str(expected) in value
+    raise ValueError(f"Filter operator {operator} is not supported")
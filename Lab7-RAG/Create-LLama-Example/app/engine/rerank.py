@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import Counter
+from typing import List, Optional, Protocol, Tuple
+
+from cachetools import LRUCache
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import ImageNode, MetadataMode, NodeWithScore, QueryBundle
+
+from app.engine.bm25 import tokenize
+from app.engine.context import cut_to_token_budget
+
+logger = logging.getLogger("uvicorn")
+
+DEFAULT_CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class Scorer(Protocol):
+    def score(self, query: str, texts: List[str]) -> List[float]: ...
+
+
+class LexicalScorer:
+    """
+    Score texts by how many of the query terms they contain, with saturated term frequencies.
+    The score of a text doesn't depend on the other candidates, so it can be cached.
+    Needs no model and runs in microseconds per candidate.
+    """
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        query_terms = set(tokenize(query))
+        if len(query_terms) == 0:
+            return [0.0] * len(texts)
+        scores = []
+        for text in texts:
+            terms = Counter(tokenize(text))
+            matched = sum(
+                1 + math.log(terms[term]) for term in query_terms if terms[term] > 0
+            )
+            scores.append(matched / len(query_terms))
+        return scores
+
+
+class CrossEncoderScorer:
+    """
+    Score (query, text) pairs with a small local cross-encoder model on CPU.
+    Requires the `sentence-transformers` package.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_CROSS_ENCODER_MODEL, batch_size: int = 32):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "sentence-transformers is required for RERANKER=cross-encoder. "
+                "Install it with `poetry add sentence-transformers` or use RERANKER=lexical"
+            ) from e
+        self._model = CrossEncoder(model_name, device="cpu")
+        self._batch_size = batch_size
+        # The model is not safe to call from several threads at the same time
+        self._lock = threading.Lock()
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        with self._lock:
+            scores = self._model.predict(
+                [(query, text) for text in texts], batch_size=self._batch_size
+            )
+        return [float(score) for score in scores]
+
+
+class Reranker(BaseNodePostprocessor):
+    """
+    Rerank the retrieved nodes with a scorer and keep the best `top_n` nodes.
+
+    The candidates are scored in batches, and scores are cached per (query, node), so
+    the same candidates of repeated or follow-up queries aren't scored again.
+    If `token_budget` is set, the reranked nodes are cut to fit it.
+    Image nodes have no text to score, they are kept with their retrieval score.
+    """
+
+    top_n: int
+    batch_size: int = 32
+    token_budget: int = 0
+
+    _scorer: Scorer = PrivateAttr()
+    _cache: LRUCache = PrivateAttr()
+
+    def __init__(self, scorer: Scorer, cache: Optional[LRUCache] = None, **kwargs):
+        super().__init__(**kwargs)
+        self._scorer = scorer
+        self._cache = cache if cache is not None else LRUCache(maxsize=4096)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "Reranker"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None or len(nodes) == 0:
+            return nodes
+        image_nodes = [node for node in nodes if isinstance(node.node, ImageNode)]
+        nodes = [node for node in nodes if not isinstance(node.node, ImageNode)]
+        if len(nodes) == 0:
+            return image_nodes
+        query = query_bundle.query_str
+        texts = [node.node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        keys = [self._cache_key(query, node, text) for node, text in zip(nodes, texts)]
+
+        with _score_cache_lock:
+            scores = [self._cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start : start + self.batch_size]
+            batch_scores = self._scorer.score(query, [texts[i] for i in batch])
+            with _score_cache_lock:
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = score
+                    self._cache[keys[i]] = score
+        logger.debug(f"Reranked {len(nodes)} nodes, {len(missing)} not cached")
+
+        ranked = sorted(
+            (NodeWithScore(node=node.node, score=score) for node, score in zip(nodes, scores)),
+            key=lambda node: node.score,
+            reverse=True,
+        )[: self.top_n]
+        if self.token_budget > 0:
+            ranked = cut_to_token_budget(ranked, self.token_budget)
+        return ranked + image_nodes
+
+    @staticmethod
+    def _cache_key(query: str, node: NodeWithScore, text: str) -> Tuple[str, str, str]:
+        # The content hash keeps cached scores valid if a node is updated with the same id
+        text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return (query, node.node.node_id, text_hash)
+
+
+_reranker_scorer: Optional[Scorer] = None
+_reranker_scorer_lock = threading.Lock()
+_score_cache: Optional[LRUCache] = None
+_score_cache_lock = threading.Lock()
+
+
+def get_reranker(top_n: int) -> Optional[Reranker]:
+    """
+    Get the reranker configured by RERANKER (lexical or cross-encoder), or None if reranking is disabled.
+    """
+    global _reranker_scorer, _score_cache
+    reranker = os.getenv("RERANKER", "none")
+    if reranker == "none":
+        return None
+    batch_size = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+    with _reranker_scorer_lock:
+        # Load the model once and share it (and its score cache) between requests
+        if _reranker_scorer is None:
+            match reranker:
+                case "lexical":
+                    _reranker_scorer = LexicalScorer()
+                case "cross-encoder":
+                    _reranker_scorer = CrossEncoderScorer(
+                        model_name=os.getenv("RERANK_MODEL", DEFAULT_CROSS_ENCODER_MODEL),
+                        batch_size=batch_size,
+                    )
+                case _:
+                    raise ValueError(f"Invalid reranker: {reranker}")
+            _score_cache = LRUCache(maxsize=int(os.getenv("RERANK_CACHE_SIZE", "4096")))
+    return Reranker(
+        scorer=_reranker_scorer,
+        cache=_score_cache,
+        top_n=top_n,
+        batch_size=batch_size,
+        token_budget=int(os.getenv("RERANK_TOKEN_BUDGET", "0")),
+    )
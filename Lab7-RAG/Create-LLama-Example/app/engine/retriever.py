@@ -0,0 +1,220 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Dict, List, Optional
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
+
+from app.engine.query_filter import compile_chroma_filters, get_filter_doc_ids
+
+
+class MergeMode(str, Enum):
+    # Keep the best score of every node, for retrievers with comparable scores
+    # (e.g. collections embedded with the same model)
+    MAX = "max"
+    # Reciprocal rank fusion, for retrievers with different kinds of scores (e.g. BM25 and dense)
+    RRF = "rrf"
+
+
+class MergingRetriever(BaseRetriever):
+    """
+    Run several retrievers concurrently and merge their results into the top-k nodes.
+    """
+
+    def __init__(
+        self,
+        retrievers: List[BaseRetriever],
+        similarity_top_k: int,
+        mode: MergeMode = MergeMode.MAX,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        super().__init__(callback_manager=callback_manager)
+        self._retrievers = retrievers
+        self._similarity_top_k = similarity_top_k
+        self._mode = mode
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with ThreadPoolExecutor(max_workers=len(self._retrievers)) as executor:
+            results = list(
+                executor.map(
+                    lambda retriever: retriever.retrieve(query_bundle),
+                    self._retrievers,
+                )
+            )
+        return self._merge(results)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # Vector stores like Chroma run their queries synchronously even when called async,
+        # so run each retriever in a thread to query them at the same time
+        results = await asyncio.gather(
+            *[
+                asyncio.to_thread(retriever.retrieve, query_bundle)
+                for retriever in self._retrievers
+            ]
+        )
+        return self._merge(list(results))
+
+    def _merge(self, results: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        if self._mode == MergeMode.RRF:
+            return self._fuse(results)
+        merged: Dict[str, NodeWithScore] = {}
+        for nodes in results:
+            for node in nodes:
+                existing = merged.get(node.node.node_id)
+                if existing is None or (node.score or 0.0) > (existing.score or 0.0):
+                    merged[node.node.node_id] = node
+        ranked = sorted(merged.values(), key=lambda node: node.score or 0.0, reverse=True)
+        return ranked[: self._similarity_top_k]
+
+    def _fuse(self, results: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        rrf_k = int(os.getenv("RRF_K", "60"))
+        scores: Dict[str, float] = {}
+        nodes: Dict[str, NodeWithScore] = {}
+        for ranked_nodes in results:
+            ranked_nodes = sorted(
+                ranked_nodes, key=lambda node: node.score or 0.0, reverse=True
+            )
+            for rank, node in enumerate(ranked_nodes):
+                node_id = node.node.node_id
+                scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+                nodes.setdefault(node_id, node)
+        ranked = sorted(scores, key=scores.__getitem__, reverse=True)
+        return [
+            NodeWithScore(node=nodes[node_id].node, score=scores[node_id])
+            for node_id in ranked[: self._similarity_top_k]
+        ]
+
+
+def create_retriever(
+    index,
+    filters: Optional[MetadataFilters] = None,
+    similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+    private_index=None,
+    callback_manager: Optional[CallbackManager] = None,
+) -> BaseRetriever:
+    """
+    Create a retriever for a vector store index with the public/private document filters.
+
+    If a private index (the collection with the user's uploads) is given, the selected documents
+    are retrieved from it concurrently with the shared index and the results are merged.
+
+    With RETRIEVAL_MODE=hybrid, every index is searched with BM25 and dense retrieval concurrently
+    and the results are fused with reciprocal rank fusion.
+    """
+    if callback_manager is None:
+        # The chat's event handlers are attached to the index
+        callback_manager = index._callback_manager
+
+    doc_ids = get_filter_doc_ids(filters) if filters is not None else None
+    if private_index is None or not doc_ids:
+        return _create_index_retriever(
+            index, filters, similarity_top_k, callback_manager
+        )
+
+    private_filters = MetadataFilters(
+        filters=[
+            MetadataFilter(key="doc_id", value=doc_ids, operator="in"),  # type: ignore
+        ]
+    )
+    retrievers = [
+        # Only the merging retriever reports retrieval events
+        _create_index_retriever(
+            index, filters, similarity_top_k, CallbackManager([])
+        ),
+        _create_index_retriever(
+            private_index, private_filters, similarity_top_k, CallbackManager([])
+        ),
+    ]
+    # Both collections are embedded with the same model (and fused the same way in hybrid mode),
+    # so their scores are compared as they are: a private hit only wins if it's a better match
+    return MergingRetriever(
+        retrievers,
+        similarity_top_k=similarity_top_k,
+        callback_manager=callback_manager,
+    )
+
+
+def _create_index_retriever(
+    index,
+    filters: Optional[MetadataFilters],
+    similarity_top_k: int,
+    callback_manager: CallbackManager,
+) -> BaseRetriever:
+    if os.getenv("RETRIEVAL_MODE", "dense") != "hybrid":
+        return _create_vector_retriever(
+            index, filters, similarity_top_k, callback_manager
+        )
+
+    from app.engine.bm25 import BM25Retriever, get_bm25_index
+
+    retrievers: List[BaseRetriever] = [
+        _create_vector_retriever(index, filters, similarity_top_k, CallbackManager([])),
+        # The BM25 index applies the same public/private document filters
+        BM25Retriever(
+            get_bm25_index(index.vector_store),
+            similarity_top_k=similarity_top_k,
+            filters=filters,
+            callback_manager=CallbackManager([]),
+        ),
+    ]
+    return MergingRetriever(
+        retrievers,
+        similarity_top_k=similarity_top_k,
+        mode=MergeMode.RRF,
+        callback_manager=callback_manager,
+    )
+
+
+def _create_vector_retriever(
+    index,
+    filters: Optional[MetadataFilters],
+    similarity_top_k: int,
+    callback_manager: CallbackManager,
+) -> BaseRetriever:
+    doc_ids = get_filter_doc_ids(filters) if filters is not None else None
+    if doc_ids is None or not is_chroma_index(index):
+        return VectorIndexRetriever(
+            index,
+            similarity_top_k=similarity_top_k,
+            filters=filters,
+            callback_manager=callback_manager,
+        )
+
+    # Query Chroma with precompiled native where clauses instead of generic metadata filters.
+    # Large document id lists are split into separate queries that run concurrently and are merged.
+    where_clauses = compile_chroma_filters(doc_ids)
+    if len(where_clauses) == 1:
+        return VectorIndexRetriever(
+            index,
+            similarity_top_k=similarity_top_k,
+            vector_store_kwargs={"where": where_clauses[0]},
+            callback_manager=callback_manager,
+        )
+    retrievers: List[BaseRetriever] = [
+        VectorIndexRetriever(
+            index,
+            similarity_top_k=similarity_top_k,
+            vector_store_kwargs={"where": where},
+            callback_manager=CallbackManager([]),
+        )
+        for where in where_clauses
+    ]
+    return MergingRetriever(
+        retrievers,
+        similarity_top_k=similarity_top_k,
+        callback_manager=callback_manager,
+    )
+
+
+def is_chroma_index(index) -> bool:
+    try:
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+    except ImportError:
+        return False
+    return isinstance(getattr(index, "vector_store", None), ChromaVectorStore)
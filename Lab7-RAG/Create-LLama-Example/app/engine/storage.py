@@ -0,0 +1,226 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage import StorageContext
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.docstore.types import DEFAULT_PERSIST_FNAME
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+logger = logging.getLogger("uvicorn")
+
+STORAGE_DIR = os.getenv("STORAGE_DIR", "storage")
+DOCSTORE_LOG_FNAME = "docstore.log"
+# The key of the log records of deleted documents
+DELETE_KEY = "__delete_ref_doc__"
+
+
+class DocstoreLog:
+    """
+    Append-only persistence for the document store.
+
+    Instead of rewriting the whole docstore after every insert or delete, new nodes and deleted
+    documents are buffered and appended to a log file next to the persisted docstore. The buffer is flushed to the log
+    when it holds `flush_count` nodes or when it is older than `flush_interval` seconds.
+    Once the log grows beyond `compact_size` bytes, it is merged into the docstore in a background thread.
+    """
+
+    def __init__(
+        self,
+        persist_dir: str = STORAGE_DIR,
+        flush_count: int = 100,
+        flush_interval: float = 5.0,
+        compact_size: int = 16 * 1024 * 1024,
+    ):
+        self.persist_dir = persist_dir
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.compact_size = compact_size
+        # The log records in order: serialized nodes, or {DELETE_KEY: ref_doc_id} for deleted documents
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._compaction: Optional[threading.Thread] = None
+
+    @property
+    def docstore_path(self) -> str:
+        return os.path.join(self.persist_dir, DEFAULT_PERSIST_FNAME)
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.persist_dir, DOCSTORE_LOG_FNAME)
+
+    @property
+    def compacting_log_path(self) -> str:
+        return f"{self.log_path}.compacting"
+
+    def append(self, nodes: Sequence[BaseNode]) -> None:
+        """
+        Add new nodes to the log. They are written when the flush policy triggers.
+        """
+        self._append_records([doc_to_json(node) for node in nodes])
+
+    def append_deletes(self, ref_doc_ids: Sequence[str]) -> None:
+        """
+        Add deleted documents to the log, so they are not brought back when the log is replayed.
+        """
+        self._append_records([{DELETE_KEY: ref_doc_id} for ref_doc_id in ref_doc_ids])
+
+    def _append_records(self, records: List[Dict[str, Any]]) -> None:
+        if len(records) == 0:
+            return
+        with self._lock:
+            self._buffer.extend(records)
+            should_flush = len(self._buffer) >= self.flush_count
+            if not should_flush and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records to the log and start a compaction if the log is too large.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            records, self._buffer = self._buffer, []
+            if len(records) > 0:
+                os.makedirs(self.persist_dir, exist_ok=True)
+                with open(self.log_path, "a") as f:
+                    for record in records:
+                        f.write(json.dumps(record) + "\n")
+                logger.info(f"Appended {len(records)} records to {self.log_path}")
+            log_size = (
+                os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+            )
+        if log_size >= self.compact_size:
+            self.compact_in_background()
+
+    def compact_in_background(self) -> None:
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._compaction = threading.Thread(
+                target=self.compact, name="docstore-compaction", daemon=True
+            )
+            self._compaction.start()
+
+    def compact(self) -> None:
+        """
+        Merge the log into the persisted docstore.
+        """
+        with self._lock:
+            if not os.path.exists(self.log_path):
+                return
+            # New nodes go to a fresh log while the current one is compacted
+            if not os.path.exists(self.compacting_log_path):
+                os.replace(self.log_path, self.compacting_log_path)
+        start = time.time()
+        docstore = self._load_snapshot()
+        self._replay(docstore, self.compacting_log_path)
+        tmp_path = f"{self.docstore_path}.tmp"
+        docstore.persist(persist_path=tmp_path)
+        os.replace(tmp_path, self.docstore_path)
+        os.remove(self.compacting_log_path)
+        logger.info(f"Compacted docstore log in {time.time() - start:.2f}s")
+
+    def load_docstore(self) -> SimpleDocumentStore:
+        """
+        Load the persisted docstore with all changes from the log applied.
+        """
+        self.flush()
+        docstore = self._load_snapshot()
+        for log_path in [self.compacting_log_path, self.log_path]:
+            self._replay(docstore, log_path)
+        return docstore
+
+    def clear(self) -> None:
+        """
+        Drop the log, e.g. after the full docstore was persisted.
+        """
+        with self._lock:
+            self._buffer = []
+            for log_path in [self.compacting_log_path, self.log_path]:
+                if os.path.exists(log_path):
+                    os.remove(log_path)
+
+    def _load_snapshot(self) -> SimpleDocumentStore:
+        if os.path.exists(self.docstore_path):
+            return SimpleDocumentStore.from_persist_path(self.docstore_path)
+        return SimpleDocumentStore()
+
+    @staticmethod
+    def _replay(docstore: SimpleDocumentStore, log_path: str) -> None:
+        if not os.path.exists(log_path):
+            return
+        # Consecutive nodes are added in one batch, deletes are applied in order
+        nodes: List[BaseNode] = []
+        with open(log_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if DELETE_KEY not in record:
+                    nodes.append(json_to_doc(record))
+                    continue
+                docstore.add_documents(nodes, allow_update=True)
+                nodes = []
+                docstore.delete_ref_doc(record[DELETE_KEY], raise_error=False)
+        docstore.add_documents(nodes, allow_update=True)
+
+
+_docstore_log: Optional[DocstoreLog] = None
+_docstore_log_lock = threading.Lock()
+
+
+def get_docstore_log() -> DocstoreLog:
+    global _docstore_log
+    with _docstore_log_lock:
+        if _docstore_log is None:
+            _docstore_log = DocstoreLog(
+                flush_count=int(os.getenv("PERSIST_FLUSH_COUNT", "100")),
+                flush_interval=float(os.getenv("PERSIST_FLUSH_INTERVAL", "5")),
+                compact_size=int(os.getenv("PERSIST_COMPACT_SIZE", str(16 * 1024 * 1024))),
+            )
+            # Don't lose the buffered nodes on shutdown
+            atexit.register(_docstore_log.flush)
+    return _docstore_log
+
+
+def persist_inserted_nodes(
+    storage_context: StorageContext, nodes: Sequence[BaseNode]
+) -> None:
+    """
+    Persist the storage after nodes were inserted into an index.
+
+    PERSIST_MODE=log (default) only appends the nodes that were added to the docstore
+    (none if the vector store stores the text), PERSIST_MODE=full persists the whole storage context.
+    """
+    if os.getenv("PERSIST_MODE", "log") == "full":
+        storage_context.persist(persist_dir=STORAGE_DIR)
+        return
+    docstore = storage_context.docstore
+    get_docstore_log().append(
+        [node for node in nodes if docstore.document_exists(node.node_id)]
+    )
+
+
+def persist_deleted_ref_docs(
+    storage_context: StorageContext, ref_doc_ids: Sequence[str]
+) -> None:
+    """
+    Persist the storage after documents were deleted from an index, the same way as `persist_inserted_nodes`.
+    """
+    if os.getenv("PERSIST_MODE", "log") == "full":
+        storage_context.persist(persist_dir=STORAGE_DIR)
+        return
+    get_docstore_log().append_deletes(ref_doc_ids)
@@ -1,10 +1,26 @@
 import importlib
 import os
-from typing import Dict, List, Union
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
 
 import yaml  # type: ignore
 from llama_index.core.tools.function_tool import FunctionTool
 from llama_index.core.tools.tool_spec.base import BaseToolSpec
+from llama_index.core.vector_stores.types import MetadataFilters
+
+
+@dataclass
+class ToolContext:
+    """
+    The request a tool is created for, passed to the `get_tools` of local tools as `context`.
+    """
+
+    # The request params, e.g. the user or session id
+    params: Optional[Dict[str, Any]] = None
+    # The public/private document filters of the chat
+    filters: Optional[MetadataFilters] = None
+    # The index with the private uploads of the user, if they have their own collection
+    private_index: Optional[Any] = None
 
 
 class ToolType:
@@ -19,7 +35,12 @@ class ToolFactory:
     }
 
     @staticmethod
-    def load_tools(tool_type: str, tool_name: str, config: dict) -> List[FunctionTool]:
+    def load_tools(
+        tool_type: str,
+        tool_name: str,
+        config: dict,
+        context: Optional[ToolContext] = None,
+    ) -> List[FunctionTool]:
         source_package = ToolFactory.TOOL_SOURCE_PACKAGE_MAP[tool_type]
         try:
             if "ToolSpec" in tool_name:
@@ -31,7 +52,7 @@ class ToolFactory:
                 return tool_spec.to_tool_list()
             else:
                 module = importlib.import_module(f"{source_package}.{tool_name}")
-                tools = module.get_tools(**config)
+                tools = module.get_tools(context=context, **config)
                 if not all(isinstance(tool, FunctionTool) for tool in tools):
                     raise ValueError(
                         f"The module {module} does not contain valid tools"
@@ -45,12 +66,14 @@ class ToolFactory:
     @staticmethod
     def from_env(
         map_result: bool = False,
+        context: Optional[ToolContext] = None,
     ) -> Union[Dict[str, List[FunctionTool]], List[FunctionTool]]:
         """
         Load tools from the configured file.
 
         Args:
             map_result: If True, return a map of tool names to their corresponding tools.
+            context: The request the tools are created for.
 
         Returns:
             A dictionary of tool names to lists of FunctionTools if map_result is True,
@@ -66,7 +89,7 @@ class ToolFactory:
                 for tool_type, config_entries in tool_configs.items():
                     for tool_name, config in config_entries.items():
                         loaded_tools = ToolFactory.load_tools(
-                            tool_type, tool_name, config
+                            tool_type, tool_name, config, context
                         )
                         if map_result:
                             tools.update(  # type: ignore
@@ -1,6 +1,12 @@
+import copy
+import hashlib
 import logging
-from typing import Dict, List, Optional
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Type
 
+from cachetools import LRUCache
 from llama_index.core.base.llms.types import ChatMessage
 from llama_index.core.settings import Settings
 from llama_index.core.tools import FunctionTool
@@ -24,8 +30,13 @@ CODE_GENERATION_PROMPT = """You are a skilled software engineer. You do not make
 Make sure to use the correct syntax for the programming language you're using.
 """
 
+CODE_EDIT_PROMPT = """
+To modify the existing code, don't repeat the whole code. Return only the changed regions as edits:
+each edit replaces an exact snippet of the existing code (copied character by character, long enough to be unique) with the new code.
+"""
+
 
-class CodeArtifact(BaseModel):
+class BaseCodeArtifact(BaseModel):
     commentary: str = Field(
         ...,
         description="Describe what you're about to do and the steps you want to take for generating the artifact in great detail.",
@@ -56,21 +67,58 @@ class CodeArtifact(BaseModel):
     file_path: str = Field(
         ..., description="Relative path to the file, including the file name."
     )
+
+
+class CodeArtifact(BaseCodeArtifact):
     code: str = Field(
         ...,
         description="Code generated by the artifact. Only runnable code is allowed.",
     )
 
 
+class CodeEdit(BaseModel):
+    original: str = Field(
+        ...,
+        description="An exact snippet of the existing code to replace, long enough to be unique.",
+    )
+    replacement: str = Field(..., description="The new code for the snippet.")
+
+
+class CodeArtifactEdit(BaseCodeArtifact):
+    edits: List[CodeEdit] = Field(
+        ..., description="The edits of the existing code, in order of appearance."
+    )
+
+    def apply(self, old_code: str) -> Optional[CodeArtifact]:
+        """
+        Apply the edits to the existing code. Returns None if an edit doesn't match the code exactly once.
+        """
+        code = old_code
+        for edit in self.edits:
+            if code.count(edit.original) != 1:
+                return None
+            code = code.replace(edit.original, edit.replacement)
+        return CodeArtifact(**self.model_dump(exclude={"edits"}), code=code)
+
+
+# The generated artifacts by query, existing code and files
+_artifact_cache: LRUCache = LRUCache(maxsize=int(os.getenv("ARTIFACT_CACHE_SIZE", "128")))
+_artifact_cache_lock = threading.Lock()
+
+
 class CodeGeneratorTool:
     def __init__(self):
-        pass
+        # Let the LLM return only the changed regions when modifying existing code
+        self.edit_mode = os.getenv("ARTIFACT_EDIT_MODE", "true").lower() == "true"
+        # The minimum seconds between two partial artifacts sent to the client
+        self.stream_interval = float(os.getenv("ARTIFACT_STREAM_INTERVAL", "0.2"))
 
     def artifact(
         self,
         query: str,
         sandbox_files: Optional[List[str]] = None,
         old_code: Optional[str] = None,
+        regenerate: bool = False,
     ) -> Dict:
         """Generate a code artifact based on the provided input.
 
@@ -78,11 +126,125 @@ class CodeGeneratorTool:
             query (str): A description of the application you want to build.
             sandbox_files (Optional[List[str]], optional): A list of sandbox file paths. Defaults to None. Include these files if the code requires them.
             old_code (Optional[str], optional): The existing code to be modified. Defaults to None.
+            regenerate (bool, optional): Generate a new artifact even if the same request was answered before, e.g. if the user asks to try again. Defaults to False.
 
         Returns:
             Dict: A dictionary containing information about the generated artifact.
         """
+        cache_key = self._cache_key(query, sandbox_files, old_code)
+        cached = None if regenerate else self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            data: Optional[CodeArtifact] = None
+            if old_code and self.edit_mode:
+                edit = self._generate(
+                    CodeArtifactEdit, query, sandbox_files, old_code
+                )
+                data = self._apply_edit(edit, old_code)
+            if data is None:
+                data = self._generate(CodeArtifact, query, sandbox_files, old_code)
+        except Exception as e:
+            logger.error(f"Failed to generate artifact: {str(e)}")
+            raise e
+        return self._to_result(cache_key, data, sandbox_files)
+
+    async def aartifact(
+        self,
+        query: str,
+        sandbox_files: Optional[List[str]] = None,
+        old_code: Optional[str] = None,
+        regenerate: bool = False,
+    ) -> Dict:
+        """
+        Async version of `artifact`. The partial artifact (commentary first, then code)
+        is streamed to the client of the chat request while it's generated.
+        """
+        cache_key = self._cache_key(query, sandbox_files, old_code)
+        cached = None if regenerate else self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            data: Optional[CodeArtifact] = None
+            if old_code and self.edit_mode:
+                edit = await self._astream_generate(
+                    CodeArtifactEdit, query, sandbox_files, old_code
+                )
+                data = self._apply_edit(edit, old_code)
+            if data is None:
+                data = await self._astream_generate(
+                    CodeArtifact, query, sandbox_files, old_code
+                )
+        except Exception as e:
+            logger.error(f"Failed to generate artifact: {str(e)}")
+            raise e
+        return self._to_result(cache_key, data, sandbox_files)
+
+    def _generate(
+        self,
+        output_cls: Type[BaseCodeArtifact],
+        query: str,
+        sandbox_files: Optional[List[str]],
+        old_code: Optional[str],
+    ) -> Any:
+        messages = self._get_messages(output_cls, query, sandbox_files, old_code)
+        sllm = Settings.llm.as_structured_llm(output_cls=output_cls)  # type: ignore
+        response = sllm.chat(messages)
+        return response.raw
+
+    async def _astream_generate(
+        self,
+        output_cls: Type[BaseCodeArtifact],
+        query: str,
+        sandbox_files: Optional[List[str]],
+        old_code: Optional[str],
+    ) -> Any:
+        from app.api.routers.events import send_event
+
+        messages = self._get_messages(output_cls, query, sandbox_files, old_code)
+        sllm = Settings.llm.as_structured_llm(output_cls=output_cls)  # type: ignore
+        if not send_event({"type": "events", "data": {"title": "Generating artifact"}}):
+            # No client to stream to
+            response = await sllm.achat(messages)
+            return response.raw
 
+        partial = None
+        last_sent = 0.0
+        async for response in await sllm.astream_chat(messages):
+            partial = response.raw
+            if partial is None or time.monotonic() - last_sent < self.stream_interval:
+                continue
+            send_event(self._get_partial_event(partial))
+            last_sent = time.monotonic()
+        if partial is None:
+            raise ValueError("The LLM returned no artifact")
+        send_event(self._get_partial_event(partial))
+        # The streamed objects are partial models, validate the complete one
+        if not isinstance(partial, output_cls):
+            partial = output_cls.model_validate(partial.model_dump())
+        return partial
+
+    @staticmethod
+    def _get_partial_event(partial: BaseModel) -> Dict:
+        return {
+            "type": "artifact_stream",
+            "data": partial.model_dump(
+                include={"commentary", "title", "template", "file_path", "code", "edits"}
+            ),
+        }
+
+    @staticmethod
+    def _get_messages(
+        output_cls: Type[BaseCodeArtifact],
+        query: str,
+        sandbox_files: Optional[List[str]],
+        old_code: Optional[str],
+    ) -> List[ChatMessage]:
+        system_prompt = CODE_GENERATION_PROMPT
+        if output_cls is CodeArtifactEdit:
+            system_prompt += CODE_EDIT_PROMPT
         if old_code:
             user_message = f"{query}\n\nThe existing code is: \n```\n{old_code}\n```"
         else:
@@ -90,22 +252,48 @@ class CodeGeneratorTool:
         if sandbox_files:
             user_message += f"\n\nThe provided files are: \n{str(sandbox_files)}"
 
-        messages: List[ChatMessage] = [
-            ChatMessage(role="system", content=CODE_GENERATION_PROMPT),
+        return [
+            ChatMessage(role="system", content=system_prompt),
             ChatMessage(role="user", content=user_message),
         ]
-        try:
-            sllm = Settings.llm.as_structured_llm(output_cls=CodeArtifact)  # type: ignore
-            response = sllm.chat(messages)
-            data: CodeArtifact = response.raw
-            data_dict = data.model_dump()
-            if sandbox_files:
-                data_dict["files"] = sandbox_files
-            return data_dict
-        except Exception as e:
-            logger.error(f"Failed to generate artifact: {str(e)}")
-            raise e
+
+    @staticmethod
+    def _apply_edit(
+        edit: CodeArtifactEdit, old_code: str
+    ) -> Optional[CodeArtifact]:
+        data = edit.apply(old_code)
+        if data is None:
+            logger.warning("Failed to apply the artifact edits, regenerating the code")
+        return data
+
+    @staticmethod
+    def _cache_key(
+        query: str, sandbox_files: Optional[List[str]], old_code: Optional[str]
+    ) -> Tuple[str, Optional[str], Tuple[str, ...]]:
+        old_code_hash = (
+            hashlib.sha256(old_code.encode("utf-8")).hexdigest() if old_code else None
+        )
+        return (query, old_code_hash, tuple(sandbox_files or []))
+
+    @staticmethod
+    def _get_cached(cache_key: Tuple) -> Optional[Dict]:
+        with _artifact_cache_lock:
+            cached = _artifact_cache.get(cache_key)
+        # Every caller gets its own copy, the cached artifact has nested lists
+        return copy.deepcopy(cached) if cached is not None else None
+
+    @staticmethod
+    def _to_result(
+        cache_key: Tuple, data: CodeArtifact, sandbox_files: Optional[List[str]]
+    ) -> Dict:
+        data_dict = data.model_dump()
+        if sandbox_files:
+            data_dict["files"] = list(sandbox_files)
+        with _artifact_cache_lock:
+            _artifact_cache[cache_key] = copy.deepcopy(data_dict)
+        return data_dict
 
 
 def get_tools(**kwargs):
-    return [FunctionTool.from_defaults(fn=CodeGeneratorTool().artifact)]
+    tool = CodeGeneratorTool()
+    return [FunctionTool.from_defaults(fn=tool.artifact, async_fn=tool.aartifact)]
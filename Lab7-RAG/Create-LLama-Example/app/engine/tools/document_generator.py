@@ -1,12 +1,22 @@
+import hashlib
 import logging
 import os
 import re
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
 from enum import Enum
 from io import BytesIO
+from typing import BinaryIO, Dict, Optional
 
 from llama_index.core.tools.function_tool import FunctionTool
 
+logger = logging.getLogger("uvicorn")
+
 OUTPUT_DIR = "output/tools"
+# The rendered documents by content hash and document type, outside of the served directory
+RENDER_CACHE_DIR = os.path.join(os.getenv("STORAGE_DIR", "storage"), "documents")
 
 
 class DocumentType(Enum):
@@ -118,9 +128,9 @@ class DocumentGenerator:
         return html_content
 
     @classmethod
-    def _generate_pdf(cls, html_content: str) -> BytesIO:
+    def _generate_pdf(cls, html_content: str, output: BinaryIO):
         """
-        Generate a PDF from the HTML content.
+        Generate a PDF from the HTML content and write it to the output file.
         """
         try:
             from xhtml2pdf import pisa
@@ -135,18 +145,14 @@ class DocumentGenerator:
             content=html_content,
         )
 
-        buffer = BytesIO()
         pdf = pisa.pisaDocument(
-            BytesIO(pdf_html.encode("UTF-8")), buffer, encoding="UTF-8"
+            BytesIO(pdf_html.encode("UTF-8")), output, encoding="UTF-8"
         )
 
         if pdf.err:
-            logging.error(f"PDF generation failed: {pdf.err}")
+            logger.error(f"PDF generation failed: {pdf.err}")
             raise ValueError("PDF generation failed")
 
-        buffer.seek(0)
-        return buffer
-
     @classmethod
     def _generate_html(cls, html_content: str) -> str:
         """
@@ -169,46 +175,73 @@ class DocumentGenerator:
             document_type: str (pdf or html) specify the type of the file format based on the use case
             file_name: str (name of the document file) must be a valid file name, no extensions needed
         Returns:
-            str (URL to the document file): A file URL ready to serve.
+            str (URL to the document file): A file URL, served as soon as the document is rendered.
         """
         try:
-            document_type = DocumentType(document_type.lower())
+            doc_type = DocumentType(document_type.lower())
         except ValueError:
             raise ValueError(
                 f"Invalid document type: {document_type}. Must be 'pdf' or 'html'."
             )
-        # Always generate html content first
-        html_content = cls._generate_html_content(original_content)
+        file_name = cls._validate_file_name(file_name)
+        file_path = os.path.join(OUTPUT_DIR, f"{file_name}.{doc_type.value}")
 
-        # Based on the type of document, generate the corresponding file
-        if document_type == DocumentType.PDF:
-            content = cls._generate_pdf(html_content)
-            file_extension = "pdf"
-        elif document_type == DocumentType.HTML:
-            content = BytesIO(cls._generate_html(html_content).encode("utf-8"))
-            file_extension = "html"
-        else:
-            raise ValueError(f"Unexpected document type: {document_type}")
+        # The same content is rendered once, later requests copy the cached document
+        cache_key = hashlib.sha256(
+            f"{doc_type.value}:{original_content}".encode("utf-8")
+        ).hexdigest()
+        cache_path = os.path.join(RENDER_CACHE_DIR, f"{cache_key}.{doc_type.value}")
+        if not _publish_cached_document(cache_path, file_path):
+            # Render in the background, the file is served once it's ready
+            future = _submit_render(original_content, doc_type, cache_path)
+            published = threading.Event()
 
-        file_name = cls._validate_file_name(file_name)
-        file_path = os.path.join(OUTPUT_DIR, f"{file_name}.{file_extension}")
+            def on_rendered(future: Future):
+                try:
+                    _on_rendered(future, cache_path, file_path)
+                finally:
+                    published.set()
 
-        cls._write_to_file(content, file_path)
+            future.add_done_callback(on_rendered)
+            # Small documents are published within the wait, so their errors reach the agent.
+            # Failures of longer renders are recorded in a marker file next to the document.
+            wait = float(os.getenv("DOCUMENT_RENDER_WAIT", "5"))
+            if not published.wait(timeout=wait):
+                logger.info(f"Rendering {file_path} in the background")
+            elif future.exception() is not None:
+                raise ValueError(
+                    f"Failed to generate the document: {future.exception()}"
+                )
 
         file_url = f"{os.getenv('FILESERVER_URL_PREFIX')}/{file_path}"
         return file_url
 
-    @staticmethod
-    def _write_to_file(content: BytesIO, file_path: str):
+    @classmethod
+    def render_document(
+        cls, original_content: str, document_type: DocumentType, file_path: str
+    ):
         """
-        Write the content to a file.
+        Render the markdown content to a document file. The document is streamed to
+        a temporary file and moved into place, so a partial file is never served.
         """
+        # Always generate html content first
+        html_content = cls._generate_html_content(original_content)
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_file_path = f"{file_path}.{os.getpid()}.part"
         try:
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, "wb") as file:
-                file.write(content.getvalue())
-        except Exception as e:
-            raise e
+            with open(tmp_file_path, "wb") as file:
+                # Based on the type of document, generate the corresponding file
+                if document_type == DocumentType.PDF:
+                    cls._generate_pdf(html_content, file)
+                elif document_type == DocumentType.HTML:
+                    file.write(cls._generate_html(html_content).encode("utf-8"))
+                else:
+                    raise ValueError(f"Unexpected document type: {document_type}")
+            os.replace(tmp_file_path, file_path)
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
 
     @staticmethod
     def _validate_file_name(file_name: str) -> str:
@@ -225,5 +258,127 @@ class DocumentGenerator:
             raise ValueError("File name is not allowed to contain special characters.")
 
 
+_render_executor: Optional[ProcessPoolExecutor] = None
+# The running renders by cache path, so concurrent requests for a document share one render
+_pending_renders: Dict[str, Future] = {}
+_render_lock = threading.Lock()
+
+
+def _render_document(original_content: str, document_type: str, file_path: str):
+    # Runs in a worker process, the arguments must be picklable
+    DocumentGenerator.render_document(
+        original_content, DocumentType(document_type), file_path
+    )
+
+
+def _submit_render(
+    original_content: str, document_type: DocumentType, cache_path: str
+) -> Future:
+    global _render_executor
+    with _render_lock:
+        future = _pending_renders.get(cache_path)
+        if future is None:
+            if _render_executor is None:
+                _render_executor = ProcessPoolExecutor(
+                    max_workers=int(os.getenv("DOCUMENT_RENDER_WORKERS", "2"))
+                )
+            future = _render_executor.submit(
+                _render_document, original_content, document_type.value, cache_path
+            )
+            _pending_renders[cache_path] = future
+    return future
+
+
+def _on_rendered(future: Future, cache_path: str, file_path: str):
+    with _render_lock:
+        _pending_renders.pop(cache_path, None)
+    try:
+        future.result()
+        _publish_document(cache_path, file_path)
+        _evict_render_cache()
+    except Exception as e:
+        logger.error(f"Failed to render document {file_path}: {e}")
+        # The URL was already returned, leave the error where the file would be
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(get_failed_marker_path(file_path), "w") as f:
+                f.write(str(e))
+        except OSError:
+            logger.exception(f"Failed to write the failure marker of {file_path}")
+
+
+def get_failed_marker_path(file_path: str) -> str:
+    """
+    The file with the error of a document that failed to render in the background.
+    """
+    return f"{file_path}.failed"
+
+
+def _publish_cached_document(cache_path: str, file_path: str) -> bool:
+    """
+    Publish a document from the render cache, returns False if it's not cached.
+    """
+    try:
+        _publish_document(cache_path, file_path)
+        # Mark the document as recently used
+        os.utime(cache_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _evict_render_cache():
+    """
+    Remove the least recently used rendered documents over DOCUMENT_RENDER_CACHE_SIZE.
+    The published documents are separate links or copies, so they are kept.
+    """
+    max_size = int(os.getenv("DOCUMENT_RENDER_CACHE_SIZE", "256"))
+    try:
+        names = os.listdir(RENDER_CACHE_DIR)
+    except FileNotFoundError:
+        return
+    cache_paths = [
+        os.path.join(RENDER_CACHE_DIR, name)
+        for name in names
+        if not name.endswith(".part")
+    ]
+    if len(cache_paths) <= max_size:
+        return
+    cache_paths.sort(key=_get_modified_time)
+    for cache_path in cache_paths[: len(cache_paths) - max_size]:
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
+
+
+def _get_modified_time(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+def _publish_document(cache_path: str, file_path: str):
+    """
+    Make a rendered document available at the file path, without copying it if possible.
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # A unique temporary name, concurrent publishes of the same file must not share it
+    tmp_file_path = f"{file_path}.{uuid.uuid4().hex}.part"
+    try:
+        try:
+            os.link(cache_path, tmp_file_path)
+        except OSError:
+            shutil.copyfile(cache_path, tmp_file_path)
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+    failed_marker_path = get_failed_marker_path(file_path)
+    if os.path.exists(failed_marker_path):
+        os.remove(failed_marker_path)
+
+
 def get_tools(**kwargs):
     return [FunctionTool.from_defaults(DocumentGenerator.generate_document)]
@@ -1,5 +1,183 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Protocol, Tuple
+
+from cachetools import TTLCache
 from llama_index.core.tools.function_tool import FunctionTool
 
+logger = logging.getLogger("uvicorn")
+
+
+class SearchBackend(Protocol):
+    def text(self, query: str, region: str, max_results: int) -> List[dict]: ...
+
+    def images(self, query: str, region: str, max_results: int) -> List[dict]: ...
+
+
+class DDGSBackend:
+    """
+    Search DuckDuckGo with the `duckduckgo_search` package.
+    """
+
+    def __init__(self):
+        try:
+            from duckduckgo_search import DDGS  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                "duckduckgo_search package is required to use this function."
+                "Please install it by running: `poetry add duckduckgo_search` or `pip install duckduckgo_search`"
+            )
+
+    def text(self, query: str, region: str, max_results: int) -> List[dict]:
+        from duckduckgo_search import DDGS
+
+        with DDGS() as ddg:
+            return list(
+                ddg.text(keywords=query, region=region, max_results=max_results)
+            )
+
+    def images(self, query: str, region: str, max_results: int) -> List[dict]:
+        from duckduckgo_search import DDGS
+
+        with DDGS() as ddg:
+            return list(
+                ddg.images(keywords=query, region=region, max_results=max_results)
+            )
+
+
+class FixtureBackend:
+    """
+    Return search results from a local JSON file, as a stand-in for DuckDuckGo in tests and benchmarks.
+    The file maps "text" and "images" to the results by query; unknown queries have no results.
+    """
+
+    def __init__(self, path: str, latency: float = 0.0):
+        with open(path, "r") as f:
+            self._fixtures: Dict[str, Dict[str, List[dict]]] = json.load(f)
+        self._latency = latency
+
+    def text(self, query: str, region: str, max_results: int) -> List[dict]:
+        return self._search("text", query, max_results)
+
+    def images(self, query: str, region: str, max_results: int) -> List[dict]:
+        return self._search("images", query, max_results)
+
+    def _search(self, kind: str, query: str, max_results: int) -> List[dict]:
+        if self._latency > 0:
+            time.sleep(self._latency)
+        return list(self._fixtures.get(kind, {}).get(query, []))[:max_results]
+
+
+class SearchService:
+    """
+    Run searches on a backend with a TTL cache of the results.
+
+    Concurrent identical searches share one in-flight request, and requests to the backend
+    are spaced by `min_interval` seconds to avoid being throttled.
+    """
+
+    def __init__(
+        self,
+        backend: SearchBackend,
+        cache_ttl: float = 3600,
+        cache_size: int = 1024,
+        min_interval: float = 1.0,
+        max_workers: int = 4,
+    ):
+        self.backend = backend
+        self.min_interval = min_interval
+        self._cache: TTLCache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._in_flight: Dict[Tuple, Future] = {}
+        # Reentrant, the done callback runs in place if the request is already done
+        self._lock = threading.RLock()
+        self._rate_limit_lock = threading.Lock()
+        self._last_request = 0.0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="duckduckgo-search"
+        )
+
+    def search(self, kind: str, query: str, region: str, max_results: int) -> List[dict]:
+        future = self._get_future(kind, query, region, max_results)
+        return list(future.result())
+
+    async def asearch(
+        self, kind: str, query: str, region: str, max_results: int
+    ) -> List[dict]:
+        future = self._get_future(kind, query, region, max_results)
+        # The request is shared with other callers, cancelling this caller must not cancel it
+        return list(await asyncio.shield(asyncio.wrap_future(future)))
+
+    def _get_future(
+        self, kind: str, query: str, region: str, max_results: int
+    ) -> Future:
+        key = (kind, query, region, max_results)
+        with self._lock:
+            results = self._cache.get(key)
+            if results is not None:
+                future: Future = Future()
+                future.set_result(results)
+                return future
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._executor.submit(self._fetch, key)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda future: self._on_fetched(key, future))
+        return future
+
+    def _fetch(self, key: Tuple) -> List[dict]:
+        kind, query, region, max_results = key
+        with self._rate_limit_lock:
+            wait = self._last_request + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_request = time.monotonic()
+        if kind == "images":
+            return self.backend.images(query, region, max_results)
+        return self.backend.text(query, region, max_results)
+
+    def _on_fetched(self, key: Tuple, future: Future) -> None:
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if future.exception() is None:
+                self._cache[key] = future.result()
+
+
+_search_service: Optional[SearchService] = None
+_search_service_lock = threading.Lock()
+
+
+def get_search_service() -> SearchService:
+    """
+    Get the search service of the backend configured by DUCKDUCKGO_BACKEND (ddgs or fixture).
+    """
+    global _search_service
+    with _search_service_lock:
+        if _search_service is None:
+            backend_name = os.getenv("DUCKDUCKGO_BACKEND", "ddgs")
+            match backend_name:
+                case "ddgs":
+                    backend: SearchBackend = DDGSBackend()
+                case "fixture":
+                    backend = FixtureBackend(
+                        path=os.getenv(
+                            "DUCKDUCKGO_FIXTURE_PATH", "config/duckduckgo_fixture.json"
+                        ),
+                        latency=float(os.getenv("DUCKDUCKGO_FIXTURE_LATENCY", "0")),
+                    )
+                case _:
+                    raise ValueError(f"Invalid search backend: {backend_name}")
+            _search_service = SearchService(
+                backend=backend,
+                cache_ttl=float(os.getenv("DUCKDUCKGO_CACHE_TTL", "3600")),
+                min_interval=float(os.getenv("DUCKDUCKGO_MIN_INTERVAL", "1.0")),
+            )
+    return _search_service
+
 
 def duckduckgo_search(
     query: str,
@@ -13,24 +191,18 @@ def duckduckgo_search(
         region Optional(str): The region to be used for the search in [country-language] convention, ex us-en, uk-en, ru-ru, etc...
         max_results Optional(int): The maximum number of results to be returned. Default is 10.
     """
-    try:
-        from duckduckgo_search import DDGS
-    except ImportError:
-        raise ImportError(
-            "duckduckgo_search package is required to use this function."
-            "Please install it by running: `poetry add duckduckgo_search` or `pip install duckduckgo_search`"
-        )
+    return get_search_service().search("text", query, region, max_results)
 
-    results = []
-    with DDGS() as ddg:
-        results = list(
-            ddg.text(
-                keywords=query,
-                region=region,
-                max_results=max_results,
-            )
-        )
-    return results
+
+async def aduckduckgo_search(
+    query: str,
+    region: str = "wt-wt",
+    max_results: int = 10,
+):
+    """
+    Async version of `duckduckgo_search`.
+    """
+    return await get_search_service().asearch("text", query, region, max_results)
 
 
 def duckduckgo_image_search(
@@ -45,26 +217,24 @@ def duckduckgo_image_search(
         region Optional(str): The region to be used for the search in [country-language] convention, ex us-en, uk-en, ru-ru, etc...
         max_results Optional(int): The maximum number of results to be returned. Default is 10.
     """
-    try:
-        from duckduckgo_search import DDGS
-    except ImportError:
-        raise ImportError(
-            "duckduckgo_search package is required to use this function."
-            "Please install it by running: `poetry add duckduckgo_search` or `pip install duckduckgo_search`"
-        )
-    with DDGS() as ddg:
-        results = list(
-            ddg.images(
-                keywords=query,
-                region=region,
-                max_results=max_results,
-            )
-        )
-    return results
+    return get_search_service().search("images", query, region, max_results)
+
+
+async def aduckduckgo_image_search(
+    query: str,
+    region: str = "wt-wt",
+    max_results: int = 10,
+):
+    """
+    Async version of `duckduckgo_image_search`.
+    """
+    return await get_search_service().asearch("images", query, region, max_results)
 
 
 def get_tools(**kwargs):
     return [
-        FunctionTool.from_defaults(duckduckgo_search),
-        FunctionTool.from_defaults(duckduckgo_image_search),
+        FunctionTool.from_defaults(fn=duckduckgo_search, async_fn=aduckduckgo_search),
+        FunctionTool.from_defaults(
+            fn=duckduckgo_image_search, async_fn=aduckduckgo_image_search
+        ),
     ]
@@ -1,18 +1,29 @@
+import asyncio
 import logging
 import os
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
 from textwrap import dedent
-from typing import Optional
+from typing import Any, Optional
 
+import numpy as np
 import pandas as pd
+from app.engine.context import count_tokens
+from app.engine.tools import ToolContext
 from app.services.file import FileService
 from llama_index.core import Settings
 from llama_index.core.prompts import PromptTemplate
 from llama_index.core.tools import FunctionTool
+from llama_index.core.vector_stores.types import MetadataFilters
 from pydantic import BaseModel, Field
 
 logger = logging.getLogger(__name__)
 
+# Rows sampled to estimate the tokens of a table
+TOKEN_SAMPLE_ROWS = 20
+
 
 class MissingCell(BaseModel):
     """
@@ -88,6 +99,66 @@ class FormFillingTool:
         """
     )
 
+    # Prompt for a window of a large table, the missing cells are already found
+    _window_extract_questions_prompt = dedent(
+        """
+        You are a data analyst. You are given a part of a large table, with the rows that have missing cells
+        and the columns needed to understand them, and the list of the missing cells.
+        Your task is to provide the question needed to fill each missing cell.
+
+        # Instructions:
+        - Understand the content of the table and the topics of the table.
+        - Keep the row index and column index of each missing cell exactly as they are given.
+        - For each missing cell, provide the question needed to fill the cell (it's important to provide the question that is relevant to the topic of the table).
+        - Since the cell's value should be concise, the question should request a numerical answer or a specific value.
+
+        Please provide your answer in the requested format.
+        # Here is your task:
+
+        - Table content:
+        {table_content}
+
+        - Missing cells:
+        {missing_cells}
+
+        - Your answer:
+        """
+    )
+
+    # Prompt for answering a question with a concise cell value
+    _cell_value_prompt = dedent(
+        """
+        Context information is below.
+        ---------------------
+        {context_str}
+        ---------------------
+        Given the context information and not prior knowledge, answer the question with only the value of a table cell:
+        a number (with its unit if needed) or a short specific value, without any explanation.
+        If the context doesn't contain the answer, answer exactly: N/A
+        Question: {query_str}
+        Value:
+        """
+    )
+
+    def __init__(
+        self,
+        filters: Optional[MetadataFilters] = None,
+        private_index: Optional[Any] = None,
+    ):
+        # The answers only use the documents of the chat: the public documents and the
+        # selected uploads of the user, never the private uploads of other users
+        self.filters = filters
+        self.private_index = private_index
+        # Tables estimated above this many tokens are processed in windows of this size
+        self.token_budget = int(os.getenv("FORM_FILLING_TOKEN_BUDGET", "4000"))
+        self.max_workers = int(os.getenv("FORM_FILLING_CONCURRENCY", "4"))
+        # The questions answered at the same time by `answer_questions`
+        self.answer_concurrency = int(
+            os.getenv("FORM_FILLING_ANSWER_CONCURRENCY", "8")
+        )
+        self._query_engine = None
+        self._query_engine_lock = threading.Lock()
+
     def extract_questions(
         self,
         file_path: Optional[str] = None,
@@ -125,10 +196,17 @@ class FormFillingTool:
                     "message": "Please check and update the file path and ensure it's a local path - not a sandbox path.",
                 }
 
+            if self._is_large_table(df):
+                return self._extract_questions_in_windows(df)
+
             table_content = df.to_markdown()
             if table_content is None:
                 raise ValueError("Could not convert the table to markdown")
         if file_content:
+            if count_tokens(file_content) > self.token_budget:
+                return self._extract_questions_in_windows(
+                    pd.read_csv(StringIO(file_content))
+                )
             table_content = file_content
 
         if table_content is None:
@@ -141,6 +219,114 @@ class FormFillingTool:
         )
         return response.model_dump()
 
+    def answer_questions(self, missing_cells: list[MissingCell]) -> dict:
+        """
+        Use this tool to answer the questions of all missing cells at once using the knowledge base.
+        Call it with the missing cells from `extract_questions` instead of querying the index for each cell.
+
+        Args:
+            missing_cells (list[MissingCell]): The missing cells with their questions, as returned by `extract_questions`.
+
+        Returns:
+            dict: The cell values to pass to `fill_form`, and the cells that couldn't be answered.
+        """
+        missing_cells = self._parse_missing_cells(missing_cells)
+        query_engine = self._get_query_engine()
+        if query_engine is None:
+            return {"error": "No index found to answer the questions"}
+        if len(missing_cells) == 0:
+            return self._to_cell_values(missing_cells, [])
+
+        def answer(cell: MissingCell) -> Optional[str]:
+            try:
+                return str(query_engine.query(cell.question_to_answer))
+            except Exception as e:
+                logger.warning(f"Failed to answer question of cell {cell}: {e}")
+                return None
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.answer_concurrency, len(missing_cells))
+        ) as executor:
+            answers = list(executor.map(answer, missing_cells))
+        return self._to_cell_values(missing_cells, answers)
+
+    async def aanswer_questions(self, missing_cells: list[MissingCell]) -> dict:
+        """
+        Async version of `answer_questions`, the questions are answered concurrently
+        with at most `answer_concurrency` of them at the same time.
+        """
+        missing_cells = self._parse_missing_cells(missing_cells)
+        query_engine = await asyncio.to_thread(self._get_query_engine)
+        if query_engine is None:
+            return {"error": "No index found to answer the questions"}
+        semaphore = asyncio.Semaphore(self.answer_concurrency)
+
+        async def answer(cell: MissingCell) -> Optional[str]:
+            async with semaphore:
+                try:
+                    return str(await query_engine.aquery(cell.question_to_answer))
+                except Exception as e:
+                    logger.warning(f"Failed to answer question of cell {cell}: {e}")
+                    return None
+
+        answers = await asyncio.gather(*[answer(cell) for cell in missing_cells])
+        return self._to_cell_values(missing_cells, list(answers))
+
+    def _get_query_engine(self):
+        """
+        Lazily create a query engine over the documents of the chat that answers with concise cell values.
+        """
+        from app.engine.index import get_index
+        from app.engine.query_filter import generate_filters
+        from app.engine.tools.query_engine import create_query_engine
+
+        with self._query_engine_lock:
+            if self._query_engine is None:
+                index = get_index()
+                if index is None:
+                    return None
+                filters = self.filters
+                if filters is None:
+                    # Without the chat's filters, only the public documents are searched
+                    filters = generate_filters([])
+                self._query_engine = create_query_engine(
+                    index,
+                    filters=filters,
+                    private_index=self.private_index,
+                    text_qa_template=PromptTemplate(self._cell_value_prompt),
+                )
+        return self._query_engine
+
+    @staticmethod
+    def _parse_missing_cells(missing_cells: list[Any]) -> list[MissingCell]:
+        return [
+            cell if isinstance(cell, MissingCell) else MissingCell(**cell)
+            for cell in missing_cells
+        ]
+
+    @staticmethod
+    def _to_cell_values(
+        missing_cells: list[MissingCell], answers: list[Optional[str]]
+    ) -> dict:
+        cell_values = []
+        unanswered_cells = []
+        for cell, answer in zip(missing_cells, answers):
+            answer = answer.strip() if answer is not None else ""
+            if answer == "" or answer.upper() == "N/A":
+                unanswered_cells.append(cell.model_dump())
+                continue
+            cell_values.append(
+                CellValue(
+                    row_index=cell.row_index,
+                    column_index=cell.column_index,
+                    value=answer,
+                ).model_dump()
+            )
+        logger.info(
+            f"Answered {len(cell_values)} of {len(missing_cells)} missing cells"
+        )
+        return {"cell_values": cell_values, "unanswered_cells": unanswered_cells}
+
     def fill_form(
         self,
         cell_values: list[CellValue],
@@ -152,7 +338,7 @@ class FormFillingTool:
         Requires cell values to be used for filling out, as well as either the path to the CSV file or the content of the CSV file.
 
         Args:
-            cell_values (list[CellValue]): The cell values used to fill out the CSV file (call `extract_questions` and query engine to construct the cell values).
+            cell_values (list[CellValue]): The cell values used to fill out the CSV file (call `extract_questions` and `answer_questions` to construct the cell values).
             file_path (Optional[str]): The local file path to the CSV file that should be filled out (not as sandbox path).
             file_content (Optional[str]): The content of the CSV file that should be filled out.
 
@@ -162,16 +348,32 @@ class FormFillingTool:
         file_name, file_extension = self._get_file_name_and_extension(
             file_path, file_content
         )
-        df = pd.read_csv(file_path)
-
-        # Fill the dataframe with the cell values
+        if file_path is not None:
+            df = pd.read_csv(file_path)
+        else:
+            df = pd.read_csv(StringIO(file_content))
+
+        # Fill the dataframe with the cell values, one write per column
+        parsed_cell_values = [
+            cell_value if isinstance(cell_value, CellValue) else CellValue(**cell_value)
+            for cell_value in cell_values
+        ]
+        rows = np.array(
+            [cell_value.row_index for cell_value in parsed_cell_values], dtype=int
+        )
+        columns = np.array(
+            [cell_value.column_index for cell_value in parsed_cell_values], dtype=int
+        )
+        values = np.array(
+            [cell_value.value for cell_value in parsed_cell_values], dtype=object
+        )
         filled_df = df.copy()
-        for cell_value in cell_values:
-            if not isinstance(cell_value, CellValue):
-                cell_value = CellValue(**cell_value)
-            filled_df.iloc[cell_value.row_index, cell_value.column_index] = (
-                cell_value.value
-            )
+        for column in np.unique(columns):
+            # Only the filled columns become object columns, the others keep their dtype
+            in_column = columns == column
+            column_values = filled_df.iloc[:, column].astype(object)
+            column_values.iloc[rows[in_column]] = values[in_column]
+            filled_df.isetitem(int(column), column_values)
 
         # Save the filled table to a new CSV file
         csv_content: str = filled_df.to_csv(index=False)
@@ -181,13 +383,102 @@ class FormFillingTool:
             save_dir=self.save_dir,
         )
 
-        new_content: str = filled_df.to_markdown()
+        if self._is_large_table(filled_df):
+            # Only show the filled rows of a large table
+            new_content: str = filled_df.iloc[np.unique(rows)].to_markdown()
+        else:
+            new_content = filled_df.to_markdown()
         result = {
             "filled_content": new_content,
             "filled_file": file_metadata,
         }
         return result
 
+    def _is_large_table(self, df: pd.DataFrame) -> bool:
+        return self._estimate_row_tokens(df) * len(df) > self.token_budget
+
+    @staticmethod
+    def _estimate_row_tokens(df: pd.DataFrame) -> float:
+        """
+        Estimate the tokens per row of the markdown table from a sample of rows.
+        """
+        if len(df) == 0:
+            return 0
+        sample = df.head(TOKEN_SAMPLE_ROWS)
+        return count_tokens(sample.to_markdown()) / len(sample)
+
+    def _extract_questions_in_windows(self, df: pd.DataFrame) -> dict:
+        """
+        Extract the questions of a large table: the missing cells are found with a mask,
+        and only the rows with missing cells and the relevant columns are sent to the LLM,
+        in windows that fit the token budget and are processed concurrently.
+        """
+        missing = df.isna().to_numpy()
+        missing_rows = np.flatnonzero(missing.any(axis=1))
+        if len(missing_rows) == 0:
+            return MissingCells(missing_cells=[]).model_dump()
+        # The columns with missing cells, and the complete label columns that identify the rows
+        is_label_column = ~df.dtypes.map(pd.api.types.is_numeric_dtype).to_numpy(dtype=bool)
+        context_columns = np.flatnonzero(missing.any(axis=0) | is_label_column)
+        context_df = df.iloc[missing_rows, context_columns]
+
+        rows_per_window = max(
+            1, int(self.token_budget // max(self._estimate_row_tokens(context_df), 1))
+        )
+        windows = [
+            (
+                context_df.iloc[start : start + rows_per_window],
+                missing_rows[start : start + rows_per_window],
+            )
+            for start in range(0, len(missing_rows), rows_per_window)
+        ]
+        logger.info(
+            f"Extracting questions for {int(missing.sum())} missing cells in {len(windows)} windows"
+        )
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(windows))
+        ) as executor:
+            results = list(
+                executor.map(
+                    lambda window: self._extract_window_questions(
+                        window[0], window[1], missing, df.columns
+                    ),
+                    windows,
+                )
+            )
+        return MissingCells(
+            missing_cells=[cell for cells in results for cell in cells]
+        ).model_dump()
+
+    def _extract_window_questions(
+        self,
+        window_df: pd.DataFrame,
+        rows: np.ndarray,
+        missing: np.ndarray,
+        column_names: pd.Index,
+    ) -> list[MissingCell]:
+        expected = {
+            (int(row), int(column))
+            for row in rows
+            for column in np.flatnonzero(missing[row])
+        }
+        missing_cells = "\n".join(
+            f"- Row: {row}, Column: {column} ({column_names[column]})"
+            for row, column in sorted(expected)
+        )
+        response: MissingCells = Settings.llm.structured_predict(
+            output_cls=MissingCells,
+            prompt=PromptTemplate(self._window_extract_questions_prompt),
+            table_content=window_df.to_markdown(),
+            missing_cells=missing_cells,
+        )
+        # Drop the cells the LLM made up
+        return [
+            cell
+            for cell in response.missing_cells
+            if (cell.row_index, cell.column_index) in expected
+        ]
+
     def _get_file_name_and_extension(
         self, file_path: Optional[str], file_content: Optional[str]
     ) -> tuple[str, str]:
@@ -216,9 +507,17 @@ class FormFillingTool:
         return file_metadata.model_dump()
 
 
-def get_tools(**kwargs):
-    tool = FormFillingTool()
+def get_tools(context: Optional[ToolContext] = None, **kwargs):
+    if context is not None:
+        tool = FormFillingTool(
+            filters=context.filters, private_index=context.private_index
+        )
+    else:
+        tool = FormFillingTool()
     return [
         FunctionTool.from_defaults(tool.extract_questions),
+        FunctionTool.from_defaults(
+            fn=tool.answer_questions, async_fn=tool.aanswer_questions
+        ),
         FunctionTool.from_defaults(tool.fill_form),
     ]
@@ -0,0 +1,36 @@
+import asyncio
+import threading
+from weakref import WeakKeyDictionary
+
+import httpx
+
+
+class AsyncClients:
+    """
+    Keep-alive async HTTP clients, one per event loop since an async client is bound to
+    the loop it's used in. The clients of closed loops are dropped.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._clients: "WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+            WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def get(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # The connections of a client refer to its loop, so the loop isn't collected
+            # while its client is kept: drop the clients of closed loops explicitly
+            for closed_loop in [key for key in self._clients if key.is_closed()]:
+                del self._clients[closed_loop]
+            client = self._clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(timeout=self.timeout)
+                self._clients[loop] = client
+            return client
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
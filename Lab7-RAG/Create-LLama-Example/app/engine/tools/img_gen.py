@@ -1,12 +1,20 @@
+import asyncio
+import hashlib
 import logging
 import os
+import threading
+import time
 import uuid
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-import requests  # type: ignore
+import httpx
+from cachetools import LRUCache
 from llama_index.core.tools import FunctionTool
 from pydantic import BaseModel, Field
 
+from app.engine.tools.http_clients import AsyncClients
+
 logger = logging.getLogger(__name__)
 
 
@@ -28,7 +36,24 @@ class ImageGeneratorToolOutput(BaseModel):
 class ImageGeneratorTool:
     _IMG_OUTPUT_FORMAT = "webp"
     _IMG_OUTPUT_DIR = "output/tools"
-    _IMG_GEN_API = "https://api.stability.ai/v2beta/stable-image/generate/core"
+    # The API URL can be changed, e.g. to test against a local stub server
+    _IMG_GEN_API = os.getenv(
+        "STABILITY_API_URL", "https://api.stability.ai/v2beta/stable-image/generate/core"
+    )
+
+    timeout = float(os.getenv("IMAGE_GEN_TIMEOUT", "60"))
+    # Images of a repeated prompt are reused for this many seconds, 0 to always generate new ones
+    cache_ttl = float(os.getenv("IMAGE_GEN_CACHE_TTL", str(24 * 3600)))
+
+    # Keep-alive connections shared by all tool instances
+    _client: Optional[httpx.Client] = None
+    _async_clients = AsyncClients(timeout=timeout)
+    _clients_lock = threading.Lock()
+    # The latest image file of every prompt hash
+    _image_files: LRUCache = LRUCache(
+        maxsize=int(os.getenv("IMAGE_GEN_CACHE_SIZE", "1024"))
+    )
+    _image_files_lock = threading.Lock()
 
     def __init__(self, api_key: str = None):
         if not api_key:
@@ -41,6 +66,17 @@ class ImageGeneratorTool:
             )
         if self.fileserver_url_prefix is None:
             raise ValueError("FILESERVER_URL_PREFIX is required.")
+        # The images generated at the same time by `generate_images`
+        self.concurrency = int(os.getenv("IMAGE_GEN_CONCURRENCY", "4"))
+
+    def _get_client(self) -> httpx.Client:
+        with self._clients_lock:
+            if ImageGeneratorTool._client is None:
+                ImageGeneratorTool._client = httpx.Client(timeout=self.timeout)
+            return ImageGeneratorTool._client
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        return self._async_clients.get()
 
     def _prepare_output_dir(self):
         """
@@ -49,49 +85,123 @@ class ImageGeneratorTool:
         if not os.path.exists(self._IMG_OUTPUT_DIR):
             os.makedirs(self._IMG_OUTPUT_DIR, exist_ok=True)
 
-    def _save_image(self, image_data: bytes):
+    @staticmethod
+    def _get_prompt_hash(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32]
+
+    def _get_image_filename(self, prompt: str) -> str:
+        """
+        Every generated image gets a new file, so a regenerated image never replaces the one
+        that earlier messages link to (or that browsers have cached).
+        """
+        prompt_hash = self._get_prompt_hash(prompt)
+        return f"{prompt_hash}-{uuid.uuid4().hex}.{self._IMG_OUTPUT_FORMAT}"
+
+    def _get_image_url(self, filename: str) -> str:
+        return f"{self.fileserver_url_prefix}/{self._IMG_OUTPUT_DIR}/{filename}"
+
+    def _get_cached_image_url(self, prompt: str) -> Optional[str]:
+        with self._image_files_lock:
+            filename = self._image_files.get(self._get_prompt_hash(prompt))
+        if filename is None:
+            return None
+        output_path = os.path.join(self._IMG_OUTPUT_DIR, filename)
+        try:
+            modified_at = os.path.getmtime(output_path)
+        except OSError:
+            return None
+        if time.time() - modified_at > self.cache_ttl:
+            return None
+        logger.info(f"Using the cached image for prompt: {prompt}")
+        return self._get_image_url(filename)
+
+    def _save_image(self, image_data: bytes, prompt: str):
         self._prepare_output_dir()
-        filename = f"{uuid.uuid4()}.{self._IMG_OUTPUT_FORMAT}"
+        filename = self._get_image_filename(prompt)
         output_path = os.path.join(self._IMG_OUTPUT_DIR, filename)
-        with open(output_path, "wb") as f:
+        # Write to a temporary file first, so a partial image is never served or cached
+        tmp_path = f"{output_path}.{uuid.uuid4()}.part"
+        with open(tmp_path, "wb") as f:
             f.write(image_data)
-        url = f"{os.getenv('FILESERVER_URL_PREFIX')}/{self._IMG_OUTPUT_DIR}/{filename}"
+        os.replace(tmp_path, output_path)
+        with self._image_files_lock:
+            self._image_files[self._get_prompt_hash(prompt)] = filename
+        url = self._get_image_url(filename)
         logger.info(f"Saved image to {output_path}.\nURL: {url}")
         return url
 
-    def _call_stability_api(self, prompt: str):
-        headers = {
-            "authorization": f"Bearer {self._api_key}",
-            "accept": "image/*",
-        }
-        data = {
-            "prompt": prompt,
-            "output_format": self._IMG_OUTPUT_FORMAT,
+    def _get_request_args(self, prompt: str) -> dict:
+        return {
+            "headers": {
+                "authorization": f"Bearer {self._api_key}",
+                "accept": "image/*",
+            },
+            "files": {"none": ""},
+            "data": {
+                "prompt": prompt,
+                "output_format": self._IMG_OUTPUT_FORMAT,
+            },
         }
 
-        response = requests.post(
-            self._IMG_GEN_API,
-            headers=headers,
-            files={"none": ""},
-            data=data,
+    def _call_stability_api(self, prompt: str) -> httpx.Response:
+        response = self._get_client().post(
+            self._IMG_GEN_API, **self._get_request_args(prompt)
+        )
+        response.raise_for_status()
+
+        return response
+
+    async def _acall_stability_api(self, prompt: str) -> httpx.Response:
+        response = await self._get_async_client().post(
+            self._IMG_GEN_API, **self._get_request_args(prompt)
         )
         response.raise_for_status()
 
         return response
 
-    def generate_image(self, prompt: str) -> ImageGeneratorToolOutput:
+    def generate_image(
+        self, prompt: str, regenerate: bool = False
+    ) -> ImageGeneratorToolOutput:
         """
         Use this tool to generate an image based on the prompt.
         Args:
             prompt (str): The prompt to generate the image from.
+            regenerate (bool): Generate a new image even if the prompt was used before, e.g. if the user asks for another version.
         """
 
         try:
-            # Call the Stability API
-            response = self._call_stability_api(prompt)
+            image_url = None if regenerate else self._get_cached_image_url(prompt)
+            if image_url is None:
+                # Call the Stability API
+                response = self._call_stability_api(prompt)
+
+                # Save the image and get the URL
+                image_url = self._save_image(response.content, prompt)
+
+            return ImageGeneratorToolOutput(
+                is_success=True,
+                image_url=image_url,
+            )
+        except Exception as e:
+            logger.exception(e, exc_info=True)
+            return ImageGeneratorToolOutput(
+                is_success=False,
+                error_message=str(e),
+            )
 
-            # Save the image and get the URL
-            image_url = self._save_image(response.content)
+    async def agenerate_image(
+        self, prompt: str, regenerate: bool = False
+    ) -> ImageGeneratorToolOutput:
+        """
+        Async version of `generate_image`.
+        """
+        try:
+            image_url = None if regenerate else self._get_cached_image_url(prompt)
+            if image_url is None:
+                response = await self._acall_stability_api(prompt)
+                image_url = await asyncio.to_thread(
+                    self._save_image, response.content, prompt
+                )
 
             return ImageGeneratorToolOutput(
                 is_success=True,
@@ -104,6 +214,41 @@ class ImageGeneratorTool:
                 error_message=str(e),
             )
 
+    def generate_images(self, prompts: List[str]) -> List[ImageGeneratorToolOutput]:
+        """
+        Use this tool to generate several images at once, one for each prompt.
+        Args:
+            prompts (List[str]): The prompts to generate the images from.
+        """
+        if len(prompts) == 0:
+            return []
+        with ThreadPoolExecutor(
+            max_workers=min(self.concurrency, len(prompts))
+        ) as executor:
+            return list(executor.map(self.generate_image, prompts))
+
+    async def agenerate_images(
+        self, prompts: List[str]
+    ) -> List[ImageGeneratorToolOutput]:
+        """
+        Async version of `generate_images`, with at most `concurrency` images generated at the same time.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def generate(prompt: str) -> ImageGeneratorToolOutput:
+            async with semaphore:
+                return await self.agenerate_image(prompt)
+
+        return list(await asyncio.gather(*[generate(prompt) for prompt in prompts]))
+
 
-def get_tools(**kwargs):
-    return [FunctionTool.from_defaults(ImageGeneratorTool(**kwargs).generate_image)]
+def get_tools(context=None, **kwargs):
+    tool = ImageGeneratorTool(**kwargs)
+    return [
+        FunctionTool.from_defaults(
+            fn=tool.generate_image, async_fn=tool.agenerate_image
+        ),
+        FunctionTool.from_defaults(
+            fn=tool.generate_images, async_fn=tool.agenerate_images
+        ),
+    ]
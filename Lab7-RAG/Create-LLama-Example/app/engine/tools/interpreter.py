@@ -1,17 +1,34 @@
 import base64
+import hashlib
 import logging
 import os
+import threading
 import uuid
-from typing import List, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional, Tuple
 
+from cachetools import LRUCache
+
+from app.engine.tools import ToolContext
+from app.engine.tools.sandbox import SandboxSession, get_sandbox_pool
 from app.services.file import DocumentFile, FileService
-from e2b_code_interpreter import Sandbox
 from e2b_code_interpreter.models import Logs
 from llama_index.core.tools import FunctionTool
 from pydantic import BaseModel
 
 logger = logging.getLogger("uvicorn")
 
+# Output formats that are saved to files, the binary ones are base64 encoded
+BINARY_FORMATS = {"png", "jpeg", "pdf"}
+FILE_FORMATS = BINARY_FORMATS | {"svg"}
+# Textual outputs longer than this are saved to a file and the LLM only gets a preview
+MAX_TEXT_OUTPUT_CHARS = int(os.getenv("INTERPRETER_MAX_TEXT_OUTPUT_CHARS", "4000"))
+
+_output_writer = ThreadPoolExecutor(max_workers=4, thread_name_prefix="interpreter-output")
+# The saved output files by content hash and format
+_saved_files: LRUCache = LRUCache(maxsize=1024)
+_saved_files_lock = threading.Lock()
+
 
 class InterpreterExtraResult(BaseModel):
     type: str
@@ -32,11 +49,19 @@ class E2BCodeInterpreter:
     output_dir = "output/tools"
     uploaded_files_dir = "output/uploaded"
 
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        backend: Optional[str] = None,
+        owner: Optional[str] = None,
+    ):
         if api_key is None:
             api_key = os.getenv("E2B_API_KEY")
+        if backend is None:
+            # CODE_INTERPRETER_BACKEND=local runs the code in a local Jupyter kernel (no isolation)
+            backend = os.getenv("CODE_INTERPRETER_BACKEND", "e2b")
         filesever_url_prefix = os.getenv("FILESERVER_URL_PREFIX")
-        if not api_key:
+        if backend == "e2b" and not api_key:
             raise ValueError(
                 "E2B_API_KEY key is required to run code interpreter. Get it here: https://e2b.dev/docs/getting-started/api-key"
             )
@@ -46,85 +71,126 @@ class E2BCodeInterpreter:
             )
 
         self.filesever_url_prefix = filesever_url_prefix
-        self.interpreter = None
+        self.interpreter: Optional[SandboxSession] = None
         self.api_key = api_key
+        # The user or session whose released sandbox can be reused, None to never reuse it
+        self.owner = owner
+        self.pool = get_sandbox_pool(backend, api_key)
 
     def __del__(self):
         """
-        Kill the interpreter when the tool is no longer in use
+        Return the interpreter to the pool when the tool is no longer in use
         """
         if self.interpreter is not None:
-            self.interpreter.kill()
+            self.pool.release(self.interpreter, self.owner)
+            self.interpreter = None
 
     def _init_interpreter(self, sandbox_files: List[str] = []):
         """
-        Lazily initialize the interpreter.
+        Lazily take a warm interpreter from the pool and sync the files to it.
+        """
+        if self.interpreter is not None and not self._keep_alive(self.interpreter):
+            # The sandbox stopped between two calls, the variables of the previous calls are lost
+            logger.warning("Sandbox is not running anymore, starting a new one")
+            self.pool.release(self.interpreter)
+            self.interpreter = None
+        if self.interpreter is None:
+            self.interpreter = self.pool.acquire(self.owner)
+        files = [
+            (
+                file_path,
+                os.path.join(self.uploaded_files_dir, os.path.basename(file_path)),
+            )
+            for file_path in sandbox_files
+        ]
+        uploaded = self.interpreter.sync_files(files)
+        if uploaded > 0:
+            logger.info(f"Uploaded {uploaded} files to sandbox")
+
+    def _keep_alive(self, session: SandboxSession) -> bool:
+        try:
+            session.keep_alive(self.pool.session_timeout)
+            return session.is_alive()
+        except Exception:
+            return False
+
+    def _save_to_disk(self, data: str, ext: str) -> DocumentFile:
+        """
+        Save an output to a file, once per content: identical outputs return the saved file.
+        Binary outputs (e.g. png) are base64 encoded, textual outputs (e.g. svg) are saved as they are.
         """
-        logger.info(f"Initializing interpreter with {len(sandbox_files)} files")
-        self.interpreter = Sandbox(api_key=self.api_key)
-        if len(sandbox_files) > 0:
-            for file_path in sandbox_files:
-                file_name = os.path.basename(file_path)
-                local_file_path = os.path.join(self.uploaded_files_dir, file_name)
-                with open(local_file_path, "rb") as f:
-                    content = f.read()
-                    if self.interpreter and self.interpreter.files:
-                        self.interpreter.files.write(file_path, content)
-            logger.info(f"Uploaded {len(sandbox_files)} files to sandbox")
-
-    def _save_to_disk(self, base64_data: str, ext: str) -> DocumentFile:
-        buffer = base64.b64decode(base64_data)
+        content = base64.b64decode(data) if ext in BINARY_FORMATS else data.encode()
+        content_hash = hashlib.sha256(content).hexdigest()
+        with _saved_files_lock:
+            document_file = _saved_files.get((content_hash, ext))
+        if document_file is not None and os.path.exists(document_file.path):
+            return document_file
 
         # Output from e2b doesn't have a name. Create a random name for it.
         filename = f"e2b_file_{uuid.uuid4()}.{ext}"
 
         document_file = FileService.save_file(
-            buffer, file_name=filename, save_dir=self.output_dir
+            content, file_name=filename, save_dir=self.output_dir
         )
+        with _saved_files_lock:
+            _saved_files[(content_hash, ext)] = document_file
 
         return document_file
 
-    def _parse_result(self, result) -> List[InterpreterExtraResult]:
+    def _parse_results(self, results: List[Any]) -> List[InterpreterExtraResult]:
         """
-        The result could include multiple formats (e.g. png, svg, etc.) but encoded in base64
-        We save each result to disk and return saved file metadata (extension, filename, url)
+        Each result could include multiple formats (e.g. png, svg, etc.), binary ones encoded in base64.
+        File outputs are saved to disk in a thread pool and returned as file metadata (extension, filename, url).
+        Large textual outputs are saved to a file too, and only a preview is returned.
         """
-        if not result:
-            return []
+        # The parsed outputs, or the pending file writes with the preview of a textual output
+        parsed: List[InterpreterExtraResult | Tuple[str, Optional[str], Future]] = []
+        for result in results:
+            try:
+                formats = result.formats()
+            except Exception as error:
+                logger.exception(error, exc_info=True)
+                logger.error("Error when parsing output from E2b interpreter tool")
+                continue
+            for ext in formats:
+                data = result[ext]
+                if ext in FILE_FORMATS:
+                    future = _output_writer.submit(self._save_to_disk, data, ext)
+                    parsed.append((ext, None, future))
+                    continue
+                # Try serialize data to string
+                try:
+                    data = str(data)
+                except Exception as e:
+                    data = f"Error when serializing data: {e}"
+                if len(data) > MAX_TEXT_OUTPUT_CHARS:
+                    future = _output_writer.submit(self._save_to_disk, data, "txt")
+                    parsed.append((ext, data[:MAX_TEXT_OUTPUT_CHARS], future))
+                else:
+                    parsed.append(InterpreterExtraResult(type=ext, content=data))
 
         output = []
-
-        try:
-            formats = result.formats()
-            results = [result[format] for format in formats]
-
-            for ext, data in zip(formats, results):
-                match ext:
-                    case "png" | "svg" | "jpeg" | "pdf":
-                        document_file = self._save_to_disk(data, ext)
-                        output.append(
-                            InterpreterExtraResult(
-                                type=ext,
-                                filename=document_file.name,
-                                url=document_file.url,
-                            )
-                        )
-                    case _:
-                        # Try serialize data to string
-                        try:
-                            data = str(data)
-                        except Exception as e:
-                            data = f"Error when serializing data: {e}"
-                        output.append(
-                            InterpreterExtraResult(
-                                type=ext,
-                                content=data,
-                            )
-                        )
-        except Exception as error:
-            logger.exception(error, exc_info=True)
-            logger.error("Error when parsing output from E2b interpreter tool", error)
-
+        for item in parsed:
+            if isinstance(item, InterpreterExtraResult):
+                output.append(item)
+                continue
+            ext, preview, future = item
+            try:
+                document_file = future.result()
+            except Exception as error:
+                logger.exception(error, exc_info=True)
+                logger.error("Error when saving output from E2b interpreter tool")
+                continue
+            if preview is not None:
+                preview += f"\n... (output truncated, the full output is in {document_file.name})"
+            output.append(
+                InterpreterExtraResult(
+                    type=ext,
+                    content=preview,
+                    filename=document_file.name,
+                    url=document_file.url,
+                )
+            )
         return output
 
     def interpret(
@@ -156,8 +222,7 @@ class E2BCodeInterpreter:
                 retry_count=retry_count,
             )
 
-        if self.interpreter is None:
-            self._init_interpreter(sandbox_files)
+        self._init_interpreter(sandbox_files)
 
         if self.interpreter:
             logger.info(
@@ -168,12 +233,12 @@ class E2BCodeInterpreter:
             if exec.error:
                 error_message = f"The code failed to execute successfully. Error: {exec.error}. Try to fix the code and run again."
                 logger.error(error_message)
-                # Calling the generated code caused an error. Kill the interpreter and return the error to the LLM so it can try to fix the error
+                # Calling the generated code caused an error. Reset the interpreter state (instead of
+                # starting a new sandbox) and return the error to the LLM so it can try to fix the error
                 try:
-                    self.interpreter.kill()  # type: ignore
+                    self.interpreter.reset()
                 except Exception:
-                    pass
-                finally:
+                    self.pool.release(self.interpreter, self.owner)
                     self.interpreter = None
                 output = E2BToolOutput(
                     is_error=True,
@@ -186,7 +251,7 @@ class E2BCodeInterpreter:
                 if len(exec.results) == 0:
                     output = E2BToolOutput(is_error=False, logs=exec.logs, results=[])
                 else:
-                    results = self._parse_result(exec.results[0])
+                    results = self._parse_results(exec.results)
                     output = E2BToolOutput(
                         is_error=False,
                         logs=exec.logs,
@@ -198,5 +263,12 @@ class E2BCodeInterpreter:
             raise ValueError("Interpreter is not initialized.")
 
 
-def get_tools(**kwargs):
-    return [FunctionTool.from_defaults(E2BCodeInterpreter(**kwargs).interpret)]
+def get_tools(context: Optional[ToolContext] = None, **kwargs):
+    from app.engine.index import DEFAULT_OWNER, get_private_owner
+
+    # Requests without a user or session id share the default owner, their sandboxes are not reused
+    owner = get_private_owner(context.params if context is not None else None)
+    interpreter = E2BCodeInterpreter(
+        owner=owner if owner != DEFAULT_OWNER else None, **kwargs
+    )
+    return [FunctionTool.from_defaults(interpreter.interpret)]
@@ -1,40 +1,305 @@
-from typing import Dict, List, Tuple
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 from llama_index.tools.openapi import OpenAPIToolSpec
 from llama_index.tools.requests import RequestsToolSpec
+from pydantic import BaseModel, PrivateAttr
+
+logger = logging.getLogger("uvicorn")
+
+HTTP_METHODS = ["get", "put", "post", "delete", "options", "head", "patch", "trace"]
+# The operation indexes of remote specs, the indexes of local specs are saved next to them
+OPENAPI_INDEX_DIR = os.path.join(os.getenv("STORAGE_DIR", "storage"), "openapi")
+# Nested $refs are resolved up to this depth, deeper (or recursive) schemas are kept as refs
+MAX_REF_DEPTH = 4
+
+
+class OpenAPIOperation(BaseModel):
+    operation_id: str
+    method: str
+    path: str
+    summary: str = ""
+    parameters: List[Dict[str, Any]] = []
+    request_body: Optional[Dict[str, Any]] = None
+
+    def to_summary(self, base_url: str) -> Dict[str, str]:
+        return {
+            "operation_id": self.operation_id,
+            "method": self.method.upper(),
+            "url": f"{base_url}{self.path}",
+            "summary": self.summary,
+        }
+
+
+class OpenAPIOperationIndex(BaseModel):
+    """
+    The operations of an OpenAPI spec, with the version of the spec they were parsed from
+    (the file modification time or the ETag of the response).
+    """
+
+    uri: str
+    version: Dict[str, Any]
+    servers: List[str]
+    base_url: str = ""
+    operations: List[OpenAPIOperation]
+
+    _terms: Optional[List[set]] = PrivateAttr(default=None)
+
+    def search(self, query: str, top_k: int = 5) -> List[OpenAPIOperation]:
+        """
+        Find the operations matching the most query terms in their path, id, summary and parameter names.
+        The HTTP method isn't searched, words like "get" would match every operation of the method.
+        """
+        from app.engine.bm25 import tokenize
+
+        if self._terms is None:
+            self._terms = [
+                set(
+                    tokenize(
+                        " ".join(
+                            [
+                                operation.path,
+                                operation.operation_id,
+                                operation.summary,
+                                *(str(p.get("name", "")) for p in operation.parameters),
+                            ]
+                        )
+                    )
+                )
+                for operation in self.operations
+            ]
+        query_terms = set(tokenize(query))
+        scored = [
+            (len(query_terms & terms), i)
+            for i, terms in enumerate(self._terms)
+            if len(query_terms & terms) > 0
+        ]
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [self.operations[i] for _, i in scored[:top_k]]
+
+    def get(self, operation_id: str) -> Optional[OpenAPIOperation]:
+        for operation in self.operations:
+            if operation.operation_id == operation_id:
+                return operation
+        return None
+
+    @classmethod
+    def from_spec(
+        cls, uri: str, version: Dict[str, Any], spec: Dict, servers: List[str]
+    ) -> "OpenAPIOperationIndex":
+        operations = []
+        for path, path_item in spec.get("paths", {}).items():
+            path_item = _resolve_refs(path_item, spec)
+            for method in HTTP_METHODS:
+                operation = path_item.get(method)
+                if operation is None:
+                    continue
+                parameters = [*path_item.get("parameters", []), *operation.get("parameters", [])]
+                request_body = operation.get("requestBody")
+                if request_body is not None:
+                    # Only the schema of the JSON body is needed to make a request
+                    request_body = (
+                        request_body.get("content", {})
+                        .get("application/json", {})
+                        .get("schema", request_body)
+                    )
+                operations.append(
+                    OpenAPIOperation(
+                        operation_id=operation.get("operationId", f"{method} {path}"),
+                        method=method,
+                        path=path,
+                        summary=operation.get("summary") or operation.get("description", ""),
+                        parameters=parameters,
+                        request_body=request_body,
+                    )
+                )
+        spec_servers = spec.get("servers", [])
+        return cls(
+            uri=uri,
+            version=version,
+            servers=servers,
+            base_url=spec_servers[0]["url"].rstrip("/") if len(spec_servers) > 0 else "",
+            operations=operations,
+        )
+
+
+def _resolve_refs(value: Any, spec: Dict, depth: int = 0) -> Any:
+    if isinstance(value, list):
+        return [_resolve_refs(item, spec, depth) for item in value]
+    if not isinstance(value, dict):
+        return value
+    ref = value.get("$ref")
+    if isinstance(ref, str) and ref.startswith("#/"):
+        if depth >= MAX_REF_DEPTH:
+            return value
+        target: Any = spec
+        for part in ref[2:].split("/"):
+            target = target.get(part, {}) if isinstance(target, dict) else {}
+        return _resolve_refs(target, spec, depth + 1)
+    return {key: _resolve_refs(item, spec, depth) for key, item in value.items()}
 
 
 class OpenAPIActionToolSpec(OpenAPIToolSpec, RequestsToolSpec):
     """
     A combination of OpenAPI and Requests tool specs that can parse OpenAPI specs and make requests.
 
+    Instead of the whole spec, the agent searches an index of the operations and only gets
+    the details of the operations it needs. The index is saved next to the spec and rebuilt
+    when the spec changes (by file modification time or ETag).
+
     openapi_uri: str: The file path or URL to the OpenAPI spec.
     domain_headers: dict: Whitelist domains and the headers to use.
     """
 
-    spec_functions = OpenAPIToolSpec.spec_functions + RequestsToolSpec.spec_functions
-    # Cached parsed specs by URI
-    _specs: Dict[str, Tuple[Dict, List[str]]] = {}
+    spec_functions = [
+        "search_operations",
+        "get_operation",
+    ] + RequestsToolSpec.spec_functions
+    # Cached operation indexes by URI, with the time they were last validated
+    _indexes: Dict[str, Tuple[OpenAPIOperationIndex, float]] = {}
+    _indexes_lock = threading.Lock()
 
     def __init__(self, openapi_uri: str, domain_headers: dict = None, **kwargs):
         if domain_headers is None:
             domain_headers = {}
-        if openapi_uri not in self._specs:
-            openapi_spec, servers = self._load_openapi_spec(openapi_uri)
-            self._specs[openapi_uri] = (openapi_spec, servers)
-        else:
-            openapi_spec, servers = self._specs[openapi_uri]
+        self._openapi_uri = openapi_uri
+        self._index = self._get_operation_index(openapi_uri)
 
         # Add the servers to the domain headers if they are not already present
-        for server in servers:
+        for server in self._index.servers:
             if server not in domain_headers:
                 domain_headers[server] = {}
 
-        OpenAPIToolSpec.__init__(self, spec=openapi_spec)
         RequestsToolSpec.__init__(self, domain_headers)
 
+    def search_operations(self, query: str, top_k: int = 5) -> List[Dict[str, str]]:
+        """
+        Use this tool to find the API operations that can be used for a task.
+        Call `get_operation` with the operation id to get its parameters before making a request.
+
+        Args:
+            query (str): Keywords describing what the operation should do, e.g. "list pets by status".
+            top_k (int): The maximum number of operations to return. Default is 5.
+        """
+        return [
+            operation.to_summary(self._index.base_url)
+            for operation in self._index.search(query, top_k)
+        ]
+
+    def get_operation(self, operation_id: str) -> Dict[str, Any]:
+        """
+        Use this tool to get the URL, parameters and request body schema of an API operation.
+
+        Args:
+            operation_id (str): The id of the operation, as returned by `search_operations`.
+        """
+        operation = self._index.get(operation_id)
+        if operation is None:
+            return {"error": f"Operation {operation_id} not found"}
+        return {
+            **operation.to_summary(self._index.base_url),
+            "parameters": operation.parameters,
+            "request_body": operation.request_body,
+        }
+
+    def load_openapi_spec(self):
+        # The whole spec is only processed if it's requested directly, it's not exposed as a tool
+        from llama_index.core import Document
+
+        spec, _, _ = self._load_openapi_spec(self._openapi_uri)
+        return [Document(text=str(self.process_api_spec(spec)))]
+
+    @classmethod
+    def _get_operation_index(cls, uri: str) -> OpenAPIOperationIndex:
+        """
+        Get the operation index of a spec from memory or disk, and rebuild it if the spec has changed.
+        """
+        revalidate_interval = float(os.getenv("OPENAPI_REVALIDATE_INTERVAL", "300"))
+        with cls._indexes_lock:
+            cached = cls._indexes.get(uri)
+        if cached is not None and time.monotonic() - cached[1] < revalidate_interval:
+            return cached[0]
+
+        index_path = cls._get_index_path(uri)
+        index = cached[0] if cached is not None else cls._read_index(index_path)
+        if index is None or not cls._is_index_valid(index):
+            logger.info(f"Building the operation index of the OpenAPI spec {uri}")
+            spec, servers, version = cls._load_openapi_spec(uri)
+            index = OpenAPIOperationIndex.from_spec(uri, version, spec, servers)
+            cls._write_index(index_path, index)
+        with cls._indexes_lock:
+            cls._indexes[uri] = (index, time.monotonic())
+        return index
+
+    @staticmethod
+    def _get_index_path(uri: str) -> str:
+        from urllib.parse import urlparse
+
+        if uri.startswith("file"):
+            return f"{urlparse(uri).path}.index.json"
+        uri_hash = hashlib.sha1(uri.encode("utf-8")).hexdigest()
+        return os.path.join(OPENAPI_INDEX_DIR, f"{uri_hash}.index.json")
+
+    @staticmethod
+    def _read_index(index_path: str) -> Optional[OpenAPIOperationIndex]:
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, "r") as f:
+                return OpenAPIOperationIndex.model_validate(json.load(f))
+        except Exception as e:
+            logger.warning(f"Failed to read the OpenAPI operation index {index_path}: {e}")
+            return None
+
+    @staticmethod
+    def _write_index(index_path: str, index: OpenAPIOperationIndex) -> None:
+        try:
+            os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+            tmp_path = f"{index_path}.part"
+            with open(tmp_path, "w") as f:
+                json.dump(index.model_dump(), f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            # The index still works from memory, e.g. next to a read-only spec
+            logger.warning(f"Failed to save the OpenAPI operation index {index_path}: {e}")
+
+    @staticmethod
+    def _is_index_valid(index: OpenAPIOperationIndex) -> bool:
+        from urllib.parse import urlparse
+
+        if index.uri.startswith("file"):
+            filepath = urlparse(index.uri).path
+            if not os.path.exists(filepath):
+                return False
+            stat = os.stat(filepath)
+            return index.version == {"mtime": stat.st_mtime, "size": stat.st_size}
+
+        import requests  # type: ignore
+
+        # Ask the server if the spec has changed, without downloading it again
+        headers = {}
+        if index.version.get("etag"):
+            headers["If-None-Match"] = index.version["etag"]
+        if index.version.get("last_modified"):
+            headers["If-Modified-Since"] = index.version["last_modified"]
+        if len(headers) == 0:
+            return False
+        try:
+            response = requests.head(
+                index.uri, headers=headers, timeout=10, allow_redirects=True
+            )
+        except requests.RequestException as e:
+            logger.warning(f"Failed to validate the OpenAPI spec {index.uri}: {e}")
+            return True
+        return response.status_code == 304
+
     @staticmethod
-    def _load_openapi_spec(uri: str) -> Tuple[Dict, List[str]]:
+    def _load_openapi_spec(uri: str) -> Tuple[Dict, List[str], Dict[str, Any]]:
         """
         Load an OpenAPI spec from a URI.
 
@@ -42,7 +307,7 @@ class OpenAPIActionToolSpec(OpenAPIToolSpec, RequestsToolSpec):
             uri (str): A file path or URL to the OpenAPI spec.
 
         Returns:
-            List[Document]: A list of Document objects.
+            The spec, the domains of its servers and the version of the spec (file modification time or ETag).
         """
         from urllib.parse import urlparse
 
@@ -58,10 +323,16 @@ class OpenAPIActionToolSpec(OpenAPIToolSpec, RequestsToolSpec):
                     f"Failed to load OpenAPI spec from {uri}, status code: {response.status_code}"
                 )
             spec = yaml.safe_load(response.text)
+            version: Dict[str, Any] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
         elif uri.startswith("file"):
             filepath = urlparse(uri).path
+            stat = os.stat(filepath)
             with open(filepath, "r") as file:
                 spec = yaml.safe_load(file)
+            version = {"mtime": stat.st_mtime, "size": stat.st_size}
         else:
             raise ValueError(
                 "Could not initialize OpenAPIActionToolSpec: Invalid OpenAPI URI provided. "
@@ -77,4 +348,4 @@ class OpenAPIActionToolSpec(OpenAPIToolSpec, RequestsToolSpec):
                 "Could not initialize OpenAPIActionToolSpec: Invalid OpenAPI spec provided. "
                 "Could not get `servers` from the spec."
             ) from e
-        return spec, servers
+        return spec, servers, version
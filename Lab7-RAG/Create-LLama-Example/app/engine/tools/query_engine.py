@@ -1,23 +1,46 @@
+import asyncio
 import os
-from typing import Any, Dict, List, Optional, Sequence
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Union
 
 from llama_index.core import get_response_synthesizer
 from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.llms.types import ImageBlock
 from llama_index.core.base.response.schema import RESPONSE_TYPE, Response
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.indices import VectorStoreIndex
 from llama_index.core.multi_modal_llms import MultiModalLLM
 from llama_index.core.prompts.base import BasePromptTemplate
 from llama_index.core.prompts.default_prompt_selectors import (
     DEFAULT_TEXT_QA_PROMPT_SEL,
 )
+from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.query_engine.multi_modal import _get_image_and_text_nodes
+from llama_index.core.response_synthesizers import ResponseMode
 from llama_index.core.response_synthesizers.base import BaseSynthesizer, QueryTextType
 from llama_index.core.schema import (
     ImageNode,
+    MetadataMode,
     NodeWithScore,
 )
+from llama_index.core.settings import Settings
 from llama_index.core.tools.query_engine import QueryEngineTool
 from llama_index.core.types import RESPONSE_TEXT_TYPE
 
+from app.engine.context import (
+    count_tokens,
+    get_context_packer,
+    get_context_token_budget,
+)
+from app.engine.images import estimate_image_tokens, prepare_image_nodes
+from app.engine.ingestion import StageTimer
+from app.engine.query_decomposition import (
+    DecomposingQueryEngine,
+    is_query_decomposition_enabled,
+)
+from app.engine.rerank import get_reranker
+from app.engine.retriever import create_retriever
 from app.settings import get_multi_modal_llm
 
 
@@ -27,8 +50,10 @@ def create_query_engine(index, **kwargs) -> BaseQueryEngine:
 
     Args:
         index: The index to create a query engine for.
+        private_index (optional): The index with the private uploads of the user, queried together with the index.
         params (optional): Additional parameters for the query engine, e.g: similarity_top_k
     """
+    private_index = kwargs.pop("private_index", None)
 
     top_k = int(os.getenv("TOP_K", 0))
     if top_k != 0 and kwargs.get("filters") is None:
@@ -39,6 +64,27 @@ def create_query_engine(index, **kwargs) -> BaseQueryEngine:
             multimodal_model=multimodal_llm,
         )
 
+    # Retrieve more candidates and keep the best ones after reranking
+    reranker = get_reranker(
+        top_n=kwargs.get("similarity_top_k", DEFAULT_SIMILARITY_TOP_K)
+    )
+    if reranker is not None:
+        kwargs["similarity_top_k"] = max(
+            reranker.top_n, int(os.getenv("RERANK_CANDIDATES", "20"))
+        )
+        kwargs["node_postprocessors"] = [
+            *kwargs.get("node_postprocessors", []),
+            reranker,
+        ]
+
+    # Pack the context into a token budget so it's answered in a single call
+    context_packer = get_context_packer()
+    if context_packer is not None:
+        kwargs["node_postprocessors"] = [
+            *kwargs.get("node_postprocessors", []),
+            context_packer,
+        ]
+
     # If index is index is LlamaCloudIndex
     # use auto_routed mode for better query results
     if index.__class__.__name__ == "LlamaCloudIndex":
@@ -46,6 +92,27 @@ def create_query_engine(index, **kwargs) -> BaseQueryEngine:
             kwargs["retrieval_mode"] = "auto_routed"
         if multimodal_llm:
             kwargs["retrieve_image_nodes"] = True
+    if isinstance(index, VectorStoreIndex) and (
+        private_index is not None
+        or kwargs.get("filters") is not None
+        or os.getenv("RETRIEVAL_MODE", "dense") == "hybrid"
+        or is_query_decomposition_enabled()
+    ):
+        similarity_top_k = kwargs.pop("similarity_top_k", DEFAULT_SIMILARITY_TOP_K)
+        retriever = create_retriever(
+            index,
+            filters=kwargs.pop("filters", None),
+            similarity_top_k=similarity_top_k,
+            private_index=private_index,
+        )
+        if is_query_decomposition_enabled():
+            return DecomposingQueryEngine.from_args(
+                retriever,
+                llm=Settings.llm,
+                similarity_top_k=similarity_top_k,
+                **kwargs,
+            )
+        return RetrieverQueryEngine.from_args(retriever, llm=Settings.llm, **kwargs)
     return index.as_query_engine(**kwargs)
 
 
@@ -69,6 +136,11 @@ def get_query_engine_tool(
         description = (
             "Use this tool to retrieve information about the text corpus from an index."
         )
+        if is_query_decomposition_enabled():
+            description += (
+                " Ask compound or comparison questions in a single call,"
+                " all their parts are searched at the same time."
+            )
     query_engine = create_query_engine(index, **kwargs)
     return QueryEngineTool.from_defaults(
         query_engine=query_engine,
@@ -79,7 +151,12 @@ def get_query_engine_tool(
 
 class MultiModalSynthesizer(BaseSynthesizer):
     """
-    A synthesizer that summarizes text nodes and uses a multi-modal LLM to generate a response.
+    A synthesizer that uses a multi-modal LLM to generate a response from text and image nodes.
+
+    If the text nodes and the images fit the token budget of the multi-modal model,
+    they are sent together in a single call.
+    Otherwise the text nodes are summarized first, while the images are preprocessed concurrently.
+    MULTIMODAL_SYNTHESIS=packed|summarize forces one of the two modes.
     """
 
     def __init__(
@@ -87,13 +164,20 @@ class MultiModalSynthesizer(BaseSynthesizer):
         multimodal_model: MultiModalLLM,
         response_synthesizer: Optional[BaseSynthesizer] = None,
         text_qa_template: Optional[BasePromptTemplate] = None,
+        text_token_budget: Optional[int] = None,
         *args,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
         self._multi_modal_llm = multimodal_model
-        self._response_synthesizer = response_synthesizer or get_response_synthesizer()
+        # The packed context fits a single compact call
+        self._response_synthesizer = response_synthesizer or get_response_synthesizer(
+            response_mode=ResponseMode.COMPACT
+        )
         self._text_qa_template = text_qa_template or DEFAULT_TEXT_QA_PROMPT_SEL
+        self._text_token_budget = text_token_budget or get_context_token_budget(
+            multimodal_model.metadata
+        )
 
     def _get_prompts(self, **kwargs) -> Dict[str, Any]:
         return {
@@ -121,34 +205,42 @@ class MultiModalSynthesizer(BaseSynthesizer):
         additional_source_nodes: Optional[Sequence[NodeWithScore]] = None,
         **response_kwargs: Any,
     ) -> RESPONSE_TYPE:
+        start = time.perf_counter()
         image_nodes, text_nodes = _get_image_and_text_nodes(nodes)
 
         if len(image_nodes) == 0:
             return await self._response_synthesizer.asynthesize(query, text_nodes)
 
-        # Summarize the text nodes to avoid exceeding the token limit
-        text_response = str(
-            await self._response_synthesizer.asynthesize(query, text_nodes)
-        )
+        timer = StageTimer()
+        images_task = asyncio.to_thread(self._prepare_images, image_nodes, timer)
+        if self._should_pack(text_nodes, len(image_nodes)):
+            mode = "packed"
+            context_str = self._get_context_str(text_nodes)
+            images = await images_task
+        else:
+            mode = "summarize"
+
+            async def summarize() -> str:
+                # Summarize the text nodes to avoid exceeding the token limit
+                with timer.stage("text"):
+                    return str(
+                        await self._response_synthesizer.asynthesize(query, text_nodes)
+                    )
+
+            context_str, images = await asyncio.gather(summarize(), images_task)
 
         fmt_prompt = self._text_qa_template.format(
-            context_str=text_response,
+            context_str=context_str,
             query_str=query.query_str,  # type: ignore
         )
+        with timer.stage("llm"):
+            llm_response = await self._multi_modal_llm.acomplete(
+                prompt=fmt_prompt,
+                image_documents=images,
+            )
 
-        llm_response = await self._multi_modal_llm.acomplete(
-            prompt=fmt_prompt,
-            image_documents=[
-                image_node.node
-                for image_node in image_nodes
-                if isinstance(image_node.node, ImageNode)
-            ],
-        )
-
-        return Response(
-            response=str(llm_response),
-            source_nodes=nodes,
-            metadata={"text_nodes": text_nodes, "image_nodes": image_nodes},
+        return self._create_response(
+            llm_response, nodes, text_nodes, image_nodes, mode, timer, start
         )
 
     def synthesize(
@@ -158,30 +250,91 @@ class MultiModalSynthesizer(BaseSynthesizer):
         additional_source_nodes: Optional[Sequence[NodeWithScore]] = None,
         **response_kwargs: Any,
     ) -> RESPONSE_TYPE:
+        start = time.perf_counter()
         image_nodes, text_nodes = _get_image_and_text_nodes(nodes)
 
         if len(image_nodes) == 0:
             return self._response_synthesizer.synthesize(query, text_nodes)
 
-        # Summarize the text nodes to avoid exceeding the token limit
-        text_response = str(self._response_synthesizer.synthesize(query, text_nodes))
+        timer = StageTimer()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            images_future = executor.submit(self._prepare_images, image_nodes, timer)
+            if self._should_pack(text_nodes, len(image_nodes)):
+                mode = "packed"
+                context_str = self._get_context_str(text_nodes)
+            else:
+                mode = "summarize"
+                # Summarize the text nodes to avoid exceeding the token limit
+                with timer.stage("text"):
+                    context_str = str(
+                        self._response_synthesizer.synthesize(query, text_nodes)
+                    )
+            images = images_future.result()
 
         fmt_prompt = self._text_qa_template.format(
-            context_str=text_response,
+            context_str=context_str,
             query_str=query.query_str,  # type: ignore
         )
+        with timer.stage("llm"):
+            llm_response = self._multi_modal_llm.complete(
+                prompt=fmt_prompt,
+                image_documents=images,
+            )
 
-        llm_response = self._multi_modal_llm.complete(
-            prompt=fmt_prompt,
-            image_documents=[
-                image_node.node
-                for image_node in image_nodes
-                if isinstance(image_node.node, ImageNode)
-            ],
+        return self._create_response(
+            llm_response, nodes, text_nodes, image_nodes, mode, timer, start
         )
 
+    def _should_pack(self, text_nodes: List[NodeWithScore], image_count: int) -> bool:
+        mode = os.getenv("MULTIMODAL_SYNTHESIS", "auto")
+        if mode != "auto":
+            return mode == "packed"
+        tokens = sum(
+            count_tokens(node.node.get_content(metadata_mode=MetadataMode.LLM))
+            for node in text_nodes
+        )
+        # The images are sent in the same call and take up part of the context window
+        tokens += image_count * estimate_image_tokens()
+        return tokens <= self._text_token_budget
+
+    @staticmethod
+    def _get_context_str(text_nodes: List[NodeWithScore]) -> str:
+        return "\n\n".join(
+            node.node.get_content(metadata_mode=MetadataMode.LLM) for node in text_nodes
+        )
+
+    @staticmethod
+    def _prepare_images(
+        image_nodes: List[NodeWithScore], timer: StageTimer
+    ) -> List[Union[ImageNode, ImageBlock]]:
+        with timer.stage("images"):
+            return prepare_image_nodes(
+                [
+                    image_node.node
+                    for image_node in image_nodes
+                    if isinstance(image_node.node, ImageNode)
+                ]
+            )
+
+    @staticmethod
+    def _create_response(
+        llm_response: Any,
+        nodes: List[NodeWithScore],
+        text_nodes: List[NodeWithScore],
+        image_nodes: List[NodeWithScore],
+        mode: str,
+        timer: StageTimer,
+        start: float,
+    ) -> Response:
+        timings = dict(timer.timings)
+        timings["total"] = round(time.perf_counter() - start, 4)
         return Response(
             response=str(llm_response),
             source_nodes=nodes,
-            metadata={"text_nodes": text_nodes, "image_nodes": image_nodes},
+            metadata={
+                "text_nodes": text_nodes,
+                "image_nodes": image_nodes,
+                "synthesis_mode": mode,
+                "timings": timings,
+            },
         )
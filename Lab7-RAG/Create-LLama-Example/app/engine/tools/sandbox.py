@@ -0,0 +1,423 @@
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from cachetools import LRUCache
+from e2b_code_interpreter.models import Logs
+
+logger = logging.getLogger("uvicorn")
+
+# Jupyter mime types and the result formats of E2B
+MIME_FORMATS = {
+    "text/plain": "text",
+    "text/html": "html",
+    "text/markdown": "markdown",
+    "image/png": "png",
+    "image/jpeg": "jpeg",
+    "image/svg+xml": "svg",
+    "application/pdf": "pdf",
+    "application/json": "json",
+    "application/javascript": "javascript",
+    "text/latex": "latex",
+}
+
+
+@dataclass
+class LocalResult:
+    """
+    A display result of a local kernel, with the same access as an E2B result.
+    """
+
+    data: Dict[str, Any]
+    is_main_result: bool = False
+
+    def formats(self) -> List[str]:
+        return [MIME_FORMATS[mime] for mime in self.data if mime in MIME_FORMATS]
+
+    def __getitem__(self, key: str) -> Any:
+        for mime, format in MIME_FORMATS.items():
+            if format == key and mime in self.data:
+                return self.data[mime]
+        raise KeyError(key)
+
+
+@dataclass
+class LocalExecutionError:
+    name: str
+    value: str
+    traceback: str
+
+    def __str__(self) -> str:
+        return f"{self.name}: {self.value}"
+
+
+@dataclass
+class LocalExecution:
+    results: List[LocalResult] = field(default_factory=list)
+    logs: Logs = field(default_factory=lambda: Logs(stdout=[], stderr=[]))
+    error: Optional[LocalExecutionError] = None
+
+
+class SandboxSession(ABC):
+    """
+    A running code interpreter session. Files are synced by content hash,
+    so only new or changed files are uploaded to a reused session.
+    """
+
+    def __init__(self):
+        self.last_used = time.monotonic()
+        self._file_hashes: Dict[str, str] = {}
+
+    @abstractmethod
+    def run_code(self, code: str) -> Any: ...
+
+    @abstractmethod
+    def write_file(self, path: str, content: bytes) -> None: ...
+
+    @abstractmethod
+    def is_alive(self) -> bool: ...
+
+    @abstractmethod
+    def kill(self) -> None: ...
+
+    def keep_alive(self, timeout: float) -> None:
+        """
+        Keep the session running for at least `timeout` more seconds.
+        """
+
+    def reset(self) -> None:
+        """
+        Clear the interpreter state (variables, imports) but keep the session and its files.
+        """
+        self.run_code("%reset -f")
+
+    def sync_files(self, files: List[Tuple[str, str]]) -> int:
+        """
+        Upload (sandbox path, local path) files that are missing or changed in the session.
+        Returns the number of uploaded files.
+        """
+        uploaded = 0
+        for sandbox_path, local_path in files:
+            file_hash = _get_file_hash(local_path)
+            if self._file_hashes.get(sandbox_path) == file_hash:
+                continue
+            with open(local_path, "rb") as f:
+                self.write_file(sandbox_path, f.read())
+            self._file_hashes[sandbox_path] = file_hash
+            uploaded += 1
+        return uploaded
+
+
+class E2BSession(SandboxSession):
+    """
+    An E2B sandbox. E2B kills a sandbox when its timeout is over, so the timeout
+    is extended whenever the session is taken from or returned to the pool.
+    """
+
+    def __init__(self, api_key: str, timeout: float = 300):
+        from e2b_code_interpreter import Sandbox
+
+        super().__init__()
+        self._sandbox = Sandbox(api_key=api_key, timeout=int(timeout))
+
+    def run_code(self, code: str) -> Any:
+        return self._sandbox.run_code(code)
+
+    def write_file(self, path: str, content: bytes) -> None:
+        self._sandbox.files.write(path, content)
+
+    def is_alive(self) -> bool:
+        return self._sandbox.is_running()
+
+    def keep_alive(self, timeout: float) -> None:
+        self._sandbox.set_timeout(int(timeout))
+
+    def kill(self) -> None:
+        self._sandbox.kill()
+
+
+class LocalKernelSession(SandboxSession):
+    """
+    A local Jupyter kernel in a subprocess, as a stand-in for E2B in development and benchmarks.
+    The code runs on this machine without isolation. Requires the `jupyter_client` and `ipykernel` packages.
+    """
+
+    def __init__(self, timeout: float = 60):
+        try:
+            from jupyter_client.manager import KernelManager
+        except ImportError as e:
+            raise ImportError(
+                "jupyter_client and ipykernel are required for the local code interpreter backend"
+            ) from e
+
+        super().__init__()
+        self._timeout = timeout
+        self._root = tempfile.mkdtemp(prefix="sandbox_")
+        self._manager = KernelManager()
+        self._manager.start_kernel(cwd=self._root)
+        self._client = self._manager.client()
+        self._client.start_channels()
+        self._client.wait_for_ready(timeout=timeout)
+
+    def run_code(self, code: str) -> LocalExecution:
+        msg_id = self._client.execute(code)
+        execution = LocalExecution()
+        while True:
+            msg = self._client.get_iopub_msg(timeout=self._timeout)
+            if msg["parent_header"].get("msg_id") != msg_id:
+                continue
+            msg_type, content = msg["msg_type"], msg["content"]
+            if msg_type == "stream":
+                if content["name"] == "stdout":
+                    execution.logs.stdout.append(content["text"])
+                else:
+                    execution.logs.stderr.append(content["text"])
+            elif msg_type in ("execute_result", "display_data"):
+                execution.results.append(
+                    LocalResult(
+                        data=content["data"],
+                        is_main_result=msg_type == "execute_result",
+                    )
+                )
+            elif msg_type == "error":
+                execution.error = LocalExecutionError(
+                    name=content["ename"],
+                    value=content["evalue"],
+                    traceback="\n".join(content["traceback"]),
+                )
+            elif msg_type == "status" and content["execution_state"] == "idle":
+                return execution
+
+    def write_file(self, path: str, content: bytes) -> None:
+        path = self._local_path(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def is_alive(self) -> bool:
+        return self._manager.is_alive()
+
+    def _local_path(self, path: str) -> str:
+        # Sandbox paths are in /tmp, other absolute paths are mapped into the session directory
+        if os.path.abspath(path).startswith(tempfile.gettempdir()):
+            return path
+        return os.path.join(self._root, path.lstrip("/"))
+
+    def kill(self) -> None:
+        try:
+            self._client.stop_channels()
+            self._manager.shutdown_kernel(now=True)
+        finally:
+            shutil.rmtree(self._root, ignore_errors=True)
+
+
+class SandboxPool:
+    """
+    Keep pre-warmed interpreter sessions, so a tool call doesn't pay for starting a sandbox.
+
+    A session is only reused by the owner (user or session) that released it, since the code
+    of a chat can leave files, installed packages and processes behind. Sessions without an owner
+    are killed when they are released. Idle sessions are killed after `idle_timeout` seconds,
+    and the pool is refilled up to `size` unused warm sessions in the background.
+    """
+
+    def __init__(
+        self,
+        backend: str = "e2b",
+        api_key: Optional[str] = None,
+        size: int = 1,
+        idle_timeout: float = 240,
+        session_timeout: float = 600,
+    ):
+        if backend not in ("e2b", "local"):
+            raise ValueError(f"Invalid code interpreter backend: {backend}")
+        self.backend = backend
+        self.api_key = api_key
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # How long an acquired session is kept running after its last use
+        self.session_timeout = session_timeout
+        self._idle: "queue.LifoQueue[SandboxSession]" = queue.LifoQueue()
+        # The released sessions by owner
+        self._owned: "OrderedDict[str, SandboxSession]" = OrderedDict()
+        self._warming = 0
+        self._lock = threading.Lock()
+        self._reaper = threading.Thread(
+            target=self._reap_idle, name="sandbox-pool-reaper", daemon=True
+        )
+        self._reaper.start()
+        self._refill()
+
+    def acquire(self, owner: Optional[str] = None) -> SandboxSession:
+        """
+        Get the session released by the owner, a warm session from the pool or start a new one.
+        Sessions that stopped running while they were idle are killed and replaced.
+        """
+        while True:
+            session = self._take_idle(owner)
+            if session is None:
+                break
+            try:
+                session.keep_alive(self.session_timeout)
+                if session.is_alive():
+                    session.last_used = time.monotonic()
+                    return session
+            except Exception as e:
+                logger.warning(f"Idle {self.backend} sandbox is not usable: {e}")
+            logger.info(f"Idle {self.backend} sandbox is not running anymore, replacing it")
+            self._kill(session)
+        logger.info(f"No warm {self.backend} sandbox available, starting one")
+        session = self._create_session()
+        session.last_used = time.monotonic()
+        return session
+
+    def release(self, session: SandboxSession, owner: Optional[str] = None) -> None:
+        """
+        Reset a session and keep it for the next acquire of its owner,
+        or kill it if it has no owner or can't be reset.
+        """
+        if owner is None:
+            self._kill(session)
+            return
+        try:
+            session.reset()
+            session.keep_alive(self.idle_timeout + 60)
+        except Exception as e:
+            logger.warning(f"Failed to reset sandbox, killing it: {e}")
+            self._kill(session)
+            return
+        session.last_used = time.monotonic()
+        with self._lock:
+            previous = self._owned.pop(owner, None)
+            self._owned[owner] = session
+        if previous is not None and previous is not session:
+            self._kill(previous)
+
+    def _take_idle(self, owner: Optional[str]) -> Optional[SandboxSession]:
+        if owner is not None:
+            with self._lock:
+                session = self._owned.pop(owner, None)
+            if session is not None:
+                return session
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            session = None
+        self._refill()
+        return session
+
+    def _create_session(self) -> SandboxSession:
+        if self.backend == "local":
+            return LocalKernelSession()
+        # Warm sessions must outlive the idle timeout, acquired sessions are extended
+        return E2BSession(api_key=self.api_key, timeout=self.idle_timeout + 60)
+
+    def _refill(self) -> None:
+        with self._lock:
+            missing = self.size - self._idle.qsize() - self._warming
+            if missing <= 0:
+                return
+            self._warming += missing
+        for _ in range(missing):
+            threading.Thread(
+                target=self._warm_session, name="sandbox-pool-warmup", daemon=True
+            ).start()
+
+    def _warm_session(self) -> None:
+        try:
+            session = self._create_session()
+            self._idle.put(session)
+        except Exception as e:
+            logger.error(f"Failed to start a warm {self.backend} sandbox: {e}")
+        finally:
+            with self._lock:
+                self._warming -= 1
+
+    def _reap_idle(self) -> None:
+        while True:
+            time.sleep(min(30, self.idle_timeout))
+            self._reap_expired()
+
+    def _reap_expired(self) -> None:
+        """
+        Kill the sessions that were idle for longer than `idle_timeout`.
+        """
+        now = time.monotonic()
+        keep = []
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if now - session.last_used > self.idle_timeout:
+                self._kill(session)
+            else:
+                keep.append(session)
+        for session in reversed(keep):
+            self._idle.put(session)
+        with self._lock:
+            expired = [
+                owner
+                for owner, session in self._owned.items()
+                if now - session.last_used > self.idle_timeout
+            ]
+            sessions = [self._owned.pop(owner) for owner in expired]
+        for session in sessions:
+            self._kill(session)
+
+    @staticmethod
+    def _kill(session: SandboxSession) -> None:
+        try:
+            session.kill()
+        except Exception:
+            pass
+
+
+# The content hashes of local files by path, modification time and size
+_local_file_hashes: LRUCache = LRUCache(maxsize=4096)
+_local_file_hashes_lock = threading.Lock()
+
+
+def _get_file_hash(path: str) -> str:
+    # Cache the hashes by modification time and size, so unchanged files are not read again
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    with _local_file_hashes_lock:
+        file_hash: Optional[str] = _local_file_hashes.get(key)
+    if file_hash is None:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        file_hash = sha256.hexdigest()
+        with _local_file_hashes_lock:
+            _local_file_hashes[key] = file_hash
+    return file_hash
+
+
+_sandbox_pools: Dict[str, SandboxPool] = {}
+_sandbox_pools_lock = threading.Lock()
+
+
+def get_sandbox_pool(backend: str, api_key: Optional[str] = None) -> SandboxPool:
+    with _sandbox_pools_lock:
+        pool = _sandbox_pools.get(backend)
+        if pool is None:
+            pool = SandboxPool(
+                backend=backend,
+                api_key=api_key,
+                size=int(os.getenv("SANDBOX_POOL_SIZE", "1")),
+                idle_timeout=float(os.getenv("SANDBOX_IDLE_TIMEOUT", "240")),
+                session_timeout=float(os.getenv("SANDBOX_SESSION_TIMEOUT", "600")),
+            )
+            _sandbox_pools[backend] = pool
+    return pool
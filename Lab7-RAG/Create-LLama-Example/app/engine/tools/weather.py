@@ -1,35 +1,167 @@
 """Open Meteo weather map tool spec."""
 
+import asyncio
 import logging
+import os
+import threading
+import time
+from typing import Optional, Tuple, Union
 
+import httpx
 import pytz  # type: ignore
-import requests  # type: ignore
+from cachetools import LRUCache, TTLCache
 from llama_index.core.tools import FunctionTool
 
+from app.engine.tools.http_clients import AsyncClients
+
 logger = logging.getLogger(__name__)
 
+# Coordinates are rounded to this many decimals (about 1 km) for the forecast cache
+COORDINATE_DECIMALS = 2
+
 
 class OpenMeteoWeather:
-    geo_api = "https://geocoding-api.open-meteo.com/v1"
-    weather_api = "https://api.open-meteo.com/v1"
+    # The API URLs can be changed, e.g. to test against a local mock server
+    geo_api = os.getenv("OPEN_METEO_GEO_API_URL", "https://geocoding-api.open-meteo.com/v1")
+    weather_api = os.getenv("OPEN_METEO_WEATHER_API_URL", "https://api.open-meteo.com/v1")
+    timeout = float(os.getenv("OPEN_METEO_TIMEOUT", "10"))
+    # Place names rarely move, geocoding results are kept for a long time
+    geo_cache_ttl = float(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 3600)))
+
+    # The geocoded locations and when they were fetched, by normalized location name.
+    # Expired entries are kept to speculatively fetch the forecast while they are refreshed.
+    _geo_cache: LRUCache = LRUCache(maxsize=4096)
+    _forecast_cache: TTLCache = TTLCache(
+        maxsize=1024, ttl=float(os.getenv("WEATHER_CACHE_TTL", "600"))
+    )
+    _cache_lock = threading.Lock()
+    _client: Optional[httpx.Client] = None
+    _async_clients = AsyncClients(timeout=timeout)
 
     @classmethod
-    def _get_geo_location(cls, location: str) -> dict:
-        """Get geo location from location name."""
-        params = {"name": location, "count": 10, "language": "en", "format": "json"}
-        response = requests.get(f"{cls.geo_api}/search", params=params)
+    def _get_client(cls) -> httpx.Client:
+        with cls._cache_lock:
+            if cls._client is None:
+                cls._client = httpx.Client(timeout=cls.timeout)
+            return cls._client
+
+    @classmethod
+    def _get_async_client(cls) -> httpx.AsyncClient:
+        return cls._async_clients.get()
+
+    @classmethod
+    def _get_cached_geo_location(cls, location: str) -> Tuple[Optional[dict], bool]:
+        """
+        Get the cached geo location of a location name and whether it's still fresh.
+        """
+        with cls._cache_lock:
+            cached = cls._geo_cache.get(location.strip().lower())
+        if cached is None:
+            return None, False
+        geo_location, fetched_at = cached
+        return geo_location, time.monotonic() - fetched_at < cls.geo_cache_ttl
+
+    @classmethod
+    def _cache_geo_location(cls, location: str, geo_location: dict) -> None:
+        with cls._cache_lock:
+            cls._geo_cache[location.strip().lower()] = (geo_location, time.monotonic())
+
+    @staticmethod
+    def _get_geo_params(location: str) -> dict:
+        return {"name": location, "count": 10, "language": "en", "format": "json"}
+
+    @staticmethod
+    def _parse_geo_location(response: httpx.Response) -> dict:
         if response.status_code != 200:
             raise Exception(f"Failed to fetch geo location: {response.status_code}")
-        else:
-            data = response.json()
-            result = data["results"][0]
-            geo_location = {
-                "id": result["id"],
-                "name": result["name"],
-                "latitude": result["latitude"],
-                "longitude": result["longitude"],
-            }
+        data = response.json()
+        result = data["results"][0]
+        geo_location = {
+            "id": result["id"],
+            "name": result["name"],
+            "latitude": result["latitude"],
+            "longitude": result["longitude"],
+        }
+        return geo_location
+
+    @staticmethod
+    def _get_forecast_key(geo_location: dict) -> Tuple[float, float]:
+        return (
+            round(geo_location["latitude"], COORDINATE_DECIMALS),
+            round(geo_location["longitude"], COORDINATE_DECIMALS),
+        )
+
+    @staticmethod
+    def _get_forecast_params(forecast_key: Tuple[float, float]) -> dict:
+        timezone = pytz.timezone("UTC").zone
+        return {
+            "latitude": forecast_key[0],
+            "longitude": forecast_key[1],
+            "current": "temperature_2m,weather_code",
+            "hourly": "temperature_2m,weather_code",
+            "daily": "weather_code",
+            "timezone": timezone,
+        }
+
+    @staticmethod
+    def _parse_forecast(response: httpx.Response) -> dict:
+        if response.status_code != 200:
+            raise Exception(
+                f"Failed to fetch weather information: {response.status_code}"
+            )
+        return response.json()
+
+    @classmethod
+    def _get_geo_location(cls, location: str) -> dict:
+        """Get geo location from location name."""
+        geo_location, is_fresh = cls._get_cached_geo_location(location)
+        if geo_location is not None and is_fresh:
             return geo_location
+        response = cls._get_client().get(
+            f"{cls.geo_api}/search", params=cls._get_geo_params(location)
+        )
+        geo_location = cls._parse_geo_location(response)
+        cls._cache_geo_location(location, geo_location)
+        return geo_location
+
+    @classmethod
+    def _get_forecast(cls, geo_location: dict) -> dict:
+        forecast_key = cls._get_forecast_key(geo_location)
+        with cls._cache_lock:
+            forecast = cls._forecast_cache.get(forecast_key)
+        if forecast is None:
+            response = cls._get_client().get(
+                f"{cls.weather_api}/forecast",
+                params=cls._get_forecast_params(forecast_key),
+            )
+            forecast = cls._parse_forecast(response)
+            with cls._cache_lock:
+                cls._forecast_cache[forecast_key] = forecast
+        return forecast
+
+    @classmethod
+    async def _aget_geo_location(cls, location: str) -> dict:
+        response = await cls._get_async_client().get(
+            f"{cls.geo_api}/search", params=cls._get_geo_params(location)
+        )
+        geo_location = cls._parse_geo_location(response)
+        cls._cache_geo_location(location, geo_location)
+        return geo_location
+
+    @classmethod
+    async def _aget_forecast(cls, geo_location: dict) -> dict:
+        forecast_key = cls._get_forecast_key(geo_location)
+        with cls._cache_lock:
+            forecast = cls._forecast_cache.get(forecast_key)
+        if forecast is None:
+            response = await cls._get_async_client().get(
+                f"{cls.weather_api}/forecast",
+                params=cls._get_forecast_params(forecast_key),
+            )
+            forecast = cls._parse_forecast(response)
+            with cls._cache_lock:
+                cls._forecast_cache[forecast_key] = forecast
+        return forecast
 
     @classmethod
     def get_weather_information(cls, location: str) -> dict:
@@ -53,22 +185,46 @@ class OpenMeteoWeather:
             f"Calling open-meteo api to get weather information of location: {location}"
         )
         geo_location = cls._get_geo_location(location)
-        timezone = pytz.timezone("UTC").zone
-        params = {
-            "latitude": geo_location["latitude"],
-            "longitude": geo_location["longitude"],
-            "current": "temperature_2m,weather_code",
-            "hourly": "temperature_2m,weather_code",
-            "daily": "weather_code",
-            "timezone": timezone,
-        }
-        response = requests.get(f"{cls.weather_api}/forecast", params=params)
-        if response.status_code != 200:
-            raise Exception(
-                f"Failed to fetch weather information: {response.status_code}"
-            )
-        return response.json()
+        return cls._get_forecast(geo_location)
+
+    @classmethod
+    async def aget_weather_information(cls, location: str) -> dict:
+        """
+        Async version of `get_weather_information`. If the location was geocoded before,
+        its forecast is fetched speculatively while the geocoding is refreshed.
+        """
+        logger.info(
+            f"Calling open-meteo api to get weather information of location: {location}"
+        )
+        cached_geo_location, is_fresh = cls._get_cached_geo_location(location)
+        if cached_geo_location is not None and is_fresh:
+            return await cls._aget_forecast(cached_geo_location)
+        if cached_geo_location is None:
+            geo_location = await cls._aget_geo_location(location)
+            return await cls._aget_forecast(geo_location)
+
+        results: Tuple[
+            Union[dict, BaseException], Union[dict, BaseException]
+        ] = await asyncio.gather(
+            cls._aget_geo_location(location),
+            cls._aget_forecast(cached_geo_location),
+            return_exceptions=True,
+        )
+        geo_location, speculative_forecast = results
+        if isinstance(geo_location, BaseException):
+            raise geo_location
+        if cls._get_forecast_key(geo_location) == cls._get_forecast_key(
+            cached_geo_location
+        ) and not isinstance(speculative_forecast, BaseException):
+            return speculative_forecast
+        # The location moved, the speculative forecast is discarded
+        return await cls._aget_forecast(geo_location)
 
 
 def get_tools(**kwargs):
-    return [FunctionTool.from_defaults(OpenMeteoWeather.get_weather_information)]
+    return [
+        FunctionTool.from_defaults(
+            fn=OpenMeteoWeather.get_weather_information,
+            async_fn=OpenMeteoWeather.aget_weather_information,
+        )
+    ]
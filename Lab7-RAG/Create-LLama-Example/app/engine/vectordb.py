@@ -1,10 +1,20 @@
+import hashlib
 import os
+import threading
+from typing import Any, Dict, Optional
 
 from llama_index.vector_stores.chroma import ChromaVectorStore
 
+_local_vector_stores: Dict[str, Any] = {}
+_local_vector_stores_lock = threading.Lock()
 
-def get_vector_store():
-    collection_name = os.getenv("CHROMA_COLLECTION", "default")
+
+def get_vector_store(collection_name: Optional[str] = None):
+    if collection_name is None:
+        collection_name = os.getenv("CHROMA_COLLECTION", "default")
+    # VECTOR_STORE=local uses the built-in memory-mapped vector store instead of Chroma
+    if os.getenv("VECTOR_STORE", "chroma") == "local":
+        return get_local_vector_store(collection_name)
     chroma_path = os.getenv("CHROMA_PATH")
     # if CHROMA_PATH is set, use a local ChromaVectorStore from the path
     # otherwise, use a remote ChromaVectorStore (ChromaDB Cloud is not supported yet)
@@ -23,3 +33,36 @@ def get_vector_store():
             collection_name=collection_name,
         )
     return store
+
+
+def get_private_collection_name(owner: str) -> str:
+    """
+    Get the name of the collection with the private uploads of an owner (user or session).
+    The owner is hashed to get a valid collection name.
+    """
+    collection_name = os.getenv("CHROMA_COLLECTION", "default")
+    owner_hash = hashlib.sha1(owner.encode("utf-8")).hexdigest()[:16]
+    return f"{collection_name}_private_{owner_hash}"
+
+
+def get_local_vector_store(collection_name: str):
+    """
+    Get the local vector store of a collection.
+    The stores are opened once and shared, so their in-memory indexes are reused.
+    """
+    from app.engine.local_vector_store import LocalVectorStore
+
+    with _local_vector_stores_lock:
+        store = _local_vector_stores.get(collection_name)
+        if store is None:
+            store = LocalVectorStore(
+                persist_dir=os.path.join(
+                    os.getenv("LOCAL_VECTOR_STORE_PATH", "storage/vectors"),
+                    collection_name,
+                ),
+                dtype=os.getenv("LOCAL_VECTOR_DTYPE", "float32"),
+                ivf_threshold=int(os.getenv("LOCAL_VECTOR_IVF_THRESHOLD", "50000")),
+                ivf_probes=int(os.getenv("LOCAL_VECTOR_IVF_PROBES", "8")),
+            )
+            _local_vector_stores[collection_name] = store
+    return store
@@ -0,0 +1,228 @@
+import hmac
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+from enum import Enum
+from typing import Optional, Tuple
+
+from app.services.file import DocumentFile
+
+logger = logging.getLogger("uvicorn")
+
+
+class ContentStatus(str, Enum):
+    PENDING = "pending"
+    INDEXED = "indexed"
+    FAILED = "failed"
+
+
+class ContentStore:
+    """
+    A content-addressed registry of the uploaded files, keyed by the SHA-256 of their content.
+
+    Uploading content that is already stored returns the existing file (and its document ids)
+    instead of storing, parsing and embedding it again. This doesn't leak private documents:
+    the uploader already has the content. Every file keeps a reference count per owner,
+    and it is removed when its last reference is released.
+
+    Files can be registered in a namespace (e.g. the owner, if every owner has its own collection),
+    then only files in the same namespace are deduplicated.
+
+    The owner comes from unauthenticated request params, so every reference has a secret
+    release token that is only returned to its uploaders and is required to release it.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS content_files (hash TEXT PRIMARY KEY, file_id TEXT NOT NULL UNIQUE, data TEXT NOT NULL, path TEXT, status TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS content_refs (hash TEXT NOT NULL, owner TEXT NOT NULL, count INTEGER NOT NULL, token TEXT, PRIMARY KEY (hash, owner))"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(content_refs)")]
+            if "token" not in columns:
+                self._db.execute("ALTER TABLE content_refs ADD COLUMN token TEXT")
+        self._fail_orphaned_files()
+
+    def _fail_orphaned_files(self) -> None:
+        """
+        Mark the files that were still being indexed by a previous run as failed, unless their
+        indexing job was resumed, so the next upload of their content indexes it again.
+        """
+        with self._lock, self._db:
+            rows = self._db.execute(
+                "SELECT file_id, data, path FROM content_files WHERE status = ?",
+                (ContentStatus.PENDING.value,),
+            ).fetchall()
+            orphaned = [
+                file_id
+                for file_id, data, path in rows
+                if not self._has_active_job(self._parse_file(data, path))
+            ]
+            self._db.executemany(
+                "UPDATE content_files SET status = ? WHERE file_id = ?",
+                [(ContentStatus.FAILED.value, file_id) for file_id in orphaned],
+            )
+        if len(orphaned) > 0:
+            logger.warning(
+                f"Marked {len(orphaned)} files as failed, their indexing was interrupted"
+            )
+
+    @staticmethod
+    def _has_active_job(document_file: DocumentFile) -> bool:
+        from app.services.indexing import get_indexing_queue
+
+        return document_file.job_id is not None and get_indexing_queue().is_active(
+            document_file.job_id
+        )
+
+    def register(
+        self, document_file: DocumentFile, owner: str, namespace: Optional[str] = None
+    ) -> Tuple[DocumentFile, bool]:
+        """
+        Register a stored file for the owner.
+
+        Returns:
+            The stored file with the same content (with the release token of the owner's reference)
+            and whether the given file is new. If it is not new, the given file is a duplicate and can be removed.
+        """
+        if document_file.hash is None:
+            raise ValueError("The file hash is required to register the file")
+        content_key = (
+            document_file.hash
+            if namespace is None
+            else f"{namespace}:{document_file.hash}"
+        )
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT data, path, status FROM content_files WHERE hash = ?",
+                (content_key,),
+            ).fetchone()
+            stored_file = self._parse_file(row[0], row[1]) if row else None
+            is_new = (
+                stored_file is None
+                or row[2] == ContentStatus.FAILED.value
+                or not os.path.exists(stored_file.path)
+                # The indexing job of the stored file was lost, it would never be indexed
+                or (
+                    row[2] == ContentStatus.PENDING.value
+                    and stored_file.job_id is not None
+                    and not self._has_active_job(stored_file)
+                )
+            )
+            if is_new:
+                if stored_file is not None and os.path.exists(stored_file.path):
+                    # Replace the copy of a file that failed (or will never) be indexed
+                    os.remove(stored_file.path)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO content_files (hash, file_id, data, path, status) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        content_key,
+                        document_file.id,
+                        self._dump_file(document_file),
+                        document_file.path,
+                        ContentStatus.PENDING.value,
+                    ),
+                )
+                stored_file = document_file
+            self._db.execute(
+                "INSERT INTO content_refs (hash, owner, count, token) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT (hash, owner) DO UPDATE SET count = count + 1, "
+                "token = COALESCE(token, excluded.token)",
+                (content_key, owner, secrets.token_urlsafe(32)),
+            )
+            (token,) = self._db.execute(
+                "SELECT token FROM content_refs WHERE hash = ? AND owner = ?",
+                (content_key, owner),
+            ).fetchone()
+        if not is_new:
+            logger.info(f"Reusing stored file {stored_file.name} for the same content")
+        return stored_file.model_copy(update={"release_token": token}), is_new
+
+    def update(
+        self, document_file: DocumentFile, status: Optional[ContentStatus] = None
+    ) -> None:
+        """
+        Update the stored metadata (and optionally the status) of a registered file.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE content_files SET data = ? WHERE file_id = ?",
+                (self._dump_file(document_file), document_file.id),
+            )
+            if status is not None:
+                self._db.execute(
+                    "UPDATE content_files SET status = ? WHERE file_id = ?",
+                    (status.value, document_file.id),
+                )
+
+    def release(
+        self, file_id: str, owner: str, release_token: Optional[str]
+    ) -> Optional[DocumentFile]:
+        """
+        Release a reference of the owner to a file. Raises PermissionError if the release token is wrong.
+
+        Returns:
+            The file if this was its last reference, so it should be deleted, otherwise None.
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT hash, data, path FROM content_files WHERE file_id = ?",
+                (file_id,),
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"File {file_id} is not found")
+            file_hash = row[0]
+            ref = self._db.execute(
+                "SELECT token FROM content_refs WHERE hash = ? AND owner = ? AND count > 0",
+                (file_hash, owner),
+            ).fetchone()
+            if ref is None:
+                raise ValueError(f"File {file_id} is not referenced by {owner}")
+            if ref[0] is None or not hmac.compare_digest(ref[0], release_token or ""):
+                raise PermissionError(f"Invalid release token for file {file_id}")
+            self._db.execute(
+                "UPDATE content_refs SET count = count - 1 WHERE hash = ? AND owner = ?",
+                (file_hash, owner),
+            )
+            self._db.execute("DELETE FROM content_refs WHERE count <= 0")
+            (count,) = self._db.execute(
+                "SELECT COUNT(*) FROM content_refs WHERE hash = ?", (file_hash,)
+            ).fetchone()
+            if count > 0:
+                return None
+            self._db.execute("DELETE FROM content_files WHERE hash = ?", (file_hash,))
+        return self._parse_file(row[1], row[2])
+
+    @staticmethod
+    def _dump_file(document_file: DocumentFile) -> str:
+        # The release token is per reference and never stored with the shared file metadata
+        return document_file.model_dump_json(exclude={"release_token"})
+
+    @staticmethod
+    def _parse_file(data: str, path: Optional[str]) -> DocumentFile:
+        document_file = DocumentFile.model_validate_json(data)
+        # The file path is excluded from the serialized file metadata
+        document_file.path = path
+        return document_file
+
+
+_content_store: Optional[ContentStore] = None
+_content_store_lock = threading.Lock()
+
+
+def get_content_store() -> ContentStore:
+    global _content_store
+    with _content_store_lock:
+        if _content_store is None:
+            db_path = os.getenv("CONTENT_STORE_DB") or os.path.join(
+                os.getenv("STORAGE_DIR", "storage"), "content_store.db"
+            )
+            _content_store = ContentStore(db_path)
+    return _content_store
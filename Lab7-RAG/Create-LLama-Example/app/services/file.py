@@ -1,4 +1,5 @@
 import base64
+import hashlib
 import logging
 import mimetypes
 import os
@@ -6,24 +7,24 @@ import re
 import uuid
 from io import BytesIO
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import BinaryIO, Dict, List, Optional, Tuple
 
 from llama_index.core import VectorStoreIndex
-from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core.readers.file.base import (
-    _try_loading_included_file_formats as get_file_loaders_map,
-)
 from llama_index.core.schema import Document
 from llama_index.indices.managed.llama_cloud.base import LlamaCloudIndex
-from llama_index.readers.file import FlatReader
 from pydantic import BaseModel, Field
 
+from app.engine.ingestion import StageTimer, run_ingestion
+
 logger = logging.getLogger(__name__)
 
 PRIVATE_STORE_PATH = str(Path("output", "uploaded"))
 TOOL_STORE_PATH = str(Path("output", "tools"))
 LLAMA_CLOUD_STORE_PATH = str(Path("output", "llamacloud"))
 
+# Size of the chunks read from an upload stream
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class DocumentFile(BaseModel):
     id: str
@@ -39,6 +40,19 @@ class DocumentFile(BaseModel):
     refs: Optional[List[str]] = Field(
         None, description="The document ids in the index."
     )
+    hash: Optional[str] = Field(
+        None, description="The SHA-256 hash of the file content."
+    )
+    job_id: Optional[str] = Field(
+        None, description="The id of the background indexing job of the file."
+    )
+    timings: Optional[Dict[str, float]] = Field(
+        None, description="The time in seconds spent in each stage of indexing the file."
+    )
+    release_token: Optional[str] = Field(
+        None,
+        description="The secret to release the upload. Only returned to its uploader.",
+    )
 
 
 class FileService:
@@ -52,51 +66,232 @@ class FileService:
         file_name: str,
         base64_content: str,
         params: Optional[dict] = None,
+        background: bool = False,
     ) -> DocumentFile:
         """
         Store the uploaded file and index it if necessary.
+        If `background` is set, the file is queued for indexing and returned right away.
         """
-        try:
-            from app.engine.index import IndexConfig, get_index
-        except ImportError as e:
-            raise ValueError("IndexConfig or get_index is not found") from e
+        # Preprocess and store the file
+        file_data, _ = cls._preprocess_base64_file(base64_content)
+        document_file, is_new = cls.save_private_file(
+            file_name, BytesIO(file_data), params
+        )
+        # The same content is already indexed (or queued for indexing)
+        if not is_new:
+            return document_file
 
-        if params is None:
-            params = {}
+        if background:
+            return cls._submit_indexing_job(document_file, params)
+        return cls.index_private_file(document_file, params)
 
-        # Add the nodes to the index and persist it
-        index_config = IndexConfig(**params)
-        index = get_index(index_config)
+    @classmethod
+    def process_private_file_stream(
+        cls,
+        file_name: str,
+        stream: BinaryIO,
+        params: Optional[dict] = None,
+    ) -> DocumentFile:
+        """
+        Stream the uploaded file to disk and queue it for indexing.
+        """
+        document_file, is_new = cls.save_private_file(file_name, stream, params)
+        if not is_new:
+            return document_file
+        return cls._submit_indexing_job(document_file, params)
 
-        # Preprocess and store the file
-        file_data, extension = cls._preprocess_base64_file(base64_content)
+    @classmethod
+    def save_private_file(
+        cls,
+        file_name: str,
+        stream: BinaryIO,
+        params: Optional[dict] = None,
+    ) -> Tuple[DocumentFile, bool]:
+        """
+        Store an uploaded file in the private directory without indexing it.
+        The document ids are derived from the file id, so they are set before indexing.
 
-        document_file = cls.save_file(
-            file_data,
+        Files are deduplicated by their content hash: if the same content was stored before,
+        the new copy is removed and the stored file is returned with its document ids.
+
+        Returns:
+            The stored file and whether it is new (and needs to be indexed).
+        """
+        from app.engine.index import get_private_owner, is_private_collections_enabled
+        from app.services.content_store import ContentStatus, get_content_store
+
+        document_file = cls.save_file_stream(
+            stream,
             file_name=file_name,
             save_dir=PRIVATE_STORE_PATH,
         )
+        if cls.is_indexable(document_file):
+            document_file.refs = [document_file.id]
+
+        owner = get_private_owner(params)
+        # With a collection per owner, the content of another owner can't be reused
+        namespace = owner if is_private_collections_enabled() else None
+        content_store = get_content_store()
+        stored_file, is_new = content_store.register(document_file, owner, namespace)
+        if not is_new:
+            os.remove(document_file.path)
+        elif not cls.is_indexable(document_file):
+            content_store.update(document_file, ContentStatus.INDEXED)
+        return stored_file, is_new
+
+    @classmethod
+    def release_private_file(
+        cls,
+        file_id: str,
+        params: Optional[dict] = None,
+        release_token: Optional[str] = None,
+    ) -> bool:
+        """
+        Release the reference of the uploader to a private file, with the release token returned by the upload.
+        The file and its documents in the index are deleted once it has no references left.
 
+        Returns:
+            Whether the file was deleted.
+        """
+        from app.engine.index import get_private_owner
+        from app.services.content_store import get_content_store
+
+        document_file = get_content_store().release(
+            file_id, get_private_owner(params), release_token
+        )
+        if document_file is None:
+            return False
+
+        if document_file.refs:
+            from app.engine.bm25 import delete_from_bm25_index
+            from app.engine.storage import persist_deleted_ref_docs
+
+            index = cls._get_index(params)
+            for ref in document_file.refs:
+                index.delete_ref_doc(ref, delete_from_docstore=True)
+            if isinstance(index, VectorStoreIndex):
+                delete_from_bm25_index(index.vector_store, document_file.refs)
+                persist_deleted_ref_docs(index.storage_context, document_file.refs)
+        if document_file.path and os.path.exists(document_file.path):
+            os.remove(document_file.path)
+        logger.info(f"Deleted private file {document_file.name}")
+        return True
+
+    @classmethod
+    def index_private_file(
+        cls,
+        document_file: DocumentFile,
+        params: Optional[dict] = None,
+    ) -> DocumentFile:
+        """
+        Index a stored private file and update its document ids.
+        """
         # Don't index csv files (they are handled by tools)
-        if extension == "csv":
+        if not cls.is_indexable(document_file):
             return document_file
-        else:
+
+        try:
+            index = cls._get_index(params)
+
             # Insert the file into the index and update document ids to the file metadata
             if isinstance(index, LlamaCloudIndex):
+                with open(document_file.path, "rb") as f:
+                    file_data = f.read()
                 doc_id = cls._add_file_to_llama_cloud_index(
                     index, document_file.name, file_data
                 )
                 # Add document ids to the file metadata
                 document_file.refs = [doc_id]
             else:
-                documents = cls._load_file_to_documents(document_file)
-                cls._add_documents_to_vector_store_index(documents, index)
-                # Add document ids to the file metadata
-                document_file.refs = [doc.doc_id for doc in documents]
+                timer = StageTimer()
+                with timer.stage("load"):
+                    documents = cls.load_private_file_documents(document_file)
+                cls._add_documents_to_vector_store_index(documents, index, timer)
+                document_file.timings = timer.timings
+        except Exception:
+            cls.set_private_file_indexed(document_file, False)
+            raise
+        cls.set_private_file_indexed(document_file, True)
 
         # Return the file metadata
         return document_file
 
+    @staticmethod
+    def set_private_file_indexed(document_file: DocumentFile, indexed: bool) -> None:
+        """
+        Record whether a private file was indexed, so later uploads of the same content can reuse it.
+        """
+        from app.services.content_store import ContentStatus, get_content_store
+
+        get_content_store().update(
+            document_file,
+            ContentStatus.INDEXED if indexed else ContentStatus.FAILED,
+        )
+
+    @classmethod
+    def load_private_file_documents(cls, document_file: DocumentFile) -> List[Document]:
+        """
+        Load a stored private file to documents and update its document ids.
+        """
+        documents = cls._load_file_to_documents(document_file)
+        document_file.refs = list(dict.fromkeys(doc.doc_id for doc in documents))
+        return documents
+
+    @classmethod
+    def insert_private_documents(
+        cls,
+        documents: List[Document],
+        params: Optional[dict] = None,
+        timer: Optional[StageTimer] = None,
+    ) -> None:
+        """
+        Insert the documents of one or more private files into the index with a single persist.
+        """
+        index = cls._get_index(params)
+        if isinstance(index, LlamaCloudIndex):
+            raise ValueError("Inserting documents is not supported for LlamaCloudIndex")
+        cls._add_documents_to_vector_store_index(documents, index, timer)
+
+    @staticmethod
+    def _get_index(params: Optional[dict] = None):
+        try:
+            from app.engine.index import IndexConfig, get_index, get_private_index
+        except ImportError as e:
+            raise ValueError("IndexConfig or get_index is not found") from e
+
+        index_config = IndexConfig(**(params or {}))
+        # Store the uploads in the private collection of the owner, if enabled
+        private_index = get_private_index(params, index_config)
+        if private_index is not None:
+            return private_index
+        return get_index(index_config)
+
+    @classmethod
+    def _submit_indexing_job(
+        cls,
+        document_file: DocumentFile,
+        params: Optional[dict] = None,
+    ) -> DocumentFile:
+        from app.services.content_store import get_content_store
+        from app.services.indexing import get_indexing_queue
+
+        if cls.is_indexable(document_file):
+            # The job is shared with later uploaders of the same content, without the release token
+            job = get_indexing_queue().submit(
+                document_file.model_copy(update={"release_token": None}), params
+            )
+            document_file.job_id = job.id
+            # Later uploads of the same content get the same job
+            get_content_store().update(document_file)
+        return document_file
+
+    @staticmethod
+    def is_indexable(document_file: DocumentFile) -> bool:
+        """
+        Whether the file is added to the index (csv files are handled by tools).
+        """
+        return document_file.type != "csv"
+
     @classmethod
     def save_file(
         cls,
@@ -114,6 +309,30 @@ class FileService:
         Returns:
             The metadata of the saved file.
         """
+        if isinstance(content, str):
+            content = content.encode()
+
+        return cls.save_file_stream(BytesIO(content), file_name, save_dir)
+
+    @classmethod
+    def save_file_stream(
+        cls,
+        stream: BinaryIO,
+        file_name: str,
+        save_dir: Optional[str] = None,
+    ) -> DocumentFile:
+        """
+        Save the content of a binary stream to a file in the local file server.
+        The stream is copied chunk by chunk and hashed while it is written,
+        so the file is never held in memory as a whole.
+
+        Args:
+            stream (BinaryIO): The stream to read the content from.
+            file_name (str): The original name of the file.
+            save_dir (Optional[str]): The relative path from the current working directory. Defaults to the `output/uploaded` directory.
+        Returns:
+            The metadata of the saved file.
+        """
         if save_dir is None:
             save_dir = os.path.join("output", "uploaded")
 
@@ -126,14 +345,17 @@ class FileService:
         new_file_name = f"{sanitized_name}_{file_id}.{extension}"
 
         file_path = os.path.join(save_dir, new_file_name)
-
-        if isinstance(content, str):
-            content = content.encode()
+        # Write to a temporary file first so a partially written upload is never served
+        tmp_file_path = f"{file_path}.part"
+        sha256 = hashlib.sha256()
 
         try:
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, "wb") as file:
-                file.write(content)
+            with open(tmp_file_path, "wb") as file:
+                while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    file.write(chunk)
+            os.replace(tmp_file_path, file_path)
         except PermissionError as e:
             logger.error(
                 f"Permission denied when writing to file {file_path}: {str(e)}"
@@ -147,6 +369,9 @@ class FileService:
         except Exception as e:
             logger.error(f"Unexpected error when writing to file {file_path}: {str(e)}")
             raise
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
 
         logger.info(f"Saved file to {file_path}")
 
@@ -172,6 +397,7 @@ class FileService:
             path=file_path,
             url=file_url,
             refs=None,
+            hash=sha256.hexdigest(),
         )
 
     @staticmethod
@@ -185,47 +411,57 @@ class FileService:
     @staticmethod
     def _load_file_to_documents(file: DocumentFile) -> List[Document]:
         """
-        Load the file from the private directory and return the documents
+        Load the file from the private directory and return the documents.
+        All documents of a file share the file id as document id, so the
+        document ids are known before the file is indexed. The documents
+        (e.g. the pages of a PDF) are told apart by their `file_part`.
         """
-        _, extension = os.path.splitext(file.name)
-        extension = extension.lstrip(".")
+        from app.engine.loaders.readers import get_reader_registry
 
+        if file.path is None:
+            raise ValueError("Document file path is not set")
         # Load file to documents
         # If LlamaParse is enabled, use it to parse the file
         # Otherwise, use the default file loaders
-        reader = _get_llamaparse_parser()
-        if reader is None:
-            reader_cls = _default_file_loaders_map().get(f".{extension}")
-            if reader_cls is None:
-                raise ValueError(f"File extension {extension} is not supported")
-            reader = reader_cls()
-        if file.path is None:
-            raise ValueError("Document file path is not set")
+        reader = get_reader_registry().get_reader(file.path)
         documents = reader.load_data(Path(file.path))
         # Add custom metadata
-        for doc in documents:
+        for i, doc in enumerate(documents):
+            doc.id_ = file.id
             doc.metadata["file_name"] = file.name
             doc.metadata["private"] = "true"
+            # The char offsets of the chunks restart in every part
+            doc.metadata["file_part"] = i
+            doc.excluded_embed_metadata_keys.append("file_part")
+            doc.excluded_llm_metadata_keys.append("file_part")
         return documents
 
     @staticmethod
     def _add_documents_to_vector_store_index(
-        documents: List[Document], index: VectorStoreIndex
+        documents: List[Document],
+        index: VectorStoreIndex,
+        timer: Optional[StageTimer] = None,
     ) -> None:
         """
         Add the documents to the vector store index
         """
-        pipeline = IngestionPipeline()
-        nodes = pipeline.run(documents=documents)
+        from app.engine.bm25 import add_nodes_to_bm25_index
+        from app.engine.storage import persist_inserted_nodes
+
+        if timer is None:
+            timer = StageTimer()
+        # Split and embed the documents the same way as the generate script
+        nodes = run_ingestion(documents, timer)
 
         # Add the nodes to the index and persist it
-        if index is None:
-            index = VectorStoreIndex(nodes=nodes)
-        else:
-            index.insert_nodes(nodes=nodes)
-        index.storage_context.persist(
-            persist_dir=os.environ.get("STORAGE_DIR", "storage")
-        )
+        with timer.stage("insert"):
+            if index is None:
+                index = VectorStoreIndex(nodes=nodes)
+            else:
+                index.insert_nodes(nodes=nodes)
+            add_nodes_to_bm25_index(index.vector_store, nodes)
+        with timer.stage("persist"):
+            persist_inserted_nodes(index.storage_context, nodes)
 
     @staticmethod
     def _add_file_to_llama_cloud_index(
@@ -260,22 +496,3 @@ def _sanitize_file_name(file_name: str) -> str:
     """
     sanitized_name = re.sub(r"[^a-zA-Z0-9.]", "_", file_name)
     return sanitized_name
-
-
-def _get_llamaparse_parser():
-    from app.engine.loaders import load_configs
-    from app.engine.loaders.file import FileLoaderConfig, llama_parse_parser
-
-    config = load_configs()
-    file_loader_config = FileLoaderConfig(**config["file"])
-    if file_loader_config.use_llama_parse:
-        return llama_parse_parser()
-    else:
-        return None
-
-
-def _default_file_loaders_map():
-    default_loaders = get_file_loaders_map()
-    default_loaders[".txt"] = FlatReader
-    default_loaders[".csv"] = FlatReader
-    return default_loaders
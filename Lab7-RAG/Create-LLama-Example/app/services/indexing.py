@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from typing import Dict, List, Optional
+
+from llama_index.core.schema import Document
+from pydantic import BaseModel, Field
+
+from app.engine.ingestion import StageTimer
+from app.services.file import DocumentFile, FileService
+
+logger = logging.getLogger("uvicorn")
+
+
+class IndexingJobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class IndexingJob(BaseModel):
+    id: str
+    file: DocumentFile
+    params: Optional[dict] = None
+    status: IndexingJobStatus = IndexingJobStatus.PENDING
+    error: Optional[str] = None
+    created_at: float = Field(default_factory=time.time)
+    updated_at: float = Field(default_factory=time.time)
+
+
+class IndexingQueue:
+    """
+    Index uploaded files in background worker threads.
+
+    Files are parsed concurrently by the workers. Jobs that arrive close together
+    are batched into a single index insert and a single persist.
+    If `db_path` is set, the jobs are stored in SQLite and unfinished jobs are resumed on restart.
+    Finished jobs are kept in memory for `job_ttl` seconds to report their status.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        batch_size: int = 16,
+        batch_wait: float = 0.2,
+        db_path: Optional[str] = None,
+        job_ttl: float = 3600,
+    ):
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.job_ttl = job_ttl
+        self._queue: queue.Queue[str] = queue.Queue()
+        self._jobs: Dict[str, IndexingJob] = {}
+        # The finish time of the finished jobs, oldest first
+        self._finished: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        # Inserting into the index and persisting it must not run concurrently
+        self._index_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._init_db(db_path)
+
+    def submit(
+        self, document_file: DocumentFile, params: Optional[dict] = None
+    ) -> IndexingJob:
+        """
+        Queue a stored file for indexing and return the job right away.
+        """
+        job = IndexingJob(id=str(uuid.uuid4()), file=document_file, params=params)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._save_job(job)
+        self._start_workers()
+        self._queue.put(job.id)
+        logger.info(f"Queued indexing job {job.id} for file {document_file.name}")
+        return job
+
+    def get(self, job_id: str) -> Optional[IndexingJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self._db is not None:
+            job = self._load_job(job_id)
+        return job
+
+    def is_active(self, job_id: str) -> bool:
+        """
+        Whether the job is queued, running or done in this process, so its file is (or is about to be) indexed.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job is not None and job.status != IndexingJobStatus.FAILED
+
+    def _start_workers(self):
+        with self._lock:
+            if len(self._threads) > 0:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"indexing-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            # Wait briefly to collect consecutive uploads into the same batch
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(self._queue.get(timeout=timeout))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process_batch([self._jobs[job_id] for job_id in batch])
+            except Exception:
+                logger.exception("Unexpected error in indexing worker")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _process_batch(self, jobs: List[IndexingJob]):
+        # Jobs with different params may target different indexes
+        groups: Dict[str, List[IndexingJob]] = {}
+        for job in jobs:
+            key = json.dumps(job.params or {}, sort_keys=True, default=str)
+            groups.setdefault(key, []).append(job)
+
+        for group in groups.values():
+            documents: List[Document] = []
+            loaded_jobs: List[IndexingJob] = []
+            for job in group:
+                self._update(job, IndexingJobStatus.RUNNING)
+                try:
+                    job_timer = StageTimer()
+                    with job_timer.stage("load"):
+                        documents.extend(
+                            FileService.load_private_file_documents(job.file)
+                        )
+                    job.file.timings = job_timer.timings
+                    loaded_jobs.append(job)
+                except Exception as e:
+                    logger.error(f"Failed to load file {job.file.name}: {e}")
+                    self._update(job, IndexingJobStatus.FAILED, str(e))
+                    FileService.set_private_file_indexed(job.file, False)
+
+            if len(loaded_jobs) == 0:
+                continue
+            # The other stages are shared by all files of the batch
+            batch_timer = StageTimer()
+            try:
+                with self._index_lock:
+                    FileService.insert_private_documents(
+                        documents, loaded_jobs[0].params, batch_timer
+                    )
+            except Exception as e:
+                logger.error(f"Failed to index {len(loaded_jobs)} files: {e}")
+                for job in loaded_jobs:
+                    self._update(job, IndexingJobStatus.FAILED, str(e))
+                    FileService.set_private_file_indexed(job.file, False)
+            else:
+                logger.info(f"Indexed {len(loaded_jobs)} files in one batch")
+                for job in loaded_jobs:
+                    job.file.timings = {**job.file.timings, **batch_timer.timings}
+                    self._update(job, IndexingJobStatus.DONE)
+                    FileService.set_private_file_indexed(job.file, True)
+
+    def _update(
+        self,
+        job: IndexingJob,
+        status: IndexingJobStatus,
+        error: Optional[str] = None,
+    ):
+        with self._lock:
+            job.status = status
+            job.error = error
+            job.updated_at = time.time()
+            if status in (IndexingJobStatus.DONE, IndexingJobStatus.FAILED):
+                self._finished[job.id] = job.updated_at
+                self._evict_finished()
+        self._save_job(job)
+
+    def _evict_finished(self):
+        # Called with the lock held
+        expired_before = time.time() - self.job_ttl
+        while len(self._finished) > 0:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > expired_before:
+                break
+            self._finished.popitem(last=False)
+            self._jobs.pop(job_id, None)
+
+    def _init_db(self, db_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS indexing_jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, path TEXT, status TEXT NOT NULL)"
+            )
+            rows = self._db.execute(
+                "SELECT data, path FROM indexing_jobs WHERE status IN (?, ?)",
+                (IndexingJobStatus.PENDING.value, IndexingJobStatus.RUNNING.value),
+            ).fetchall()
+        # Resume the jobs that were not finished before the restart
+        for data, path in rows:
+            job = self._parse_job(data, path)
+            job.status = IndexingJobStatus.PENDING
+            self._jobs[job.id] = job
+            self._queue.put(job.id)
+        if len(rows) > 0:
+            logger.info(f"Resuming {len(rows)} unfinished indexing jobs")
+            self._start_workers()
+
+    def _save_job(self, job: IndexingJob):
+        if self._db is None:
+            return
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO indexing_jobs (id, data, path, status) VALUES (?, ?, ?, ?)",
+                (job.id, job.model_dump_json(), job.file.path, job.status.value),
+            )
+
+    def _load_job(self, job_id: str) -> Optional[IndexingJob]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data, path FROM indexing_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._parse_job(*row) if row else None
+
+    @staticmethod
+    def _parse_job(data: str, path: Optional[str]) -> IndexingJob:
+        job = IndexingJob.model_validate_json(data)
+        # The file path is excluded from the serialized file metadata
+        job.file.path = path
+        return job
+
+
+_indexing_queue: Optional[IndexingQueue] = None
+_indexing_queue_lock = threading.Lock()
+
+
+def get_indexing_queue() -> IndexingQueue:
+    global _indexing_queue
+    with _indexing_queue_lock:
+        if _indexing_queue is None:
+            _indexing_queue = IndexingQueue(
+                workers=int(os.getenv("INDEXING_WORKERS", "1")),
+                batch_size=int(os.getenv("INDEXING_BATCH_SIZE", "16")),
+                batch_wait=float(os.getenv("INDEXING_BATCH_WAIT", "0.2")),
+                db_path=os.getenv("INDEXING_QUEUE_DB"),
+                job_ttl=float(os.getenv("INDEXING_JOB_TTL", "3600")),
+            )
+    return _indexing_queue
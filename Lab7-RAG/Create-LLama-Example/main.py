@@ -15,6 +15,7 @@ from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
 from app.api.routers import api_router
+from app.engine.loaders.readers import init_reader_registry
 from app.middlewares.frontend import FrontendProxyMiddleware
 from app.observability import init_observability
 from app.settings import init_settings
@@ -27,6 +28,7 @@ app = FastAPI(servers=servers)
 
 init_settings()
 init_observability()
+init_reader_registry()
 
 environment = os.getenv("ENVIRONMENT", "dev")  # Default to 'development' if not set
 logger = logging.getLogger("uvicorn")
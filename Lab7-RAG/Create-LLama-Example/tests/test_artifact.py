@@ -0,0 +1,182 @@
+import asyncio
+import sys
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import pytest
+from cachetools import LRUCache
+
+from app.engine.tools import artifact
+from app.engine.tools.artifact import (
+    CodeArtifact,
+    CodeArtifactEdit,
+    CodeEdit,
+    CodeGeneratorTool,
+)
+
+ARTIFACT_FIELDS: Dict[str, Any] = {
+    "commentary": "A script that prints a greeting",
+    "template": "code-interpreter-multilang",
+    "title": "Greeting",
+    "description": "Prints a greeting.",
+    "additional_dependencies": [],
+    "has_additional_dependencies": False,
+    "install_dependencies_command": "",
+    "port": None,
+    "file_path": "script.py",
+}
+
+
+def _artifact(code: str) -> CodeArtifact:
+    return CodeArtifact(**ARTIFACT_FIELDS, code=code)
+
+
+def _edit(*edits: CodeEdit) -> CodeArtifactEdit:
+    return CodeArtifactEdit(**ARTIFACT_FIELDS, edits=list(edits))
+
+
+class FakeStructuredLLM:
+    def __init__(self, llm: "FakeLLM", output_cls: type):
+        self.llm = llm
+        self.output_cls = output_cls
+
+    def _next(self) -> Any:
+        self.llm.calls.append(self.output_cls)
+        return self.llm.responses[self.output_cls].pop(0)
+
+    def chat(self, messages):
+        return SimpleNamespace(raw=self._next())
+
+    async def achat(self, messages):
+        return SimpleNamespace(raw=self._next())
+
+    async def astream_chat(self, messages):
+        result = self._next()
+
+        async def stream():
+            yield SimpleNamespace(
+                raw=self.output_cls.model_construct(commentary=result.commentary)
+            )
+            yield SimpleNamespace(raw=result)
+
+        return stream()
+
+
+class FakeLLM:
+    def __init__(self, responses: Dict[type, List[Any]]):
+        self.responses = responses
+        self.calls: List[type] = []
+
+    def as_structured_llm(self, output_cls: type) -> FakeStructuredLLM:
+        return FakeStructuredLLM(self, output_cls)
+
+
+@pytest.fixture(autouse=True)
+def artifact_cache(monkeypatch):
+    monkeypatch.setattr(artifact, "_artifact_cache", LRUCache(maxsize=16))
+
+
+def _use_send_event(monkeypatch, send_event) -> None:
+    # The routers package imports the whole app, only the event sender is needed
+    monkeypatch.setitem(
+        sys.modules, "app.api.routers.events", SimpleNamespace(send_event=send_event)
+    )
+
+
+def _use_llm(monkeypatch, responses: Dict[type, List[Any]]) -> FakeLLM:
+    llm = FakeLLM(responses)
+    monkeypatch.setattr(artifact, "Settings", SimpleNamespace(llm=llm))
+    return llm
+
+
+def test_edits_are_applied():
+    edit = _edit(
+        CodeEdit(original='print("hello")', replacement='print("hi")'),
+        CodeEdit(original="# end", replacement="# done"),
+    )
+
+    result = edit.apply('print("hello")\n# end\n')
+
+    assert result is not None
+    assert result.code == 'print("hi")\n# done\n'
+    assert result.title == "Greeting"
+
+
+def test_edits_must_match_exactly_once():
+    old_code = "x = 1\nx = 1\n"
+
+    assert _edit(CodeEdit(original="x = 1", replacement="x = 2")).apply(old_code) is None
+    assert _edit(CodeEdit(original="y = 1", replacement="y = 2")).apply(old_code) is None
+
+
+def test_failed_edits_regenerate_the_code(monkeypatch):
+    llm = _use_llm(
+        monkeypatch,
+        {
+            CodeArtifactEdit: [_edit(CodeEdit(original="missing", replacement=""))],
+            CodeArtifact: [_artifact('print("hi")')],
+        },
+    )
+
+    result = CodeGeneratorTool().artifact("Say hi", old_code='print("hello")')
+
+    assert result["code"] == 'print("hi")'
+    assert llm.calls == [CodeArtifactEdit, CodeArtifact]
+
+
+def test_cached_artifacts_are_copies(monkeypatch):
+    llm = _use_llm(monkeypatch, {CodeArtifact: [_artifact('print("hello")')]})
+    tool = CodeGeneratorTool()
+
+    first = tool.artifact("Say hello", sandbox_files=["/tmp/data.csv"])
+    first["files"].append("/tmp/other.csv")
+    first["additional_dependencies"].append("requests")
+    second = tool.artifact("Say hello", sandbox_files=["/tmp/data.csv"])
+
+    assert second["files"] == ["/tmp/data.csv"]
+    assert second["additional_dependencies"] == []
+    assert llm.calls == [CodeArtifact]
+
+
+def test_regenerate_bypasses_the_cache(monkeypatch):
+    llm = _use_llm(
+        monkeypatch,
+        {CodeArtifact: [_artifact('print("hello")'), _artifact('print("hey")')]},
+    )
+    tool = CodeGeneratorTool()
+
+    tool.artifact("Say hello")
+    regenerated = tool.artifact("Say hello", regenerate=True)
+
+    assert regenerated["code"] == 'print("hey")'
+    assert tool.artifact("Say hello")["code"] == 'print("hey")'
+    assert llm.calls == [CodeArtifact, CodeArtifact]
+
+
+def test_artifact_is_generated_without_streaming_without_a_client(monkeypatch):
+    _use_llm(monkeypatch, {CodeArtifact: [_artifact('print("hello")')]})
+    _use_send_event(monkeypatch, lambda data: False)
+
+    result = asyncio.run(CodeGeneratorTool().aartifact("Say hello"))
+
+    assert result["code"] == 'print("hello")'
+
+
+def test_partial_artifacts_are_streamed(monkeypatch):
+    _use_llm(monkeypatch, {CodeArtifact: [_artifact('print("hello")')]})
+    sent: List[Dict] = []
+
+    def send_event(data: Dict) -> bool:
+        sent.append(data)
+        return True
+
+    _use_send_event(monkeypatch, send_event)
+    tool = CodeGeneratorTool()
+    tool.stream_interval = 0
+
+    result = asyncio.run(tool.aartifact("Say hello"))
+
+    assert result["code"] == 'print("hello")'
+    partials = [event["data"] for event in sent if event["type"] == "artifact_stream"]
+    assert partials[0] == {"commentary": ARTIFACT_FIELDS["commentary"]}
+    assert partials[-1]["code"] == 'print("hello")'
@@ -0,0 +1,147 @@
+import os
+
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
+
+from app.engine import bm25
+from app.engine.bm25 import (
+    BM25Index,
+    add_nodes_to_bm25_index,
+    delete_from_bm25_index,
+    get_bm25_index,
+    tokenize,
+)
+from app.engine.local_vector_store import LocalVectorStore
+
+
+def _node(node_id: str, text: str, ref_doc_id: str = "doc", **metadata) -> TextNode:
+    node = TextNode(id_=node_id, text=text, embedding=[1.0, 0.0])
+    node.metadata.update(metadata)
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+    return node
+
+
+def _index(tmp_path, **kwargs) -> BM25Index:
+    vector_store = LocalVectorStore(persist_dir=str(tmp_path / "vectors"))
+    index = BM25Index(
+        path=str(tmp_path / "bm25.jsonl"), vector_store=vector_store, **kwargs
+    )
+    # Start from the empty vector store, so the added nodes are logged
+    index._ensure_log()
+    return index
+
+
+def _ids(results):
+    return [node_id for node_id, _ in results]
+
+
+def test_tokenize_keeps_identifiers():
+    assert tokenize("The part AB-1234 of clause 4.2") == [
+        "part", "ab-1234", "ab", "1234", "clause", "4.2", "4", "2",
+    ]  # fmt: skip
+
+
+def test_search(tmp_path):
+    index = _index(tmp_path)
+    index.add(
+        [
+            _node("a", "the pump AB-1234 is leaking"),
+            _node("b", "replace the filter every month"),
+        ]
+    )
+
+    assert _ids(index.search("1234 leak", 5)) == ["a"]
+    assert _ids(index.search("filter", 5)) == ["b"]
+    assert index.search("unknown", 5) == []
+
+
+def test_update_and_delete(tmp_path):
+    index = _index(tmp_path)
+    index.add([_node("a", "old pump manual", ref_doc_id="doc1")])
+    index.add([_node("a", "new valve manual", ref_doc_id="doc1")])
+    index.add([_node("b", "pump and valve", ref_doc_id="doc2")])
+
+    assert _ids(index.search("pump", 5)) == ["b"]
+
+    index.delete("doc2")
+
+    assert _ids(index.search("pump valve", 5)) == ["a"]
+
+
+def test_reload_from_log(tmp_path):
+    index = _index(tmp_path)
+    index.add([_node("a", "pump manual", ref_doc_id="doc1")])
+    index.add([_node("b", "pump spare parts", ref_doc_id="doc2")])
+    index.delete("doc1")
+
+    reloaded = _index(tmp_path)
+
+    assert _ids(reloaded.search("pump", 5)) == ["b"]
+
+
+def test_filters(tmp_path):
+    index = _index(tmp_path)
+    index.add(
+        [
+            _node("public", "pump manual", private="false"),
+            _node("private", "pump manual", ref_doc_id="file1", private="true"),
+        ]
+    )
+    public_filters = MetadataFilters(
+        filters=[MetadataFilter(key="private", value="true", operator="!=")]
+    )
+    doc_filters = MetadataFilters(
+        filters=[MetadataFilter(key="doc_id", value=["file1"], operator="in")]
+    )
+
+    assert _ids(index.search("pump", 5, public_filters)) == ["public"]
+    assert _ids(index.search("pump", 5, doc_filters)) == ["private"]
+
+
+def test_compaction(tmp_path):
+    index = _index(tmp_path, compact_min_records=4)
+    index.search("pump", 5)
+    for i in range(3):
+        index.add([_node("a", f"pump revision {i}", ref_doc_id="doc1")])
+    index.add([_node("b", "valve", ref_doc_id="doc2")])
+
+    with open(index.path) as f:
+        assert len(f.readlines()) == 2
+    assert _ids(index.search("pump", 5)) == ["a"]
+    assert _ids(_index(tmp_path).search("revision 2", 5)) == ["a"]
+
+
+def test_log_is_built_from_the_vector_store_on_first_search(tmp_path):
+    vector_store = LocalVectorStore(persist_dir=str(tmp_path / "vectors"))
+    index = BM25Index(path=str(tmp_path / "bm25.jsonl"), vector_store=vector_store)
+    nodes = [_node("a", "pump manual")]
+    vector_store.add(nodes)
+
+    # Without a log, inserts don't scan the vector store
+    index.add(nodes)
+    assert not os.path.exists(index.path)
+
+    assert _ids(index.search("pump", 5)) == ["a"]
+
+
+def test_index_is_only_maintained_in_hybrid_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25, "BM25_DIR", str(tmp_path / "bm25"))
+    monkeypatch.setattr(bm25, "_bm25_indexes", {})
+    vector_store = LocalVectorStore(persist_dir=str(tmp_path / "vectors"))
+    nodes = [_node("a", "pump manual", ref_doc_id="doc1")]
+    vector_store.add(nodes)
+
+    monkeypatch.setenv("RETRIEVAL_MODE", "hybrid")
+    bm25_index = get_bm25_index(vector_store)
+    assert _ids(bm25_index.search("pump", 5)) == ["a"]
+
+    # A log left by hybrid mode would go stale, it's dropped to be rebuilt later
+    monkeypatch.setenv("RETRIEVAL_MODE", "dense")
+    vector_store.delete("doc1")
+    delete_from_bm25_index(vector_store, ["doc1"])
+    assert not os.path.exists(bm25_index.path)
+
+    monkeypatch.setenv("RETRIEVAL_MODE", "hybrid")
+    vector_store.add([_node("b", "valve manual", ref_doc_id="doc2")])
+    add_nodes_to_bm25_index(vector_store, [])
+    assert _ids(get_bm25_index(vector_store).search("pump valve", 5)) == ["b"]
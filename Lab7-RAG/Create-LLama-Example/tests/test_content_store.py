@@ -0,0 +1,130 @@
+import hashlib
+
+import pytest
+
+from app.services import indexing
+from app.services.content_store import ContentStatus, ContentStore
+from app.services.file import DocumentFile
+from app.services.indexing import IndexingJob, IndexingQueue
+
+
+@pytest.fixture(autouse=True)
+def indexing_queue(monkeypatch):
+    queue = IndexingQueue()
+    monkeypatch.setattr(indexing, "_indexing_queue", queue)
+    return queue
+
+
+def _file(tmp_path, file_id: str, content: bytes = b"content") -> DocumentFile:
+    path = tmp_path / f"{file_id}.txt"
+    path.write_bytes(content)
+    return DocumentFile(
+        id=file_id,
+        name=path.name,
+        type="txt",
+        size=len(content),
+        url=f"/api/files/{path.name}",
+        path=str(path),
+        hash=hashlib.sha256(content).hexdigest(),
+    )
+
+
+def _status(store: ContentStore, file_id: str) -> str:
+    (status,) = store._db.execute(
+        "SELECT status FROM content_files WHERE file_id = ?", (file_id,)
+    ).fetchone()
+    return status
+
+
+def test_interrupted_files_are_failed_on_startup(tmp_path, indexing_queue):
+    db_path = str(tmp_path / "content.db")
+    store = ContentStore(db_path)
+    interrupted, _ = store.register(_file(tmp_path, "interrupted"), "alice")
+    resumed_file, _ = store.register(_file(tmp_path, "resumed", b"other"), "alice")
+    resumed = IndexingJob(id="job", file=resumed_file)
+    indexing_queue._jobs[resumed.id] = resumed
+    store.update(resumed_file.model_copy(update={"job_id": resumed.id}))
+
+    store = ContentStore(db_path)
+
+    assert _status(store, "interrupted") == ContentStatus.FAILED.value
+    assert _status(store, "resumed") == ContentStatus.PENDING.value
+
+
+def test_register_deduplicates_by_content(tmp_path):
+    store = ContentStore(str(tmp_path / "content.db"))
+    first, is_new = store.register(_file(tmp_path, "first"), "alice")
+    assert is_new
+
+    duplicate, is_new = store.register(_file(tmp_path, "second"), "bob")
+
+    assert not is_new
+    assert duplicate.id == "first"
+    assert duplicate.release_token != first.release_token
+
+
+def test_namespaces_are_not_deduplicated(tmp_path):
+    store = ContentStore(str(tmp_path / "content.db"))
+    store.register(_file(tmp_path, "first"), "alice", namespace="alice")
+
+    stored, is_new = store.register(_file(tmp_path, "second"), "bob", namespace="bob")
+
+    assert is_new
+    assert stored.id == "second"
+
+
+def test_failed_content_is_registered_again(tmp_path):
+    store = ContentStore(str(tmp_path / "content.db"))
+    first, _ = store.register(_file(tmp_path, "first"), "alice")
+    store.update(first, ContentStatus.FAILED)
+
+    stored, is_new = store.register(_file(tmp_path, "second"), "alice")
+
+    assert is_new
+    assert stored.id == "second"
+
+
+def test_content_of_a_lost_job_is_registered_again(tmp_path, indexing_queue):
+    store = ContentStore(str(tmp_path / "content.db"))
+    first, _ = store.register(_file(tmp_path, "first"), "alice")
+    store.update(first.model_copy(update={"job_id": "lost"}))
+    second, is_new = store.register(_file(tmp_path, "second"), "alice")
+    assert is_new
+
+    indexing_queue._jobs["live"] = IndexingJob(id="live", file=second)
+    store.update(second.model_copy(update={"job_id": "live"}))
+    duplicate, is_new = store.register(_file(tmp_path, "third"), "bob")
+
+    assert not is_new
+    assert duplicate.id == "second"
+
+
+def test_release_requires_the_release_token(tmp_path):
+    store = ContentStore(str(tmp_path / "content.db"))
+    stored, _ = store.register(_file(tmp_path, "first"), "alice")
+
+    with pytest.raises(PermissionError):
+        store.release("first", "alice", "wrong")
+    with pytest.raises(PermissionError):
+        store.release("first", "alice", None)
+    with pytest.raises(ValueError):
+        store.release("first", "bob", stored.release_token)
+    with pytest.raises(ValueError):
+        store.release("unknown", "alice", stored.release_token)
+
+
+def test_file_is_removed_with_its_last_reference(tmp_path):
+    store = ContentStore(str(tmp_path / "content.db"))
+    alice, _ = store.register(_file(tmp_path, "first"), "alice")
+    again, _ = store.register(_file(tmp_path, "second"), "alice")
+    bob, _ = store.register(_file(tmp_path, "third"), "bob")
+    # An owner keeps the same token for all its references
+    assert again.release_token == alice.release_token
+
+    assert store.release("first", "alice", alice.release_token) is None
+    assert store.release("first", "bob", bob.release_token) is None
+    released = store.release("first", "alice", alice.release_token)
+
+    assert released is not None and released.id == "first"
+    with pytest.raises(ValueError):
+        store.release("first", "alice", alice.release_token)
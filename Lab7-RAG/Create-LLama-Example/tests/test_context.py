@@ -0,0 +1,88 @@
+import pytest
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import (
+    ImageNode,
+    NodeRelationship,
+    NodeWithScore,
+    RelatedNodeInfo,
+    TextNode,
+)
+from llama_index.core.settings import Settings
+
+from app.engine.context import ContextPacker
+
+
+@pytest.fixture(autouse=True)
+def mock_llm():
+    # The tokenizer is picked by the active LLM
+    Settings.llm = MockLLM()
+
+
+def _text(node_id: str, text: str, start: int, score: float, ref_doc_id: str = "doc"):
+    node = TextNode(
+        id_=node_id, text=text, start_char_idx=start, end_char_idx=start + len(text)
+    )
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+    return NodeWithScore(node=node, score=score)
+
+
+def _image(node_id: str, score: float):
+    return NodeWithScore(
+        node=ImageNode(id_=node_id, image_path=f"{node_id}.png"), score=score
+    )
+
+
+def _pack(nodes):
+    return ContextPacker(token_budget=100000).postprocess_nodes(nodes)
+
+
+def test_merges_overlapping_chunks():
+    packed = _pack(
+        [
+            _text("a", "the pump is ", 0, 0.5),
+            _text("b", "pump is leaking", 4, 0.9),
+        ]
+    )
+
+    assert len(packed) == 1
+    assert packed[0].node.get_content() == "the pump is leaking"
+    assert packed[0].score == 0.9
+
+
+def test_keeps_chunks_of_other_documents():
+    packed = _pack(
+        [
+            _text("a", "the pump is ", 0, 0.5, ref_doc_id="doc1"),
+            _text("b", "pump is leaking", 4, 0.9, ref_doc_id="doc2"),
+        ]
+    )
+
+    assert [node.node.node_id for node in packed] == ["b", "a"]
+
+
+def test_containment_requires_matching_text():
+    packed = _pack(
+        [
+            _text("a", "the pump is leaking", 0, 0.9),
+            _text("b", "valve", 4, 0.5),
+        ]
+    )
+
+    assert len(packed) == 2
+
+
+def test_drops_duplicate_content():
+    packed = _pack(
+        [
+            _text("a", "the pump", 0, 0.9, ref_doc_id="doc1"),
+            _text("b", "the pump", 0, 0.5, ref_doc_id="doc2"),
+        ]
+    )
+
+    assert [node.node.node_id for node in packed] == ["a"]
+
+
+def test_keeps_image_nodes():
+    packed = _pack([_image("img1", 0.9), _image("img2", 0.8), _image("img1", 0.7)])
+
+    assert [node.node.node_id for node in packed] == ["img1", "img2"]
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from app.engine.tools import document_generator
+from app.engine.tools.document_generator import DocumentGenerator
+
+
+@pytest.fixture(autouse=True)
+def directories(tmp_path, monkeypatch):
+    # The render workers may outlive a test, so the paths are absolute
+    monkeypatch.setattr(document_generator, "OUTPUT_DIR", str(tmp_path / "output"))
+    monkeypatch.setattr(
+        document_generator, "RENDER_CACHE_DIR", str(tmp_path / "storage" / "documents")
+    )
+    monkeypatch.setenv("FILESERVER_URL_PREFIX", "http://localhost/api/files")
+
+
+def _path(file_name: str) -> str:
+    return os.path.join(document_generator.OUTPUT_DIR, file_name)
+
+
+def test_document_is_published_when_the_url_is_returned():
+    url = DocumentGenerator.generate_document("# Report", "html", "report")
+
+    assert url.endswith("/report.html")
+    with open(_path("report.html")) as f:
+        assert "<h1>Report</h1>" in f.read()
+
+
+def test_rendered_documents_are_reused_from_the_cache():
+    DocumentGenerator.generate_document("# Report", "html", "report")
+    DocumentGenerator.generate_document("# Report", "html", "copy")
+
+    assert len(os.listdir(document_generator.RENDER_CACHE_DIR)) == 1
+    with open(_path("report.html")) as report, open(_path("copy.html")) as copy:
+        assert report.read() == copy.read()
+
+
+def test_render_cache_is_bounded(monkeypatch):
+    monkeypatch.setenv("DOCUMENT_RENDER_CACHE_SIZE", "2")
+
+    for i in range(4):
+        DocumentGenerator.generate_document(f"# Report {i}", "html", f"report{i}")
+
+    assert len(os.listdir(document_generator.RENDER_CACHE_DIR)) == 2
+    # The published documents are kept
+    assert all(os.path.exists(_path(f"report{i}.html")) for i in range(4))
+
+
+def test_invalid_file_name():
+    with pytest.raises(ValueError):
+        DocumentGenerator.generate_document("# Report", "html", "../report")
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import threading
+import time
+from typing import List
+
+import pytest
+
+from app.engine.tools.duckduckgo import FixtureBackend, SearchService
+
+FIXTURE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "config", "duckduckgo_fixture.json"
+)
+
+
+class CountingBackend(FixtureBackend):
+    def __init__(self, latency: float = 0.0):
+        super().__init__(FIXTURE_PATH, latency=latency)
+        self.queries: List[str] = []
+
+    def _search(self, kind: str, query: str, max_results: int) -> List[dict]:
+        self.queries.append(query)
+        return super()._search(kind, query, max_results)
+
+
+def test_fixture_backend():
+    backend = FixtureBackend(FIXTURE_PATH)
+
+    assert len(backend.text("llamaindex", "wt-wt", 10)) == 2
+    assert len(backend.text("llamaindex", "wt-wt", 1)) == 1
+    assert len(backend.images("llama", "wt-wt", 10)) == 1
+    assert backend.text("unknown", "wt-wt", 10) == []
+
+
+def test_results_are_cached():
+    backend = CountingBackend()
+    service = SearchService(backend, min_interval=0)
+
+    first = service.search("text", "llamaindex", "wt-wt", 10)
+    second = service.search("text", "llamaindex", "wt-wt", 10)
+
+    assert first == second
+    assert backend.queries == ["llamaindex"]
+
+
+def test_concurrent_identical_searches_are_coalesced():
+    backend = CountingBackend(latency=0.2)
+    service = SearchService(backend, min_interval=0)
+    results: List[List[dict]] = []
+
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                service.search("text", "llamaindex", "wt-wt", 10)
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 4
+    assert backend.queries == ["llamaindex"]
+
+
+def test_requests_are_rate_limited():
+    backend = CountingBackend()
+    service = SearchService(backend, min_interval=0.2)
+    start = time.monotonic()
+    service.search("text", "a", "wt-wt", 10)
+    service.search("text", "b", "wt-wt", 10)
+    service.search("text", "c", "wt-wt", 10)
+
+    assert time.monotonic() - start >= 0.4
+    assert backend.queries == ["a", "b", "c"]
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_search():
+    backend = CountingBackend(latency=0.2)
+    # The shared search is queued behind another one
+    service = SearchService(backend, min_interval=0, max_workers=1)
+
+    async def search():
+        busy = asyncio.create_task(service.asearch("text", "busy", "wt-wt", 10))
+        cancelled = asyncio.create_task(
+            service.asearch("text", "llamaindex", "wt-wt", 10)
+        )
+        waiting = asyncio.create_task(
+            service.asearch("text", "llamaindex", "wt-wt", 10)
+        )
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await busy
+        return await waiting
+
+    assert len(asyncio.run(search())) == 2
+    assert backend.queries == ["busy", "llamaindex"]
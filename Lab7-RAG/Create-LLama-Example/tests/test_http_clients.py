@@ -0,0 +1,30 @@
+import asyncio
+import gc
+
+from app.engine.tools.http_clients import AsyncClients
+
+
+def test_one_client_per_loop():
+    clients = AsyncClients(timeout=5)
+
+    async def get_twice():
+        return clients.get(), clients.get()
+
+    first, second = asyncio.run(get_twice())
+    other, _ = asyncio.run(get_twice())
+
+    assert first is second
+    assert other is not first
+
+
+def test_clients_of_closed_loops_are_dropped():
+    clients = AsyncClients(timeout=5)
+
+    async def get():
+        clients.get()
+
+    for _ in range(3):
+        asyncio.run(get())
+    gc.collect()
+
+    assert len(clients) <= 1
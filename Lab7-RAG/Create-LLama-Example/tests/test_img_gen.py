@@ -0,0 +1,62 @@
+import os
+import time
+
+import httpx
+import pytest
+from cachetools import LRUCache
+
+from app.engine.tools.img_gen import ImageGeneratorTool
+
+
+@pytest.fixture
+def tool(tmp_path, monkeypatch):
+    monkeypatch.setenv("STABILITY_API_KEY", "test")
+    monkeypatch.setenv("FILESERVER_URL_PREFIX", "http://localhost/api/files")
+    monkeypatch.setattr(ImageGeneratorTool, "_IMG_OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(ImageGeneratorTool, "_image_files", LRUCache(maxsize=16))
+    tool = ImageGeneratorTool()
+    calls = []
+
+    def call_stability_api(prompt: str) -> httpx.Response:
+        calls.append(prompt)
+        return httpx.Response(200, content=f"image {len(calls)}".encode())
+
+    monkeypatch.setattr(tool, "_call_stability_api", call_stability_api)
+    tool.calls = calls  # type: ignore
+    return tool
+
+
+def test_repeated_prompt_reuses_the_image(tool):
+    first = tool.generate_image("a cat")
+    second = tool.generate_image("a cat")
+
+    assert first.image_url == second.image_url
+    assert tool.calls == ["a cat"]
+
+
+def _path(tool, image_url: str) -> str:
+    return os.path.join(tool._IMG_OUTPUT_DIR, os.path.basename(image_url))
+
+
+def test_regenerate_bypasses_the_cache(tool):
+    first = tool.generate_image("a cat")
+    second = tool.generate_image("a cat", regenerate=True)
+
+    assert tool.calls == ["a cat", "a cat"]
+    # The earlier image is kept for the messages that link to it
+    assert second.image_url != first.image_url
+    with open(_path(tool, first.image_url), "rb") as f:
+        assert f.read() == b"image 1"
+    assert tool.generate_image("a cat").image_url == second.image_url
+
+
+def test_cached_image_expires(tool, monkeypatch):
+    monkeypatch.setattr(ImageGeneratorTool, "cache_ttl", 60)
+    output = tool.generate_image("a cat")
+    path = _path(tool, output.image_url)
+    expired = time.time() - 61
+    os.utime(path, (expired, expired))
+
+    tool.generate_image("a cat")
+
+    assert tool.calls == ["a cat", "a cat"]
@@ -0,0 +1,38 @@
+from app.services.file import DocumentFile
+from app.services.indexing import IndexingJob, IndexingJobStatus, IndexingQueue
+
+
+def _job(queue: IndexingQueue, job_id: str) -> IndexingJob:
+    document_file = DocumentFile(
+        id=job_id, name=f"{job_id}.txt", type="txt", size=0, url=f"/{job_id}.txt"
+    )
+    job = IndexingJob(id=job_id, file=document_file)
+    queue._jobs[job.id] = job
+    return job
+
+
+def test_finished_jobs_are_evicted_after_their_ttl():
+    queue = IndexingQueue(job_ttl=0)
+    running = _job(queue, "running")
+    done = _job(queue, "done")
+
+    queue._update(running, IndexingJobStatus.RUNNING)
+    queue._update(done, IndexingJobStatus.DONE)
+
+    assert queue.get("running") is running
+    assert queue.get("done") is None
+
+
+def test_finished_jobs_are_kept_within_their_ttl():
+    queue = IndexingQueue(job_ttl=3600)
+    done = _job(queue, "done")
+    failed = _job(queue, "failed")
+
+    queue._update(done, IndexingJobStatus.DONE)
+    queue._update(failed, IndexingJobStatus.FAILED, "error")
+
+    assert queue.get("done") is done
+    assert queue.is_active("done")
+    assert queue.get("failed") is failed
+    assert not queue.is_active("failed")
+    assert not queue.is_active("unknown")
@@ -0,0 +1,35 @@
+from typing import List
+
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+from pydantic import Field
+
+from app.engine.ingestion import BatchEmbedding
+
+
+class SyncOnlyEmbedding(MockEmbedding):
+    batch_sizes: List[int] = Field(default_factory=list)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.batch_sizes.append(len(texts))
+        return super()._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        raise AssertionError("The async client must not be used")
+
+
+def test_batches_are_embedded_with_the_sync_client():
+    embed_model = SyncOnlyEmbedding(embed_dim=4)
+    embedded = TextNode(text="embedded", embedding=[1.0, 0.0, 0.0, 0.0])
+    nodes = [TextNode(text=f"node {i}") for i in range(5)] + [embedded]
+    embedding = BatchEmbedding(embed_model=embed_model, batch_size=2, concurrency=2)
+
+    # Repeated calls don't depend on a previous event loop
+    for _ in range(2):
+        for node in nodes[:5]:
+            node.embedding = None
+        embedding(nodes)
+
+    assert all(node.embedding is not None for node in nodes)
+    assert embedded.embedding == [1.0, 0.0, 0.0, 0.0]
+    assert sorted(embed_model.batch_sizes) == [1, 1, 2, 2, 2, 2]
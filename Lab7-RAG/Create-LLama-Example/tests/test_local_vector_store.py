@@ -0,0 +1,118 @@
+import numpy as np
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import (
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from app.engine.local_vector_store import LocalVectorStore, _IVFIndex
+
+
+def _node(node_id: str, embedding, ref_doc_id: str = "doc", **metadata) -> TextNode:
+    node = TextNode(id_=node_id, text=f"text of {node_id}", embedding=embedding)
+    node.metadata.update(metadata)
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+    return node
+
+
+def _query(store: LocalVectorStore, embedding, top_k: int = 2, filters=None):
+    return store.query(
+        VectorStoreQuery(
+            query_embedding=embedding, similarity_top_k=top_k, filters=filters
+        )
+    )
+
+
+def test_add_and_query(tmp_path):
+    store = LocalVectorStore(persist_dir=str(tmp_path))
+    store.add(
+        [
+            _node("a", [1.0, 0.0, 0.0]),
+            _node("b", [0.0, 1.0, 0.0]),
+            _node("c", [0.7, 0.7, 0.0]),
+        ]
+    )
+
+    result = _query(store, [1.0, 0.0, 0.0])
+
+    assert result.ids == ["a", "c"]
+    assert result.similarities[0] == 1.0
+    assert result.nodes[0].get_content() == "text of a"
+
+
+def test_update_replaces_the_node(tmp_path):
+    store = LocalVectorStore(persist_dir=str(tmp_path))
+    store.add([_node("a", [1.0, 0.0]), _node("b", [0.0, 1.0])])
+    store.add([_node("a", [0.0, 1.0])])
+
+    result = _query(store, [0.0, 1.0])
+
+    assert sorted(result.ids) == ["a", "b"]
+    assert result.similarities == [1.0, 1.0]
+    assert len(store.get_nodes()) == 2
+
+
+def test_delete_by_ref_doc_id(tmp_path):
+    store = LocalVectorStore(persist_dir=str(tmp_path))
+    store.add(
+        [
+            _node("a", [1.0, 0.0], ref_doc_id="doc1"),
+            _node("b", [0.9, 0.1], ref_doc_id="doc2"),
+        ]
+    )
+
+    store.delete("doc1")
+
+    assert _query(store, [1.0, 0.0]).ids == ["b"]
+    assert [node.node_id for node in store.get_nodes()] == ["b"]
+
+
+def test_reload_keeps_nodes_and_deletes(tmp_path):
+    store = LocalVectorStore(persist_dir=str(tmp_path))
+    store.add(
+        [
+            _node("a", [1.0, 0.0], ref_doc_id="doc1"),
+            _node("b", [0.0, 1.0], ref_doc_id="doc2"),
+        ]
+    )
+    store.delete("doc1")
+    store.persist(str(tmp_path))
+
+    reloaded = LocalVectorStore(persist_dir=str(tmp_path))
+
+    assert _query(reloaded, [1.0, 0.0]).ids == ["b"]
+    reloaded.add([_node("c", [1.0, 0.0])])
+    assert _query(reloaded, [1.0, 0.0], top_k=1).ids == ["c"]
+
+
+def test_filters(tmp_path):
+    store = LocalVectorStore(persist_dir=str(tmp_path))
+    store.add(
+        [
+            _node("public", [1.0, 0.0], private="false"),
+            _node("private", [1.0, 0.0], ref_doc_id="file1", private="true"),
+        ]
+    )
+    filters = MetadataFilters(
+        filters=[MetadataFilter(key="private", value="true", operator="!=")]
+    )
+
+    assert _query(store, [1.0, 0.0], filters=filters).ids == ["public"]
+
+    # The filter metadata is loaded lazily after a reload
+    reloaded = LocalVectorStore(persist_dir=str(tmp_path))
+    assert _query(reloaded, [1.0, 0.0], filters=filters).ids == ["public"]
+    doc_filters = MetadataFilters(
+        filters=[MetadataFilter(key="doc_id", value=["file1"], operator="in")]
+    )
+    assert _query(reloaded, [1.0, 0.0], filters=doc_filters).ids == ["private"]
+
+
+def test_ivf_trains_on_few_vectors():
+    vectors = np.eye(4, dtype=np.float32)
+
+    ivf = _IVFIndex.train(vectors, 4)
+
+    assert len(ivf.centroids) == 4
+    assert len(ivf.candidates(vectors[0], 4, probes=1)) > 0
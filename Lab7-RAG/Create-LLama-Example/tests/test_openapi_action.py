@@ -0,0 +1,138 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+pytest.importorskip("llama_index.tools.openapi")
+
+from app.engine.tools import openapi_action  # noqa: E402
+from app.engine.tools.openapi_action import (  # noqa: E402
+    OpenAPIActionToolSpec,
+    OpenAPIOperationIndex,
+)
+
+SPEC = {
+    "openapi": "3.0.0",
+    "servers": [{"url": "https://petstore.example.com/v1/"}],
+    "paths": {
+        "/pets": {
+            "get": {
+                "operationId": "listPets",
+                "summary": "List all pets",
+                "parameters": [{"name": "status", "in": "query"}],
+            },
+            "post": {
+                "operationId": "createPet",
+                "summary": "Create a pet",
+                "requestBody": {
+                    "content": {
+                        "application/json": {
+                            "schema": {"$ref": "#/components/schemas/Pet"}
+                        }
+                    }
+                },
+            },
+        },
+        "/pets/{petId}": {
+            "parameters": [{"$ref": "#/components/parameters/PetId"}],
+            "get": {"operationId": "showPetById", "summary": "Info for a pet"},
+        },
+    },
+    "components": {
+        "parameters": {"PetId": {"name": "petId", "in": "path", "required": True}},
+        "schemas": {
+            "Pet": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "parent": {"$ref": "#/components/schemas/Pet"},
+                },
+            }
+        },
+    },
+}
+
+
+@pytest.fixture
+def spec_uri(tmp_path, monkeypatch):
+    monkeypatch.setattr(OpenAPIActionToolSpec, "_indexes", {})
+    spec_path = tmp_path / "openapi.yaml"
+    spec_path.write_text(yaml.safe_dump(SPEC))
+    return f"file://{spec_path}"
+
+
+def _index() -> OpenAPIOperationIndex:
+    return OpenAPIOperationIndex.from_spec("file:///openapi.yaml", {}, SPEC, [])
+
+
+def test_operations_are_indexed():
+    index = _index()
+
+    assert [operation.operation_id for operation in index.operations] == [
+        "listPets",
+        "createPet",
+        "showPetById",
+    ]
+    assert index.base_url == "https://petstore.example.com/v1"
+    assert index.get("showPetById").parameters == [
+        {"name": "petId", "in": "path", "required": True}
+    ]
+
+
+def test_refs_are_resolved_up_to_the_max_depth():
+    request_body = _index().get("createPet").request_body
+
+    assert request_body["properties"]["name"] == {"type": "string"}
+    nested = request_body
+    for _ in range(openapi_action.MAX_REF_DEPTH - 1):
+        nested = nested["properties"]["parent"]
+    # The recursive schema is kept as a ref at the max depth
+    assert nested["properties"]["parent"] == {"$ref": "#/components/schemas/Pet"}
+
+
+def test_search_ignores_the_http_method():
+    index = _index()
+
+    assert index.search("get pets by status")[0].operation_id == "listPets"
+    assert index.search("get") == []
+    assert index.search("post") == []
+
+
+def test_index_is_saved_and_rebuilt_when_the_spec_changes(spec_uri, monkeypatch):
+    monkeypatch.setenv("OPENAPI_REVALIDATE_INTERVAL", "0")
+    index = OpenAPIActionToolSpec._get_operation_index(spec_uri)
+    index_path = OpenAPIActionToolSpec._get_index_path(spec_uri)
+    assert os.path.exists(index_path)
+    assert OpenAPIActionToolSpec._is_index_valid(index)
+
+    spec_path = spec_uri[len("file://") :]
+    spec = {**SPEC, "paths": {"/owners": {"get": {"operationId": "listOwners"}}}}
+    with open(spec_path, "w") as f:
+        yaml.safe_dump(spec, f)
+    os.utime(spec_path, (1, 1))
+
+    assert not OpenAPIActionToolSpec._is_index_valid(index)
+    rebuilt = OpenAPIActionToolSpec._get_operation_index(spec_uri)
+    assert [operation.operation_id for operation in rebuilt.operations] == ["listOwners"]
+
+
+def test_remote_index_is_validated_through_redirects(monkeypatch):
+    requests = pytest.importorskip("requests")
+    calls = []
+
+    def head(url, **kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(status_code=304)
+
+    monkeypatch.setattr(requests, "head", head)
+    index = OpenAPIOperationIndex(
+        uri="https://example.com/openapi.yaml",
+        version={"etag": '"v1"'},
+        servers=[],
+        operations=[],
+    )
+
+    assert OpenAPIActionToolSpec._is_index_valid(index)
+    assert calls[0]["allow_redirects"] is True
+    assert calls[0]["headers"] == {"If-None-Match": '"v1"'}
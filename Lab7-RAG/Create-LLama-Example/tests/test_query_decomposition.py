@@ -0,0 +1,44 @@
+from typing import List
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from app.engine.query_decomposition import DecomposingQueryEngine
+
+
+class FakeRetriever(BaseRetriever):
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # Every query finds two nodes of its own and a shared one
+        query = query_bundle.query_str
+        return [
+            NodeWithScore(node=TextNode(id_=f"{query}-1", text=f"{query} 1"), score=0.9),
+            NodeWithScore(node=TextNode(id_="shared", text="shared"), score=0.8),
+            NodeWithScore(node=TextNode(id_=f"{query}-2", text=f"{query} 2"), score=0.5),
+        ]
+
+
+def _engine(similarity_top_k: int) -> DecomposingQueryEngine:
+    return DecomposingQueryEngine.from_args(
+        FakeRetriever(), llm=MockLLM(), similarity_top_k=similarity_top_k
+    )
+
+
+def test_merged_nodes_are_cut_to_the_top_k():
+    engine = _engine(similarity_top_k=3)
+    retriever = FakeRetriever()
+    results = [retriever.retrieve(query) for query in ["a", "b", "c"]]
+
+    nodes = engine._merge(results)
+
+    assert [node.node.node_id for node in nodes] == ["a-1", "b-1", "c-1"]
+
+
+def test_merged_nodes_are_deduplicated():
+    engine = _engine(similarity_top_k=10)
+    retriever = FakeRetriever()
+    results = [retriever.retrieve(query) for query in ["a", "b"]]
+
+    nodes = engine._merge(results)
+
+    assert [node.node.node_id for node in nodes] == ["a-1", "b-1", "shared", "a-2", "b-2"]
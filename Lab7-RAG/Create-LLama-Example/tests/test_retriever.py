@@ -0,0 +1,56 @@
+import pytest
+from llama_index.core import VectorStoreIndex
+from llama_index.core.callbacks import CallbackManager, CBEventType, LlamaDebugHandler
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.settings import Settings
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
+
+from app.engine.retriever import create_retriever
+
+
+@pytest.fixture(autouse=True)
+def mock_embed_model(monkeypatch):
+    monkeypatch.setenv("RETRIEVAL_MODE", "dense")
+    Settings.embed_model = MockEmbedding(embed_dim=8)
+
+
+def _node(text: str, ref_doc_id: str) -> TextNode:
+    node = TextNode(text=text)
+    # The stored doc_id metadata is the id of the source document
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+    return node
+
+
+def _index(callback_manager: CallbackManager, *texts: str) -> VectorStoreIndex:
+    return VectorStoreIndex(
+        # The in-memory store fails on empty filtered results, so every node is selected
+        [_node(text, "file1") for text in texts],
+        callback_manager=callback_manager,
+    )
+
+
+def test_retrieve_events_reach_the_index_handlers():
+    handler = LlamaDebugHandler()
+    index = _index(CallbackManager([handler]), "shared")
+
+    create_retriever(index, filters=MetadataFilters(filters=[])).retrieve("query")
+
+    assert len(handler.get_event_pairs(CBEventType.RETRIEVE)) == 1
+
+
+def test_merged_retrieve_events_reach_the_index_handlers():
+    handler = LlamaDebugHandler()
+    callback_manager = CallbackManager([handler])
+    index = _index(callback_manager, "shared")
+    private_index = _index(callback_manager, "private")
+    filters = MetadataFilters(
+        filters=[MetadataFilter(key="doc_id", value=["file1"], operator="in")]  # type: ignore
+    )
+
+    create_retriever(index, filters=filters, private_index=private_index).retrieve(
+        "query"
+    )
+
+    # The merged retrieval is reported once
+    assert len(handler.get_event_pairs(CBEventType.RETRIEVE)) == 1
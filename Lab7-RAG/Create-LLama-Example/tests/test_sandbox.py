@@ -0,0 +1,104 @@
+import time
+from typing import Dict, List, Optional
+
+import pytest
+
+from app.engine.tools.sandbox import SandboxPool, SandboxSession
+
+
+class FakeSession(SandboxSession):
+    def __init__(self):
+        super().__init__()
+        self.files: Dict[str, bytes] = {}
+        self.code: List[str] = []
+        self.alive = True
+        self.timeout: Optional[float] = None
+
+    def run_code(self, code: str):
+        self.code.append(code)
+
+    def write_file(self, path: str, content: bytes) -> None:
+        self.files[path] = content
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+    def keep_alive(self, timeout: float) -> None:
+        self.timeout = timeout
+
+    def kill(self) -> None:
+        self.alive = False
+
+
+class FakePool(SandboxPool):
+    def __init__(self, **kwargs):
+        super().__init__(backend="local", size=0, **kwargs)
+
+    def _create_session(self) -> SandboxSession:
+        return FakeSession()
+
+
+def test_session_is_abstract():
+    with pytest.raises(TypeError):
+        SandboxSession()  # type: ignore
+
+
+def test_sync_files_only_uploads_changed_files(tmp_path):
+    local_path = tmp_path / "data.csv"
+    local_path.write_text("a,b")
+    session = FakeSession()
+
+    assert session.sync_files([("/tmp/data.csv", str(local_path))]) == 1
+    assert session.sync_files([("/tmp/data.csv", str(local_path))]) == 0
+    local_path.write_text("a,b,c")
+    assert session.sync_files([("/tmp/data.csv", str(local_path))]) == 1
+    assert session.files["/tmp/data.csv"] == b"a,b,c"
+
+
+def test_sessions_are_only_reused_by_their_owner():
+    pool = FakePool()
+    session = pool.acquire("alice")
+    pool.release(session, "alice")
+
+    other = pool.acquire("bob")
+    assert other is not session
+    assert pool.acquire("alice") is session
+    assert session.code == ["%reset -f"]
+
+
+def test_sessions_without_owner_are_killed():
+    pool = FakePool()
+    session = pool.acquire()
+
+    pool.release(session)
+
+    assert not session.is_alive()
+    assert pool.acquire() is not session
+
+
+def test_acquire_extends_the_timeout_and_replaces_dead_sessions():
+    pool = FakePool(session_timeout=600)
+    session = pool.acquire("alice")
+    pool.release(session, "alice")
+    assert session.timeout == pool.idle_timeout + 60
+
+    session.alive = False
+    replacement = pool.acquire("alice")
+
+    assert replacement is not session
+    assert isinstance(replacement, FakeSession)
+    pool.release(replacement, "alice")
+    assert pool.acquire("alice") is replacement
+    assert replacement.timeout == 600
+
+
+def test_idle_sessions_expire():
+    pool = FakePool(idle_timeout=10)
+    session = pool.acquire("alice")
+    pool.release(session, "alice")
+    session.last_used = time.monotonic() - 11
+
+    pool._reap_expired()
+
+    assert not session.is_alive()
+    assert pool.acquire("alice") is not session
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from cachetools import LRUCache, TTLCache
+
+from app.engine.tools.http_clients import AsyncClients
+from app.engine.tools.weather import OpenMeteoWeather
+
+
+class MockOpenMeteo:
+    """
+    A local stand-in for the geocoding and forecast APIs that records the requests.
+    """
+
+    def __init__(self):
+        self.requests: List[str] = []
+        self.latitude = 52.52
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                mock.requests.append(url.path)
+                if url.path == "/search":
+                    body: Dict = {
+                        "results": [
+                            {
+                                "id": 1,
+                                "name": params["name"],
+                                "latitude": mock.latitude,
+                                "longitude": 13.41,
+                            }
+                        ]
+                    }
+                else:
+                    body = {
+                        "latitude": float(params["latitude"]),
+                        "current": {"temperature_2m": 20.0, "weather_code": 0},
+                    }
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def count(self, path: str) -> int:
+        return self.requests.count(path)
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    mock = MockOpenMeteo()
+    monkeypatch.setattr(OpenMeteoWeather, "geo_api", mock.url)
+    monkeypatch.setattr(OpenMeteoWeather, "weather_api", mock.url)
+    monkeypatch.setattr(OpenMeteoWeather, "_geo_cache", LRUCache(maxsize=16))
+    monkeypatch.setattr(
+        OpenMeteoWeather, "_forecast_cache", TTLCache(maxsize=16, ttl=600)
+    )
+    monkeypatch.setattr(OpenMeteoWeather, "_client", None)
+    monkeypatch.setattr(OpenMeteoWeather, "_async_clients", AsyncClients(timeout=5))
+    yield mock
+    mock.server.shutdown()
+    mock.server.server_close()
+
+
+def test_geocoding_and_forecasts_are_cached(mock_api):
+    first = OpenMeteoWeather.get_weather_information("Berlin")
+    second = OpenMeteoWeather.get_weather_information(" berlin ")
+
+    assert first == second
+    assert first["latitude"] == 52.52
+    assert mock_api.requests == ["/search", "/forecast"]
+
+
+def test_forecast_is_fetched_speculatively_with_an_expired_location(
+    mock_api, monkeypatch
+):
+    OpenMeteoWeather.get_weather_information("Berlin")
+    monkeypatch.setattr(OpenMeteoWeather, "geo_cache_ttl", 0)
+    OpenMeteoWeather._forecast_cache.clear()
+
+    forecast = asyncio.run(OpenMeteoWeather.aget_weather_information("Berlin"))
+
+    # The location is refreshed while the forecast of the cached location is fetched
+    assert forecast["latitude"] == 52.52
+    assert mock_api.count("/search") == 2
+    assert mock_api.count("/forecast") == 2
+
+
+def test_speculative_forecast_is_discarded_when_the_location_moved(
+    mock_api, monkeypatch
+):
+    OpenMeteoWeather.get_weather_information("Berlin")
+    monkeypatch.setattr(OpenMeteoWeather, "geo_cache_ttl", 0)
+    OpenMeteoWeather._forecast_cache.clear()
+    mock_api.latitude = 48.14
+
+    forecast = asyncio.run(OpenMeteoWeather.aget_weather_information("Berlin"))
+
+    assert forecast["latitude"] == 48.14
+    assert mock_api.count("/search") == 2
+    assert mock_api.count("/forecast") == 3